@@ -0,0 +1,45 @@
+"""Compare batch queries against one scalar query per session.
+
+Needs NumPy (`pip install ravel[batch]`).
+
+Usage:
+
+    python benchmarks/bench_batch.py [number of rules] [number of sessions]
+"""
+import random
+import sys
+import time
+
+from bench_engines import make_queries, make_ruleset
+
+from ravel import batch, queries
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<16} {elapsed * 1000:>10.1f} ms")
+    return result, elapsed
+
+
+def main(size, sessions):
+    rng = random.Random(42)
+    ruleset = make_ruleset(size, rng)
+    qs = [q for _ in range(sessions // 200 + 1) for q in make_queries(size, rng)][:sessions]
+    print(f"{size} rules, {len(qs)} sessions")
+
+    rulebook = {"Situation": {**ruleset, "index": queries.build_index(ruleset["rules"])}}
+    query, _ = timed("build", lambda: batch.BatchQuery.build(ruleset))
+    matrix, _ = timed("encode", lambda: query.encode(qs))
+    expected, scalar = timed("scalar", lambda: [queries.query_top("Situation", q, rulebook) for q in qs])
+    results, vectorized = timed("batch", lambda: query.query_top(matrix))
+    assert results == expected, "batch results disagree with the scalar path"
+    print(f"speedup {scalar / vectorized:.1f}x")
+
+
+if __name__ == "__main__":
+    main(
+        int(sys.argv[1]) if len(sys.argv) > 1 else 2_000,
+        int(sys.argv[2]) if len(sys.argv) > 2 else 2_000,
+    )
@@ -0,0 +1,74 @@
+"""Compare the query engines on a large synthetic rulebook.
+
+Rules are grouped into "files" that share a `Location` gate and a couple of
+thresholds, the way a file's `when:` preamble is shared by its rules.
+
+Usage:
+
+    python benchmarks/bench_engines.py [number of rules]
+"""
+import random
+import sys
+import timeit
+
+from ravel import queries, types
+
+RULES_PER_FILE = 20
+QUERIES = 200
+
+
+def predicate(quality, comparator, value):
+    return types.Predicate(quality, types.Comparison(quality, comparator, value))
+
+
+def make_ruleset(size, rng):
+    rules = []
+    locations = {}
+    for number in range(size):
+        location = "Room %d" % (number // RULES_PER_FILE)
+        predicates = [
+            predicate("Location", "=", location),
+            predicate("Turns", ">=", (number // RULES_PER_FILE) % 7),
+            predicate("Counter %d" % rng.randrange(50), rng.choice([">=", "<", ">"]), rng.randrange(5)),
+        ]
+        name = "rule-%06d" % number
+        rules.append(types.Rule(name, sorted(predicates)))
+        locations[name] = types.Situation(name, [])
+    rules.sort()
+    return {"rules": rules, "locations": locations}
+
+
+def make_queries(size, rng):
+    rooms = size // RULES_PER_FILE + 1
+    return [
+        {
+            "Location": "Room %d" % rng.randrange(rooms),
+            "Turns": rng.randrange(10),
+            **{"Counter %d" % counter: rng.randrange(5) for counter in range(0, 50, 3)},
+        }
+        for _ in range(QUERIES)
+    ]
+
+
+def main(size):
+    rng = random.Random(42)
+    ruleset = make_ruleset(size, rng)
+    qs = make_queries(size, rng)
+    print(f"{size} rules, {len(qs)} queries")
+    expected = None
+    for engine in queries.ENGINES:
+        rulebook = {"Situation": {**ruleset, "index": queries.build_index(ruleset["rules"], engine)}}
+
+        def run():
+            return [list(queries.query("Situation", q, rulebook)) for q in qs]
+
+        results = run()
+        if expected is None:
+            expected = results
+        assert results == expected, "%s disagrees with the linear engine" % engine
+        elapsed = timeit.timeit(run, number=3) / 3 / len(qs) * 1e6
+        print(f"{engine:<10} {elapsed:>12.1f} us/query")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20_000)
@@ -0,0 +1,42 @@
+"""Compare interpreted and compiled predicate evaluation.
+
+Usage:
+
+    python benchmarks/bench_predicates.py
+"""
+import timeit
+
+from ravel import types
+
+NUMBER = 200_000
+
+PREDICATES = {
+    'Location = "Foyer"': types.Comparison("Location", "=", "Foyer"),
+    '"Wearing Cloak" >= 1': types.Comparison("Wearing Cloak", ">=", 1),
+    "Bar < 2 + 3 * 4": types.Comparison("Bar", "<", types.Expression(2, "+", types.Expression(3, "*", 4))),
+}
+
+OPERATIONS = {
+    "Bar += 1": types.Operation("Bar", "+=", 1),
+    "Bar = (7 // 2) % 3": types.Operation("Bar", "=", types.Expression(types.Expression(7, "//", 2), "%", 3)),
+}
+
+
+def report(label, interpreted, compiled):
+    slow = timeit.timeit(interpreted, number=NUMBER) / NUMBER * 1e9
+    fast = timeit.timeit(compiled, number=NUMBER) / NUMBER * 1e9
+    print(f"{label:<28} {slow:>10.0f} ns {fast:>10.0f} ns {slow / fast:>8.1f}x")
+
+
+def main():
+    print(f"{'':<28} {'evaluate':>13} {'compiled':>13} {'speedup':>9}")
+    for label, comparison in PREDICATES.items():
+        check = comparison.compile()
+        report(label, lambda: comparison.evaluate(2), lambda: check(2))
+    for label, operation in OPERATIONS.items():
+        apply = operation.compile()
+        report(label, lambda: operation.evaluate(2, qualities={}), lambda: apply(2, qualities={}))
+
+
+if __name__ == "__main__":
+    main()
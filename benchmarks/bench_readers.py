@@ -0,0 +1,43 @@
+"""Compare syml with ravel's reader on the example stories, scaled up.
+
+Each example rulebook is repeated with renamed top-level keys until the
+corpus holds the requested number of copies.
+
+Usage:
+
+    python benchmarks/bench_readers.py [copies of the examples]
+"""
+import re
+import sys
+import timeit
+
+import syml
+from path import Path
+
+from ravel import readers
+
+EXAMPLES = Path(__file__).abspath().dirname().parent / "examples"
+
+TOP_LEVEL_KEY = re.compile(r"^([^\s:#-][^\s:]*):", re.MULTILINE)
+
+
+def make_corpus(copies):
+    sources = [filepath.read_text(encoding="utf-8") for filepath in sorted(EXAMPLES.walkfiles("*.ravel"))]
+    corpus = []
+    for copy in range(copies):
+        for source in sources:
+            corpus.append(TOP_LEVEL_KEY.sub(r"\1-%d:" % copy, source))
+    return corpus
+
+
+def main(copies):
+    corpus = make_corpus(copies)
+    size = sum(len(source) for source in corpus)
+    print("%d documents, %d KiB" % (len(corpus), size // 1024))
+    for name, loads in [("syml", syml.loads), ("readers", readers.loads)]:
+        seconds = min(timeit.repeat(lambda: [loads(source) for source in corpus], number=1, repeat=3))
+        print("%-8s %8.1f ms %8.1f KiB/s" % (name, seconds * 1000, size / 1024 / seconds))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,241 @@
+"""Query one compiled ruleset for many sessions at once.
+
+Numeric and string comparisons against constants are evaluated for every
+session in a handful of NumPy operations over a sessions × qualities matrix
+and a rules × predicates threshold table. Whatever can't be vectorized is
+checked per session, but only for rules whose vectorized predicates held.
+
+NumPy is an optional dependency: `pip install ravel[batch]`.
+"""
+import numbers
+
+import attr
+
+from ravel import queries, types
+
+try:
+    import numpy as np
+except ImportError:  # pragma: nocover
+    np = None
+
+# Comparator codes in the threshold tables; 0 pads rules with fewer predicates.
+COMPARATORS = [">", ">=", "==", "<=", "<", "!="]
+SYMBOL_COMPARATORS = ["==", "!="]
+ALIASES = {"=": "=="}
+
+# Sessions are evaluated in chunks of at most this many (session, predicate) cells.
+CHUNK_CELLS = 1 << 22
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError("Batch queries need NumPy; install ravel[batch].")
+
+
+def get_ufuncs():
+    return {
+        ">": np.greater,
+        ">=": np.greater_equal,
+        "==": np.equal,
+        "<=": np.less_equal,
+        "<": np.less,
+        "!=": np.not_equal,
+    }
+
+
+def get_constant(expression):
+    """Return `(True, value)` for a constant (or constant-foldable) expression."""
+    if queries.is_constant(expression):
+        return True, expression
+    if isinstance(expression, types.Expression):
+        try:
+            return True, expression.compile()()
+        except Exception:
+            return False, None
+    return False, None
+
+
+@attr.s(slots=True)
+class SessionMatrix:
+    """Many sessions' qualities, encoded for `BatchQuery`.
+
+    `values` holds numeric qualities (missing ones as 0, anything else as
+    NaN); `symbols` holds string qualities as codes from the query's string
+    table (-1 for anything else).
+    """
+
+    sessions = attr.ib()
+    values = attr.ib()
+    symbols = attr.ib()
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+@attr.s(slots=True)
+class BatchQuery:
+    """A ruleset compiled into threshold tables for batch queries."""
+
+    rules = attr.ib()
+    locations = attr.ib()
+    ranks = attr.ib()
+    columns = attr.ib()
+    strings = attr.ib()
+    numeric_columns = attr.ib()
+    numeric_comparators = attr.ib()
+    numeric_thresholds = attr.ib()
+    symbol_columns = attr.ib()
+    symbol_comparators = attr.ib()
+    symbol_thresholds = attr.ib()
+    residuals = attr.ib()
+
+    @classmethod
+    def build(cls, ruleset):
+        require_numpy()
+        rules = ruleset["rules"]
+        columns = {}
+        strings = {}
+        numeric = []
+        symbolic = []
+        residuals = {}
+        for position, rule in enumerate(rules):
+            rule_numeric = []
+            rule_symbolic = []
+            for predicate in rule.predicates:
+                comparison = predicate.predicate
+                comparator = getattr(comparison, "comparator", None)
+                comparator = ALIASES.get(comparator, comparator)
+                is_constant, value = get_constant(getattr(comparison, "expression", None))
+                if comparator not in COMPARATORS or not is_constant:
+                    residuals.setdefault(position, []).append(predicate)
+                    continue
+                column = columns.setdefault(predicate.name, len(columns))
+                if isinstance(value, numbers.Real):
+                    rule_numeric.append((column, COMPARATORS.index(comparator) + 1, float(value)))
+                elif isinstance(value, str) and comparator in SYMBOL_COMPARATORS:
+                    code = strings.setdefault(value, len(strings))
+                    rule_symbolic.append((column, SYMBOL_COMPARATORS.index(comparator) + 1, code))
+                else:
+                    residuals.setdefault(position, []).append(predicate)
+            numeric.append(rule_numeric)
+            symbolic.append(rule_symbolic)
+
+        numeric_columns, numeric_comparators, numeric_thresholds = pad_table(numeric, np.float64)
+        symbol_columns, symbol_comparators, symbol_thresholds = pad_table(symbolic, np.int64)
+        return cls(
+            rules=rules,
+            locations=ruleset["locations"],
+            ranks=np.array(queries.rank_rules(rules), dtype=np.int64),
+            columns=columns,
+            strings=strings,
+            numeric_columns=numeric_columns,
+            numeric_comparators=numeric_comparators,
+            numeric_thresholds=numeric_thresholds,
+            symbol_columns=symbol_columns,
+            symbol_comparators=symbol_comparators,
+            symbol_thresholds=symbol_thresholds,
+            residuals=residuals,
+        )
+
+    def encode(self, sessions):
+        """Encode a sequence of quality mappings as a `SessionMatrix`."""
+        sessions = list(sessions)
+        values = np.zeros((len(sessions), len(self.columns)), dtype=np.float64)
+        symbols = np.full((len(sessions), len(self.columns)), -1, dtype=np.int64)
+        for row, qualities in enumerate(sessions):
+            for quality, column in self.columns.items():
+                value = qualities.get(quality)
+                if value is None:
+                    continue
+                if isinstance(value, numbers.Real):
+                    values[row, column] = value
+                else:
+                    values[row, column] = np.nan
+                    if isinstance(value, str):
+                        symbols[row, column] = self.strings.get(value, -1)
+        return SessionMatrix(sessions, values, symbols)
+
+    def satisfied(self, matrix):
+        """Return a sessions × rules boolean array of the rules each session satisfies."""
+        result = np.empty((len(matrix), len(self.rules)), dtype=bool)
+        width = max(1, self.numeric_columns.size + self.symbol_columns.size)
+        step = max(1, CHUNK_CELLS // width)
+        for start in range(0, len(matrix), step):
+            stop = start + step
+            chunk = evaluate_table(
+                matrix.values[start:stop],
+                self.numeric_columns,
+                self.numeric_comparators,
+                self.numeric_thresholds,
+                COMPARATORS,
+            )
+            chunk &= evaluate_table(
+                matrix.symbols[start:stop],
+                self.symbol_columns,
+                self.symbol_comparators,
+                self.symbol_thresholds,
+                SYMBOL_COMPARATORS,
+            )
+            result[start:stop] = chunk
+
+        for position, residual in self.residuals.items():
+            for row in np.flatnonzero(result[:, position]):
+                result[row, position] = queries.match_predicates(matrix.sessions[row], residual)
+        return result
+
+    def query(self, sessions, how_many=1):
+        """Return each session's best `how_many` `(name, location)` results, best first.
+
+        `sessions` is a sequence of quality mappings or an encoded `SessionMatrix`.
+        """
+        matrix = sessions if isinstance(sessions, SessionMatrix) else self.encode(sessions)
+        satisfied = self.satisfied(matrix)
+        keys = np.where(satisfied, self.ranks, len(self.rules))
+        how_many = len(self.rules) if how_many is None else min(how_many, len(self.rules))
+        if how_many <= 0:
+            return [[] for _ in range(len(matrix))]
+        if how_many == 1:
+            best = keys.argmin(axis=1)[:, np.newaxis]
+        else:
+            best = np.argpartition(keys, how_many - 1, axis=1)[:, :how_many]
+            order = np.argsort(np.take_along_axis(keys, best, axis=1), axis=1, kind="stable")
+            best = np.take_along_axis(best, order, axis=1)
+
+        results = []
+        for row, positions in enumerate(best):
+            names = [self.rules[position].name for position in positions if satisfied[row, position]]
+            results.append([(name, self.locations[name]) for name in names])
+        return results
+
+    def query_top(self, sessions):
+        """Return each session's best `(name, location)`, or None, like `queries.query_top`."""
+        return [result[0] if result else None for result in self.query(sessions, how_many=1)]
+
+
+def pad_table(entries, threshold_type):
+    """Pack each rule's `(column, comparator, threshold)` entries into padded rules × predicates arrays."""
+    width = max((len(rule_entries) for rule_entries in entries), default=0)
+    columns = np.zeros((len(entries), width), dtype=np.int64)
+    comparators = np.zeros((len(entries), width), dtype=np.int8)
+    thresholds = np.zeros((len(entries), width), dtype=threshold_type)
+    for position, rule_entries in enumerate(entries):
+        for slot, (column, comparator, threshold) in enumerate(rule_entries):
+            columns[position, slot] = column
+            comparators[position, slot] = comparator
+            thresholds[position, slot] = threshold
+    return columns, comparators, thresholds
+
+
+def evaluate_table(values, columns, comparators, thresholds, comparator_names):
+    """Evaluate a padded threshold table for every session row of `values`."""
+    if not columns.size:
+        return np.ones((values.shape[0], columns.shape[0]), dtype=bool)
+    cells = values[:, columns]
+    matched = np.ones(cells.shape, dtype=bool)
+    ufuncs = get_ufuncs()
+    with np.errstate(invalid="ignore"):
+        for code, name in enumerate(comparator_names, 1):
+            mask = comparators == code
+            if mask.any():
+                matched[:, mask] = ufuncs[name](cells[:, mask], thresholds[mask])
+    return matched.all(axis=2)
@@ -0,0 +1,280 @@
+"""Compiled worlds packed into a single memory-mapped file.
+
+A bundle holds everything `Environment.load` produces for a world: each
+concept's sorted rules with their compiled predicates, the givens and the
+metadata, plus every location's compiled baggage (situations with their
+directives and choices). Locations are found through a sorted string table
+and decoded only when looked up, so opening a bundle reads little more than
+the rules, and the read-only pages are shared by every process that maps it.
+Opening a bundle only decodes its small head; the rules are decoded when the
+world is first loaded from it.
+
+Bundles hold pickles, and unpickling runs whatever code a pickle asks for:
+only load bundles from trusted sources, as you would only import trusted code.
+
+Layout, all integers little-endian:
+
+    magic, format                        header
+    6 × (offset, length)                 section table
+    names                                UTF-8 "concept\\0location", sorted
+    name offsets                         uint64 × (count + 1)
+    blob offsets                         uint64 × (count + 1)
+    head                                 pickled name, givens, metadata, ranges and versions
+    rules                                pickled rules of each concept
+    blobs                                one pickled location after another
+"""
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import weakref
+from collections.abc import Mapping
+
+import attr
+from path import Path
+
+from ravel import exceptions, grammars
+
+MAGIC = b"RAVELBND"
+
+# Bump when the layout changes.
+BUNDLE_FORMAT = 2
+
+HEADER = struct.Struct("<8sI4x")
+SECTION = struct.Struct("<QQ")
+SECTIONS = ["names", "name_offsets", "blob_offsets", "head", "rules", "blobs"]
+SECTIONS_START = HEADER.size + SECTION.size * len(SECTIONS)
+
+
+def get_ravel_version():
+    from ravel import caches
+
+    return caches.get_ravel_version()
+
+
+def get_location_values(ruleset):
+    """Return every compiled location of a ruleset, compiling any lazy baggage."""
+    locations = ruleset["locations"]
+    for name in list(locations):
+        locations[name]
+    return dict.items(locations) if isinstance(locations, dict) else locations.items()
+
+
+def pad(data):
+    return data + b"\0" * (-len(data) % 8)
+
+
+def write_bundle(path, rulebook, name="begin"):
+    """Write a loaded rulebook (as returned by `Environment.load`) to a bundle at `path`."""
+    entries = []
+    rules = {}
+    for concept, ruleset in rulebook["rulebook"].items():
+        rules[concept] = list(ruleset["rules"])
+        for location, value in get_location_values(ruleset):
+            entries.append(((concept + "\0" + location).encode("utf-8"), value))
+    entries.sort(key=lambda entry: entry[0])
+
+    names = []
+    name_offsets = [0]
+    blobs = []
+    blob_offsets = [0]
+    ranges = {}
+    for position, (key, value) in enumerate(entries):
+        names.append(key)
+        name_offsets.append(name_offsets[-1] + len(key))
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        blobs.append(blob)
+        blob_offsets.append(blob_offsets[-1] + len(blob))
+        concept = key.split(b"\0", 1)[0].decode("utf-8")
+        start, _ = ranges.get(concept, (position, position))
+        ranges[concept] = (start, position + 1)
+
+    head = {
+        "name": name,
+        "version": get_ravel_version(),
+        "grammar_version": grammars.GRAMMAR_VERSION,
+        "metadata": rulebook["metadata"],
+        "givens": rulebook["givens"],
+        "concepts": list(rules),
+        "ranges": ranges,
+    }
+    sections = [
+        pad(b"".join(names)),
+        pad(struct.pack("<%dQ" % len(name_offsets), *name_offsets)),
+        pad(struct.pack("<%dQ" % len(blob_offsets), *blob_offsets)),
+        pad(pickle.dumps(head, protocol=pickle.HIGHEST_PROTOCOL)),
+        pad(pickle.dumps(rules, protocol=pickle.HIGHEST_PROTOCOL)),
+        b"".join(blobs),
+    ]
+
+    table = []
+    offset = SECTIONS_START
+    for section in sections:
+        table.append(SECTION.pack(offset, len(section)))
+        offset += len(section)
+
+    path = Path(path)
+    fd, temp_path = tempfile.mkstemp(dir=path.abspath().dirname(), prefix=".tmp-", suffix=".bundle")
+    try:
+        # Bundles are meant to be shared, unlike the private temporary file.
+        os.chmod(fd, 0o644)
+        with os.fdopen(fd, "wb") as fo:
+            fo.write(HEADER.pack(MAGIC, BUNDLE_FORMAT))
+            fo.writelines(table)
+            fo.writelines(sections)
+        os.replace(temp_path, path)
+    except BaseException:
+        Path(temp_path).remove_p()
+        raise
+
+
+def release(views, mapped):
+    for view in views:
+        view.release()
+    mapped.close()
+
+
+class Bundle:
+    """A bundle mapped read-only into memory, until it is closed or garbage-collected."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, "rb") as fi:
+            self.stat = os.fstat(fi.fileno())
+            self.map = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise exceptions.BundleError("%s is not a ravel bundle" % self.path)
+        if version != BUNDLE_FORMAT:
+            raise exceptions.BundleError("%s has bundle format %s, not %s" % (self.path, version, BUNDLE_FORMAT))
+
+        sections = {
+            section: SECTION.unpack_from(self.map, HEADER.size + SECTION.size * index)
+            for index, section in enumerate(SECTIONS)
+        }
+        self.view = memoryview(self.map)
+        self.names = self.get_section(self.view, sections["names"])
+        self.name_offsets = self.get_section(self.view, sections["name_offsets"]).cast("Q")
+        self.blob_offsets = self.get_section(self.view, sections["blob_offsets"]).cast("Q")
+        self.rules_section = sections["rules"]
+        self.blobs = self.get_section(self.view, sections["blobs"])
+        self.rules = None
+        self.closed = False
+        # Unmapped once nothing (such as a rulebook's locations) uses the bundle any more.
+        self.finalizer = weakref.finalize(
+            self, release, (self.names, self.name_offsets, self.blob_offsets, self.blobs, self.view), self.map
+        )
+        self.head = self.unpickle(self.get_section(self.view, sections["head"]))
+        if self.head["version"] != get_ravel_version():
+            raise exceptions.BundleError(
+                "%s was built by ravel %s, not %s" % (self.path, self.head["version"], get_ravel_version())
+            )
+
+    def unpickle(self, data):
+        try:
+            return pickle.loads(data)
+        except Exception as e:
+            raise exceptions.BundleError("%s can't be read: %s" % (self.path, e)) from e
+
+    def close(self):
+        """Unmap the bundle; locations that haven't been decoded yet can't be any more."""
+        self.closed = True
+        self.finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get_rules(self):
+        """Return the rules of each concept, decoded on first use."""
+        if self.rules is None:
+            self.rules = self.unpickle(self.get_section(self.view, self.rules_section))
+        return self.rules
+
+    @staticmethod
+    def get_section(view, section):
+        offset, length = section
+        return view[offset : offset + length]
+
+    def is_up_to_date(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        return (stat.st_mtime_ns, stat.st_size) == (self.stat.st_mtime_ns, self.stat.st_size)
+
+    def get_name(self, position):
+        return self.names[self.name_offsets[position] : self.name_offsets[position + 1]]
+
+    def find(self, concept, location, start=0, stop=None):
+        """Return the position of a location in the string table, or None."""
+        stop = len(self.name_offsets) - 1 if stop is None else stop
+        low, high = start, stop
+        key = (concept + "\0" + location).encode("utf-8")
+        while low < high:
+            middle = (low + high) // 2
+            if self.get_name(middle).tobytes() < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < stop and self.get_name(low) == key:
+            return low
+        return None
+
+    def decode(self, position):
+        return self.unpickle(self.blobs[self.blob_offsets[position] : self.blob_offsets[position + 1]])
+
+    def get_rulebook(self):
+        """Return the bundle as one compiled rulebook, as a loader would."""
+        return {
+            "rulebook": {
+                concept: {"rules": rules, "locations": BundleLocations(self, concept)}
+                for concept, rules in self.get_rules().items()
+            },
+            "includes": [],
+            "givens": self.head["givens"],
+            "metadata": self.head["metadata"],
+            "is_up_to_date": self.is_up_to_date,
+        }
+
+
+@attr.s(eq=False)
+class BundleLocations(Mapping):
+    """A concept's locations in a bundle, each decoded on first lookup."""
+
+    bundle = attr.ib()
+    concept = attr.ib()
+    decoded = attr.ib(default=attr.Factory(dict), repr=False)
+
+    @property
+    def positions(self):
+        return self.bundle.head["ranges"].get(self.concept, (0, 0))
+
+    def __getitem__(self, location):
+        try:
+            return self.decoded[location]
+        except KeyError:
+            pass
+        if self.bundle.closed:
+            raise exceptions.BundleError("%s was closed; load the world again" % self.bundle.path)
+        start, stop = self.positions
+        position = self.bundle.find(self.concept, location, start, stop)
+        if position is None:
+            raise KeyError(location)
+        value = self.decoded[location] = self.bundle.decode(position)
+        return value
+
+    def __iter__(self):
+        if self.bundle.closed:
+            raise exceptions.BundleError("%s was closed; load the world again" % self.bundle.path)
+        prefix = len(self.concept.encode("utf-8")) + 1
+        for position in range(*self.positions):
+            yield self.bundle.get_name(position)[prefix:].tobytes().decode("utf-8")
+
+    def __len__(self):
+        start, stop = self.positions
+        return stop - start
@@ -0,0 +1,359 @@
+import contextlib
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import tempfile
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+
+import attr
+from path import Path
+
+from ravel import grammars
+
+logger = logging.getLogger("ravel.caches")
+
+# Bump when the layout of cache entries changes.
+CACHE_FORMAT = 1
+
+
+def get_fingerprint(data):
+    """Return a short digest of a rulebook file's bytes."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def get_ravel_version():
+    from importlib import metadata
+
+    try:
+        return metadata.version("ravel")
+    except metadata.PackageNotFoundError:  # pragma: nocover
+        return "unknown"
+
+
+@attr.s
+class DiskCache:
+    """Keep compiled rulebooks on disk between runs.
+
+    Entries are keyed on a hash of the rulebook's source along with
+    everything else the compiled result depends on: the rulebook name and
+    location separator, the ravel version and the grammar version. Entries
+    are written atomically; any entry that can't be read back is discarded,
+    and the rulebook is simply compiled again.
+    """
+
+    path = attr.ib(converter=Path)
+    version = attr.ib(default=attr.Factory(get_ravel_version))
+    grammar_version = attr.ib(default=grammars.GRAMMAR_VERSION)
+
+    def get_key(self, source, name="", location_separator="::"):
+        digest = hashlib.sha256()
+        for part in (str(CACHE_FORMAT), self.version, self.grammar_version, name, location_separator, source):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get_path(self, key):
+        return self.path / (key + ".pickle")
+
+    def get(self, key):
+        """Return the compiled rulebook stored under `key`, or None."""
+        filepath = self.get_path(key)
+        try:
+            with open(filepath, "rb") as fi:
+                stored_key, rulebook = pickle.load(fi)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.warning("Discarding unreadable cache entry %s", filepath, exc_info=True)
+            self.discard(key)
+            return None
+        if stored_key != key or not isinstance(rulebook, dict):
+            logger.warning("Discarding mismatched cache entry %s", filepath)
+            self.discard(key)
+            return None
+        return rulebook
+
+    def put(self, key, rulebook):
+        """Store a compiled rulebook under `key`, atomically replacing any older entry."""
+        rulebook = {k: v for k, v in rulebook.items() if k != "is_up_to_date"}
+        self.path.makedirs_p()
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix=".tmp-", suffix=".pickle")
+        try:
+            with os.fdopen(fd, "wb") as fo:
+                pickle.dump((key, rulebook), fo, protocol=pickle.HIGHEST_PROTOCOL)
+                fo.flush()
+                os.fsync(fo.fileno())
+            os.replace(temp_path, self.get_path(key))
+        except BaseException:
+            Path(temp_path).remove_p()
+            raise
+
+    def discard(self, key):
+        self.get_path(key).remove_p()
+
+    def clear(self):
+        for filepath in self.path.glob("*.pickle"):
+            filepath.remove_p()
+
+
+@attr.s
+class CompileCache:
+    """Intern compiled predicates and effects by their source text.
+
+    Identical sources (ignoring surrounding whitespace) compile once and
+    share the resulting object, which must therefore not be mutated. At
+    most `maxsize` entries are kept, least recently used first to go, so a
+    long-lived process reloading edited stories doesn't grow without bound.
+    """
+
+    maxsize = attr.ib(default=8192)
+    entries = attr.ib(default=attr.Factory(OrderedDict), repr=False)
+    hits = attr.ib(default=0)
+    misses = attr.ib(default=0)
+    evictions = attr.ib(default=0)
+
+    def get(self, kind, source, compile):
+        """Return the cached `kind` compiled from `source`, compiling it with `compile(source)` on a miss."""
+        key = (kind, source.strip())
+        try:
+            result = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            result = self.entries[key] = compile(source)
+            if self.maxsize is not None and len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return result
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+def get_size(value):
+    """Return the approximate size in bytes of a compiled rulebook.
+
+    Containers and the objects of `ravel.types` are followed; anything else
+    (such as the environment of lazily compiled baggage) is counted shallowly.
+    """
+    seen = set()
+    size = 0
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        size += sys.getsizeof(value)
+        if isinstance(value, dict):
+            stack.extend(value.keys())
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            stack.extend(value)
+        elif type(value).__module__ == "ravel.types":
+            if attr.has(type(value)):
+                stack.extend(getattr(value, field.name) for field in attr.fields(type(value)))
+            elif hasattr(value, "__dict__"):
+                stack.extend(vars(value).values())
+    return size
+
+
+@attr.s(eq=False)
+class RulebookCache(MutableMapping):
+    """Compiled rulebooks by name, bounded in entries and/or approximate bytes.
+
+    Once over a bound, entries are evicted least recently used first, or
+    least frequently used first with `policy="lfu"`. Pinned entries (the
+    rulebooks of the story an environment last loaded) are never evicted.
+    Entries holding the same compiled rulebook (such as a rulebook kept under
+    its name and under its content key) share it, and it is counted once
+    against both bounds. Lookups, misses (including stale entries, with
+    `get_fresh`), recompiles (entries replaced because they went stale) and
+    evictions are counted. Sizes are only measured, with `sizer`, when the
+    cache is bounded by `max_bytes`.
+    """
+
+    max_entries = attr.ib(default=None)
+    max_bytes = attr.ib(default=None)
+    policy = attr.ib(default="lru", validator=attr.validators.in_(["lru", "lfu"]))
+    sizer = attr.ib(default=get_size, repr=False)
+
+    entries = attr.ib(init=False, factory=OrderedDict, repr=False)
+    payloads = attr.ib(init=False, factory=dict, repr=False)
+    payload_refs = attr.ib(init=False, factory=dict, repr=False)
+    uses = attr.ib(init=False, factory=dict, repr=False)
+    pinned = attr.ib(init=False, factory=dict, repr=False)
+    holds = attr.ib(init=False, default=0, repr=False)
+    total_bytes = attr.ib(init=False, default=0)
+    hits = attr.ib(init=False, default=0)
+    misses = attr.ib(init=False, default=0)
+    recompiles = attr.ib(init=False, default=0)
+    evictions = attr.ib(init=False, default=0)
+
+    def __getitem__(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        self.entries.move_to_end(key)
+        self.uses[key] += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.entries:
+            if self.entries[key] is not value:
+                self.recompiles += 1
+            self.remove_payload(key)
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        self.uses.setdefault(key, 0)
+        self.add_payload(key, value)
+        self.evict(keep=key)
+
+    def __delitem__(self, key):
+        del self.entries[key]
+        del self.uses[key]
+        self.remove_payload(key)
+
+    def get_fresh(self, key):
+        """Return the entry under `key` if it is still up to date, or None; stale entries are misses."""
+        value = self.entries.get(key)
+        if value is None or not value["is_up_to_date"]():
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        self.uses[key] += 1
+        return value
+
+    @staticmethod
+    def get_payload(value):
+        """Return the identity of the compiled rulebook an entry holds."""
+        return id(value.get("rulebook", value) if isinstance(value, Mapping) else value)
+
+    def add_payload(self, key, value):
+        payload = self.payloads[key] = self.get_payload(value)
+        refs = self.payload_refs.get(payload)
+        if refs is None:
+            size = self.sizer(value) if self.max_bytes is not None else 0
+            refs = self.payload_refs[payload] = [0, size]
+            self.total_bytes += size
+        refs[0] += 1
+
+    def remove_payload(self, key):
+        payload = self.payloads.pop(key)
+        refs = self.payload_refs[payload]
+        refs[0] -= 1
+        if not refs[0]:
+            del self.payload_refs[payload]
+            self.total_bytes -= refs[1]
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def keys(self):
+        return self.entries.keys()
+
+    def values(self):
+        return self.entries.values()
+
+    def items(self):
+        return self.entries.items()
+
+    def is_full(self):
+        return (self.max_entries is not None and len(self.payload_refs) > self.max_entries) or (
+            self.max_bytes is not None and self.total_bytes > self.max_bytes
+        )
+
+    def get_victims(self, keep=None):
+        """Return the evictable keys, first to go first; `keep`, the entry just added, isn't one."""
+        keys = [key for key in self.entries if key not in self.pinned and key != keep]
+        if self.policy == "lfu":
+            # Sorting is stable, so entries used as often go least recently used first.
+            keys.sort(key=self.uses.__getitem__)
+        return keys
+
+    def evict(self, keep=None):
+        if self.holds or not self.is_full():
+            return
+        for key in self.get_victims(keep):
+            del self[key]
+            self.evictions += 1
+            if not self.is_full():
+                break
+
+    @contextlib.contextmanager
+    def holding(self):
+        self.holds += 1
+        try:
+            yield
+        finally:
+            self.holds -= 1
+            self.evict()
+
+    def pin(self, keys):
+        for key in keys:
+            self.pinned[key] = self.pinned.get(key, 0) + 1
+
+    def unpin(self, keys):
+        for key in keys:
+            count = self.pinned.pop(key, 0) - 1
+            if count > 0:
+                self.pinned[key] = count
+        self.evict()
+
+    def clear(self):
+        self.entries.clear()
+        self.payloads.clear()
+        self.payload_refs.clear()
+        self.uses.clear()
+        self.total_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.payload_refs),
+            "keys": len(self.entries),
+            "bytes": self.total_bytes,
+            "pinned": len(self.pinned),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "recompiles": self.recompiles,
+            "evictions": self.evictions,
+        }
+
+
+def to_rulebook_cache(value):
+    """Return `value` as a `RulebookCache`, copying the entries of any other mapping into an unbounded one."""
+    if isinstance(value, RulebookCache):
+        return value
+    if not isinstance(value, Mapping):
+        raise TypeError("The rulebook cache must be a RulebookCache or a mapping, not %r" % type(value).__name__)
+    cache = RulebookCache()
+    cache.update(value)
+    return cache
@@ -1,13 +1,15 @@
 # pragma: nocover
+import json
 import logging
-import pdb
+import os
 import sys
 import textwrap
+import zipfile
 
 import click
 from colorclass import Color
 
-from ravel import loaders
+from ravel import bundles, caches, loaders, profilers, watchers
 from ravel.environments import Environment
 from ravel.vm import runners
 from ravel.vm.signals import SIGNAL
@@ -36,16 +38,74 @@ def main(config, verbose, debug):
 
 @main.command()
 @click.argument("directory", type=click.STRING)
+@click.option("--cache-dir", type=click.STRING, default=None, help="Keep compiled rulebooks in this directory.")
+@click.option("--jobs", type=click.INT, default=None, help="Compile rulebooks across this many processes.")
+@click.option("--lazy", is_flag=True, default=False, help="Compile each situation when it is first visited.")
+@click.option("--watch", is_flag=True, default=False, help="Watch the story's files instead of checking them.")
+@click.option("--fingerprint", is_flag=True, default=False, help="Check the story's files by their content.")
 @pass_config
-def run(config, directory):
-    """Run the indicated story."""
+def run(config, directory, cache_dir, jobs, lazy, watch, fingerprint):
+    """Run the indicated story, from its directory, a zip archive or a (trusted) bundle."""
+    if zipfile.is_zipfile(directory):
+        reject_options(["--watch", "--fingerprint"], [watch, fingerprint], "a zip archive")
+        loader = loaders.ZipLoader(directory)
+    elif os.path.isfile(directory):
+        reject_options(
+            ["--cache-dir", "--jobs", "--lazy", "--watch", "--fingerprint"],
+            [cache_dir, jobs, lazy, watch, fingerprint],
+            "a bundle, which is already compiled",
+        )
+        loader = loaders.BundleLoader(directory)
+    else:
+        loader = loaders.FileSystemLoader(
+            directory, watcher=watchers.get_watcher() if watch else None, fingerprint=fingerprint
+        )
     env = Environment(
-        loader=loaders.FileSystemLoader(directory),
+        loader=loader,
+        disk_cache=caches.DiskCache(cache_dir) if cache_dir else None,
+        parallel_workers=jobs,
+        lazy_situations=lazy,
     )
     with ConsoleRunner(env, debug=config.debug, verbose=config.verbose) as runner:
         runner.run()
 
 
+def reject_options(names, values, source):
+    """Refuse options that can't apply to a story loaded from `source`."""
+    given = [name for name, value in zip(names, values) if value]
+    if given:
+        raise click.UsageError("%s can't be used with %s" % (", ".join(given), source))
+
+
+@main.command()
+@click.argument("directory", type=click.STRING)
+@click.argument("output", type=click.STRING)
+@pass_config
+def build(config, directory, output):
+    """Compile the indicated story into a single bundle.
+
+    Bundles are unpickled when run, so only run bundles from trusted sources.
+    """
+    env = Environment(loader=loaders.FileSystemLoader(directory))
+    bundles.write_bundle(output, env.load(), name=env.initializing_name)
+
+
+@main.command("profile-compile")
+@click.argument("directory", type=click.STRING)
+@click.option("--top", type=click.INT, default=10, help="Show this many of the slowest rules.")
+@click.option("--json", "as_json", is_flag=True, default=False, help="Print the timings as JSON.")
+@pass_config
+def profile_compile(config, directory, top, as_json):
+    """Compile the indicated story and show where the time went."""
+    profiler = profilers.CompileProfiler()
+    env = Environment(loader=loaders.FileSystemLoader(directory), profiler=profiler)
+    env.load()
+    if as_json:
+        click.echo(json.dumps(profiler.as_dict(top), indent=2))
+    else:
+        click.echo(profiler.format(top))
+
+
 class ConsoleRunner(runners.StatefulRunner):
     def __init__(self, env: Environment, debug: bool = False, verbose: bool = False):
         super().__init__(env)
@@ -122,6 +182,8 @@ class ConsoleRunner(runners.StatefulRunner):
     def handle_exception(self, debug=False):
         logging.exception("Something bad happened...")
         if debug:
+            import pdb
+
             pdb.post_mortem()
         sys.exit(1)
 
@@ -3,7 +3,7 @@ from collections.abc import Mapping, Sequence
 
 from slugify import slugify_unicode  # type: ignore
 
-from ravel import exceptions, parsers, types
+from ravel import exceptions, parsers, profilers, types
 from ravel.utils.data import merge_dicts
 from ravel.utils.strings import get_text, is_text, unwrap
 
@@ -58,7 +58,9 @@ def compile_choice(environment, concept, parent_rule, directives):
     if is_text(directives):
         directives = [directives]
     intro, directives, subsituations = compile_directives(environment, concept, parent_rule, directives)
-    subrule = environment.location_separator.join([parent_rule, slugify_unicode(get_text(intro), to_lower=True)])
+    with profilers.phase(environment, "slugify"):
+        slug = slugify_unicode(get_text(intro), to_lower=True)
+    subrule = environment.location_separator.join([parent_rule, slug])
     try:
         return (
             types.Choice(subrule),
@@ -7,7 +7,7 @@ from . import logger
 
 def compile_effect(environment, concept, parent_rule, effect):
     logger.debug("Compiling effect for %s:%s:\n%r", concept, parent_rule, effect)
-    return parsers.OperationParser().parse(get_text(effect)), {}
+    return environment.compile_cache.get("effect", get_text(effect), parsers.OperationParser().parse), {}
 
 
 def compile_effects(environment, concept, parent_rule, raw_effects):
@@ -3,6 +3,10 @@ from ravel.utils.strings import get_text
 
 
 def compile_predicate(environment, target):
+    return environment.compile_cache.get("predicate", get_text(target), lambda source: _compile_predicate(target))
+
+
+def _compile_predicate(target):
     try:
         comparison = parsers.ComparisonParser().parse(get_text(target))
     except (
@@ -11,4 +15,5 @@ def compile_predicate(environment, target):
         exceptions.VisitationError,
     ):
         exceptions.raise_parse_error(target, exceptions.ComparisonParseError)
+    comparison.compile()
     return types.Predicate(comparison.quality, comparison)
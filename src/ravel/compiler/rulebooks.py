@@ -2,7 +2,7 @@ import itertools as it
 from collections import defaultdict
 from collections.abc import Mapping
 
-from ravel import exceptions, types
+from ravel import exceptions, profilers, types
 from ravel.utils.strings import get_text, is_text
 
 from . import situations  # noqa
@@ -79,9 +79,10 @@ def compile_preamble(environment, rulebook):
 
 def compile_rulebook(environment, rulebook, prefix=""):
     """Compile a rulebook declaration"""
-    rules = defaultdict(lambda: {"rules": [], "locations": {}})
+    rules = defaultdict(lambda: {"rules": [], "locations": types.Locations(separator=environment.location_separator)})
 
-    preamble = compile_preamble(environment, rulebook)
+    with profilers.phase(environment, "preamble"):
+        preamble = compile_preamble(environment, rulebook)
 
     for rule_name, data in preamble["rulesets"]:
         if is_when(data[0]):
@@ -100,20 +101,23 @@ def compile_rulebook(environment, rulebook, prefix=""):
         rule_name = prefix + get_text(rule_name)
         concept = get_text(concept)
 
-        rules[concept]["rules"].append(
-            types.Rule(
-                rule_name,
-                compile_ruleset(
-                    environment,
-                    concept,
-                    rule_name,
-                    preamble["common_predicates"] + ruleset_predicates,
-                ),
-            )
-        )
-        rules[concept]["locations"].update(
-            concepts.compile_baggage(environment, concept, rule_name, baggage_data)
-        )
+        with profilers.rule(environment, rule_name):
+            with profilers.phase(environment, "rulesets"):
+                rules[concept]["rules"].append(
+                    types.Rule(
+                        rule_name,
+                        compile_ruleset(
+                            environment,
+                            concept,
+                            rule_name,
+                            preamble["common_predicates"] + ruleset_predicates,
+                        ),
+                    )
+                )
+            with profilers.phase(environment, "baggage"):
+                rules[concept]["locations"].update(
+                    concepts.compile_baggage(environment, concept, rule_name, baggage_data)
+                )
 
     for ruleset in rules.values():
         ruleset["rules"].sort()
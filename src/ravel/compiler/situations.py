@@ -1,4 +1,4 @@
-from ravel import exceptions, types
+from ravel import exceptions, profilers, types
 from ravel.utils.data import merge_dicts
 
 from . import concepts
@@ -17,9 +17,18 @@ def compile_situation_baggage(environment, concept, parent_rule, baggage):
             "Missing baggage for {concept}:{parent_rule}"
         )
 
-    intro, directives, subsituations = _directives.compile_directives(
-        environment, concept, parent_rule, baggage
-    )
+    if environment.lazy_situations:
+        settings = environment.get_compile_settings()
+        return {parent_rule: types.LazyBaggage(compile_situation, settings, concept, parent_rule, baggage)}
+    return compile_situation(environment, concept, parent_rule, baggage)
+
+
+def compile_situation(environment, concept, parent_rule, baggage):
+    """Compile a situation and its choices' sub-situations."""
+    with profilers.phase(environment, "directives"):
+        intro, directives, subsituations = _directives.compile_directives(
+            environment, concept, parent_rule, baggage
+        )
     return {
         parent_rule: types.Situation(intro, directives),
         **merge_dicts(*subsituations),
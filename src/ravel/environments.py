@@ -1,10 +1,14 @@
-from collections import OrderedDict, defaultdict, deque
+import bisect
+import heapq
+import logging
+import threading
+from collections import OrderedDict, deque
 
 import attr
-import syml
 
-from ravel import loaders
-from ravel.compiler import rulebooks
+from ravel import caches, loaders, profilers, queries, types
+
+logger = logging.getLogger("ravel.environments")
 
 
 @attr.s
@@ -12,17 +16,223 @@ class Environment:
     loader = attr.ib(default=attr.Factory(lambda: loaders.FileSystemLoader()))
     location_separator = attr.ib(default="::")
     initializing_name = attr.ib(default="begin")
+    query_engine = attr.ib(default="indexed")
+    query_cache_size = attr.ib(default=1024)
+    disk_cache = attr.ib(default=None)
+    parallel_workers = attr.ib(default=None)
+    lazy_situations = attr.ib(default=False)
+    compile_cache = attr.ib(default=attr.Factory(caches.CompileCache), repr=False)
+    profiler = attr.ib(default=None, repr=False)
+
+    cache = attr.ib(default=attr.Factory(caches.RulebookCache), converter=caches.to_rulebook_cache)
+    query_caches = attr.ib(default=attr.Factory(dict), repr=False)
+    merged = attr.ib(default=None, repr=False)
+    pinned = attr.ib(default=attr.Factory(list), repr=False)
+    compile_lock = attr.ib(init=False, factory=threading.Lock, repr=False, eq=False)
+    compile_settings = attr.ib(init=False, default=None, repr=False, eq=False)
+
+    def __getstate__(self):
+        # Lazily compiled baggage keeps its environment; the caches stay behind.
+        state = {**self.__dict__, "query_caches": {}, "merged": None, "profiler": None, "pinned": []}
+        state["cache"] = caches.RulebookCache()
+        state["compile_cache"] = caches.CompileCache(maxsize=self.compile_cache.maxsize)
+        del state["compile_lock"]
+        state["compile_settings"] = None
+        return state
 
-    cache = attr.ib(default=attr.Factory(dict))
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile_lock = threading.Lock()
 
     def load(self):
         return self.load_rulebook(self.initializing_name)
 
     def load_rulebook(self, name):
-        loaded_rulebooks = OrderedDict()
-        names_to_load = deque([name])
+        # Nothing is evicted until the loaded rulebooks are pinned.
+        with self.cache.holding():
+            if self.parallel_workers:
+                loaded_rulebooks = self.get_rulebooks_in_parallel(name)
+            else:
+                loaded_rulebooks = self.get_rulebooks(name)
+            return self.assemble_rulebook(name, loaded_rulebooks)
+
+    async def load_async(self, executor=None):
+        return await self.load_rulebook_async(self.initializing_name, executor)
+
+    async def load_rulebook_async(self, name, executor=None):
+        """Like `load_rulebook`, without blocking the event loop.
+
+        Sources are fetched with the loader's `get_source_async`, a whole wave
+        of includes at once, and compiled on `executor`: the loop's default
+        executor, or a process pool if `parallel_workers` is set. Freshness
+        checks and assembly run in a thread.
+
+        Only one load should run at a time on an environment: its caches are
+        only safe from the compiling threads, which take `compile_lock` and
+        so compile one file at a time.
+        """
+        import asyncio
+
+        with self.cache.holding():
+            if executor is None and self.parallel_workers:
+                from concurrent.futures import ProcessPoolExecutor
+
+                with ProcessPoolExecutor(max_workers=self.parallel_workers) as executor:
+                    loaded_rulebooks = await self.get_rulebooks_async(name, executor)
+            else:
+                loaded_rulebooks = await self.get_rulebooks_async(name, executor)
+            return await asyncio.to_thread(self.assemble_rulebook, name, loaded_rulebooks)
+
+    def assemble_rulebook(self, name, loaded_rulebooks):
         metadata = {}
         givens = []
+        for rulebook in loaded_rulebooks.values():
+            metadata.update(rulebook["metadata"])
+            givens.extend(rulebook["givens"])
+
+        with profilers.phase(self, "merge"):
+            master_rulebook = self.merge_rulebooks(loaded_rulebooks)
+        rulebook = {
+            "metadata": metadata,
+            "rulebook": master_rulebook,
+            "givens": givens,
+        }
+        self.pin_rulebooks(loaded_rulebooks)
+        logger.info(
+            "Loaded %s; compile cache: %s; rulebook cache: %s",
+            name,
+            self.compile_cache.stats(),
+            self.cache.stats(),
+        )
+        return rulebook
+
+    def pin_rulebooks(self, loaded_rulebooks):
+        """Keep the loaded rulebooks in the cache, in place of those loaded last time."""
+        pinned = list(loaded_rulebooks)
+        for name, rulebook in loaded_rulebooks.items():
+            key = self.get_content_key(name, rulebook["is_up_to_date"])
+            if key is not None:
+                pinned.append(key)
+        self.cache.pin(pinned)
+        self.cache.unpin(self.pinned)
+        self.pinned = pinned
+
+    def merge_rulebooks(self, loaded_rulebooks):
+        """Merge loaded rulebooks into one ruleset per concept.
+
+        Each rulebook's rules are already sorted, so they are combined with a
+        k-way merge. When the same rulebooks are loaded again, concepts that
+        none of the changed rulebooks touch keep the rulesets, indexes and
+        query caches of the previous merge. In concepts that unchanged
+        rulebooks contribute to as well, the changed rulebooks'
+        contributions are swapped in copies; see `update_ruleset`.
+        """
+        key = (tuple(loaded_rulebooks), self.query_engine, self.query_cache_size)
+        changes = []
+        untouched = set()
+        if self.merged is not None and self.merged["key"] == key:
+            master_rulebook = dict(self.merged["rulebook"])
+            concepts = set()
+            for name, rulebook in loaded_rulebooks.items():
+                previous = self.merged["rulebooks"][name]
+                if rulebook is previous:
+                    untouched.update(rulebook["rulebook"])
+                else:
+                    changes.append((previous["rulebook"], rulebook["rulebook"]))
+                    concepts.update(previous["rulebook"])
+                    concepts.update(rulebook["rulebook"])
+        else:
+            self.clear_query_caches()
+            self.query_caches.clear()
+            master_rulebook = {}
+            concepts = {concept for rulebook in loaded_rulebooks.values() for concept in rulebook["rulebook"]}
+
+        for concept in concepts:
+            rulesets = [
+                rulebook["rulebook"][concept]
+                for rulebook in loaded_rulebooks.values()
+                if concept in rulebook["rulebook"]
+            ]
+            ruleset = master_rulebook.get(concept)
+            if (
+                concept in untouched
+                and len(rulesets) > 1
+                and ruleset is not None
+                and isinstance(ruleset["locations"], types.MergedLocations)
+            ):
+                master_rulebook[concept] = self.update_ruleset(concept, ruleset, changes)
+                continue
+
+            cache = self.query_caches.pop(concept, None)
+            if cache is not None:
+                cache.clear()
+            if not rulesets:
+                master_rulebook.pop(concept, None)
+                continue
+
+            if len(rulesets) == 1:
+                # A lone contribution's locations are used as they are, which keeps a bundle's lazy.
+                locations = rulesets[0]["locations"]
+            else:
+                locations = types.MergedLocations(separator=self.location_separator)
+                for contribution in rulesets:
+                    locations.add(contribution["locations"])
+            ruleset = master_rulebook[concept] = {
+                "rules": list(heapq.merge(*[ruleset["rules"] for ruleset in rulesets])),
+                "locations": locations,
+            }
+            with profilers.phase(self, "index"):
+                ruleset["index"] = queries.build_index(ruleset["rules"], self.query_engine)
+            if self.query_cache_size:
+                ruleset["cache"] = self.query_caches[concept] = queries.QueryCache.build(
+                    ruleset["rules"], self.query_cache_size
+                )
+
+        self.merged = {"key": key, "rulebooks": dict(loaded_rulebooks), "rulebook": master_rulebook}
+        return dict(master_rulebook)
+
+    def update_ruleset(self, concept, ruleset, changes):
+        """Return a merged ruleset with the contributions of changed rulebooks swapped in.
+
+        The previous contributions' rules and locations are taken out of
+        copies and the new ones spliced in, and only their entries are
+        updated in a copy of the index; the rules of the other rulebooks
+        aren't touched. Rulebooks already loaded keep the previous ruleset
+        as it was.
+        """
+        removed = []
+        added = []
+        locations = ruleset["locations"].copy()
+        for previous, rulebook in changes:
+            for contributions, rules in ((previous, removed), (rulebook, added)):
+                contribution = contributions.get(concept)
+                if contribution is not None:
+                    rules.extend(contribution["rules"])
+            if concept in previous:
+                locations.remove(previous[concept]["locations"])
+            if concept in rulebook:
+                locations.add(rulebook[concept]["locations"])
+
+        rules = list(ruleset["rules"])
+        for rule in removed:
+            position = bisect.bisect_left(rules, rule)
+            while rules[position] is not rule:
+                position += 1
+            del rules[position]
+        for rule in added:
+            bisect.insort(rules, rule)
+
+        new_ruleset = {"rules": rules, "locations": locations}
+        with profilers.phase(self, "index"):
+            new_ruleset["index"] = queries.update_index(ruleset["index"], removed, added, rules)
+        if ruleset.get("cache") is not None:
+            new_ruleset["cache"] = self.query_caches[concept] = ruleset["cache"].updated(added)
+        return new_ruleset
+
+    def get_rulebooks(self, name):
+        """Return the named rulebook and everything it includes, in breadth-first order."""
+        loaded_rulebooks = OrderedDict()
+        names_to_load = deque([name])
 
         while names_to_load:
             name = names_to_load.popleft()
@@ -35,28 +245,106 @@ class Environment:
                         if include_name not in loaded_rulebooks
                     ]
                 )
-                metadata.update(rulebook["metadata"])
-                givens.extend(rulebook["givens"])
 
-        master_rulebook = defaultdict(lambda: {"rules": [], "locations": {}})
-        for rulebook in loaded_rulebooks.values():
-            for concept, ruleset in rulebook["rulebook"].items():
-                master_concept = master_rulebook[concept]
-                master_concept["rules"].extend(ruleset["rules"])
-                master_concept["locations"].update(ruleset["locations"])
+        return loaded_rulebooks
 
-        for ruleset in master_rulebook.values():
-            ruleset["rules"].sort()
+    def get_rulebooks_in_parallel(self, name):
+        """Like `get_rulebooks`, but compile each wave of includes across a process pool.
 
-        return {
-            "metadata": metadata,
-            "rulebook": dict(master_rulebook),
-            "givens": givens,
-        }
+        Sources are read here; only compilation happens in the workers. The
+        include graph is walked one breadth-first level at a time, which visits
+        rulebooks in the same order as the serial walk.
+        """
+        if not self.loader.has_sources:
+            # Nothing to compile, such as a bundle.
+            return self.get_rulebooks(name)
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        loaded_rulebooks = OrderedDict()
+        worker_environment = self.get_worker_environment()
+        wave = [name]
+        with ProcessPoolExecutor(max_workers=self.parallel_workers) as executor:
+            while wave:
+                compiling = {}
+                for name in wave:
+                    rulebook = self.cache.get_fresh(name)
+                    if rulebook is None:
+                        source, is_up_to_date = self.loader.get_source(self, name)
+                        rulebook = self.get_shared_rulebook(name, is_up_to_date)
+                        if rulebook is None:
+                            future = executor.submit(compile_source, worker_environment, source, name)
+                            compiling[name] = (future, is_up_to_date)
+                        else:
+                            self.cache[name] = rulebook
+                    loaded_rulebooks[name] = rulebook
+
+                for name, (future, is_up_to_date) in compiling.items():
+                    rulebook = future.result()
+                    rulebook["is_up_to_date"] = is_up_to_date
+                    loaded_rulebooks[name] = self.cache[name] = rulebook
+                    self.share_rulebook(name, rulebook)
+
+                wave = get_next_wave(wave, loaded_rulebooks)
+
+        return loaded_rulebooks
+
+    async def get_rulebooks_async(self, name, executor=None):
+        """Like `get_rulebooks`, loading each wave of includes concurrently."""
+        import asyncio
+
+        loaded_rulebooks = OrderedDict()
+        wave = [name]
+        while wave:
+            # Freshness checks may stat or hash files, so a wave is checked in a thread.
+            rulebooks = dict(zip(wave, await asyncio.to_thread(self.get_fresh_rulebooks, wave)))
+            stale = [name for name, rulebook in rulebooks.items() if rulebook is None]
+            loaded = await asyncio.gather(*[self.loader.load_async(self, name, executor) for name in stale])
+            for name, rulebook in zip(stale, loaded):
+                self.cache[name] = rulebooks[name] = rulebook
+            loaded_rulebooks.update(rulebooks)
+            wave = get_next_wave(wave, loaded_rulebooks)
+        return loaded_rulebooks
+
+    def get_fresh_rulebooks(self, names):
+        return [self.cache.get_fresh(name) for name in names]
+
+    def get_worker_environment(self):
+        """Return a copy of this environment that can be sent to a compiling process."""
+        return attr.evolve(
+            self,
+            loader=None,
+            cache=caches.RulebookCache(),
+            query_caches={},
+            merged=None,
+            pinned=[],
+            compile_cache=caches.CompileCache(maxsize=self.compile_cache.maxsize),
+            profiler=None,
+        )
+
+    def get_compile_settings(self):
+        """Return the settings that lazy baggage compiles with, instead of keeping this environment."""
+        if self.compile_settings is None:
+            self.compile_settings = CompileSettings(self.location_separator, self.compile_cache)
+        return self.compile_settings
+
+    def clear_query_caches(self):
+        """Drop the query results cached for the last loaded rulebook."""
+        for cache in self.query_caches.values():
+            cache.clear()
+
+    def get_rulebook_cache_stats(self):
+        return self.cache.stats()
+
+    def get_compile_cache_stats(self):
+        return self.compile_cache.stats()
+
+    def get_query_cache_stats(self):
+        return {concept: cache.stats() for concept, cache in self.query_caches.items()}
 
     def get_rulebook(self, name):
-        rulebook = self.cache.get(name)
-        if rulebook is None or not rulebook["is_up_to_date"]():
+        rulebook = self.cache.get_fresh(name)
+        if rulebook is None:
             rulebook = self.loader.load(self, name)
             self.cache[name] = rulebook
         return rulebook
@@ -65,10 +353,109 @@ class Environment:
     def default_is_up_to_date():
         return True
 
+    @staticmethod
+    def get_content_key(name, is_up_to_date):
+        fingerprint = getattr(is_up_to_date, "fingerprint", None)
+        return None if fingerprint is None else ("content", name, fingerprint)
+
+    def get_shared_rulebook(self, name, is_up_to_date):
+        """Return the rulebook already compiled from a file with the same name and content, or None.
+
+        Only loaders that fingerprint their files (see `loaders.ContentChecker`)
+        share rulebooks, which are kept in `cache` under a content key as well
+        as under their name. Files with the same name and content compile to
+        the same rulebook, whichever loader or story version they come from.
+        """
+        key = self.get_content_key(name, is_up_to_date)
+        rulebook = None if key is None else self.cache.get(key)
+        return None if rulebook is None else {**rulebook, "is_up_to_date": is_up_to_date}
+
+    def share_rulebook(self, name, rulebook):
+        key = self.get_content_key(name, rulebook["is_up_to_date"])
+        if key is not None:
+            self.cache[key] = rulebook
+
     def compile_rulebook(self, source, name="", is_up_to_date=default_is_up_to_date):
-        data = syml.loads(source, filename=name)
+        rulebook = self.get_shared_rulebook(name, is_up_to_date)
+        if rulebook is None:
+            rulebook = self.build_rulebook(source, name)
+            rulebook["is_up_to_date"] = is_up_to_date
+            self.share_rulebook(name, rulebook)
+        return rulebook
+
+    def build_rulebook(self, source, name=""):
+        """Compile a rulebook, or read it from the disk cache, without sharing it or checking its freshness."""
+        rulebook = key = None
+        if self.disk_cache is not None:
+            key = self.disk_cache.get_key(source, name, self.location_separator)
+            rulebook = self.disk_cache.get(key)
+
+        if rulebook is None:
+            # The compiler (and syml, parsimonious and slugify with it) is only imported to compile.
+            from ravel import readers
+            from ravel.compiler import rulebooks
+
+            with profilers.file(self, name):
+                with profilers.phase(self, "syml"):
+                    data = readers.loads(source, filename=name)
+
+                prefix = name + self.location_separator if name else ""
+                rulebook = rulebooks.compile_rulebook(self, data, prefix)
+            if key is not None:
+                self.disk_cache.put(key, rulebook)
+        return rulebook
+
+    def build_rulebook_locked(self, source, name=""):
+        # Compiling threads share the compile cache and the profiler.
+        with self.compile_lock:
+            return self.build_rulebook(source, name)
+
+    async def compile_rulebook_async(self, source, name="", is_up_to_date=default_is_up_to_date, executor=None):
+        """Compile a rulebook on `executor`, in a worker process if it is a process pool.
+
+        Shared rulebooks are looked up and stored on the event loop. Threads
+        compile one file at a time, as they share this environment's state.
+        """
+        import asyncio
+        from concurrent.futures import ProcessPoolExecutor
 
-        prefix = name + self.location_separator if name else ""
-        rulebook = rulebooks.compile_rulebook(self, data, prefix)
-        rulebook["is_up_to_date"] = is_up_to_date
+        rulebook = self.get_shared_rulebook(name, is_up_to_date)
+        if rulebook is None:
+            loop = asyncio.get_running_loop()
+            if isinstance(executor, ProcessPoolExecutor):
+                args = (compile_source, self.get_worker_environment(), source, name)
+            else:
+                args = (self.build_rulebook_locked, source, name)
+            rulebook = await loop.run_in_executor(executor, *args)
+            rulebook["is_up_to_date"] = is_up_to_date
+            self.share_rulebook(name, rulebook)
         return rulebook
+
+
+@attr.s
+class CompileSettings:
+    """What compiling baggage needs from an environment, without its loader, caches or profiler."""
+
+    location_separator = attr.ib()
+    compile_cache = attr.ib(repr=False)
+    lazy_situations = attr.ib(default=False, init=False)
+    profiler = attr.ib(default=None, init=False, repr=False)
+
+    def __getstate__(self):
+        compile_cache = caches.CompileCache(maxsize=self.compile_cache.maxsize)
+        return {**self.__dict__, "compile_cache": compile_cache}
+
+
+def get_next_wave(wave, loaded_rulebooks):
+    """Return the rulebooks included by `wave` that haven't been loaded yet, in order."""
+    next_wave = OrderedDict()
+    for name in wave:
+        for include_name in loaded_rulebooks[name]["includes"]:
+            if include_name not in loaded_rulebooks:
+                next_wave[include_name] = None
+    return list(next_wave)
+
+
+def compile_source(environment, source, name):
+    """Compile a rulebook in a worker process, leaving its sharing and freshness check to the caller."""
+    return environment.build_rulebook(source, name)
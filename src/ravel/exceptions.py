@@ -1,7 +1,4 @@
-from parsimonious.exceptions import ParseError as ParsimoniousParseError  # noqa: F401
-from parsimonious.exceptions import VisitationError  # noqa: F401
-
-from .types import Source
+from . import types
 
 
 class ParseError(ValueError):
@@ -28,11 +25,28 @@ class RulebookNotFound(Exception):
     pass
 
 
+class BundleError(Exception):
+    pass
+
+
 def raise_parse_error(position, error_type=ParseError):
-    if isinstance(position, Source):
+    if isinstance(position, types.Source):
         raise error_type(
             "%r" % position,
             position,
         )
     else:
         raise error_type("Could not determine source position:\n%r" % position, position)
+
+
+def __getattr__(name):
+    # Parsimonious is only imported once something is parsed.
+    if name == "ParsimoniousParseError":
+        from parsimonious.exceptions import ParseError
+
+        return ParseError
+    if name == "VisitationError":
+        from parsimonious.exceptions import VisitationError
+
+        return VisitationError
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
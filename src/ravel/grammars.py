@@ -1,3 +1,4 @@
+import hashlib
 import textwrap
 
 base_expression_grammar = textwrap.dedent(
@@ -118,3 +119,9 @@ plain_text_grammar = (
     )
     + comparison_grammar
 )
+
+
+# Identifies the grammars above, so anything compiled with other grammars is never reused.
+GRAMMAR_VERSION = hashlib.sha256(
+    "\0".join([operation_grammar, comparison_grammar, intro_text_grammar, plain_text_grammar]).encode("utf-8")
+).hexdigest()[:16]
@@ -1,12 +1,17 @@
 import codecs
+import os
+import threading
 
 import attr
 from path import Path
 
-from . import exceptions
+from . import bundles, caches, exceptions
 
 
 class BaseLoader:
+    # Whether the loader reads sources for the environment to compile, with `get_source`.
+    has_sources = True
+
     def load(self, environment, name):
         source, is_up_to_date = self.get_source(environment, name)
         return environment.compile_rulebook(source, name, is_up_to_date)
@@ -14,13 +19,37 @@ class BaseLoader:
     def get_source(self, environment, name):
         raise NotImplementedError()
 
+    async def load_async(self, environment, name, executor=None):
+        source, is_up_to_date = await self.get_source_async(environment, name)
+        return await environment.compile_rulebook_async(source, name, is_up_to_date, executor)
+
+    async def get_source_async(self, environment, name):
+        """Like `get_source`, without blocking the event loop; by default, `get_source` runs in a thread."""
+        import asyncio
+
+        return await asyncio.to_thread(self.get_source, environment, name)
+
 
 @attr.s
 class FileSystemLoader(BaseLoader):
+    """Load rulebooks from the files of a directory.
+
+    Without a watcher (see `ravel.watchers`), each freshness check compares
+    the file's modification time; with one, it compares the file's
+    generation, which the watcher bumps when the file changes. With
+    `fingerprint` set, it compares the file's content instead, and the
+    environment shares one compiled rulebook between identical files.
+    """
+
     base_path = attr.ib(default=".")
     extension = attr.ib(default=".ravel")
+    watcher = attr.ib(default=None, repr=False)
+    fingerprint = attr.ib(default=False)
 
     def get_up_to_date_checker(self, filepath):
+        if self.watcher is not None:
+            return self.watcher.get_up_to_date_checker(filepath)
+
         filepath = Path(filepath)
         try:
             mtime = filepath.getmtime()
@@ -29,7 +58,6 @@ class FileSystemLoader(BaseLoader):
 
         def is_up_to_date():
             try:
-                print("was %s, now %s" % (mtime, filepath.getmtime()))
                 return mtime == filepath.getmtime()
             except OSError:
                 return False
@@ -41,9 +69,152 @@ class FileSystemLoader(BaseLoader):
         if not filepath.exists():
             raise exceptions.RulebookNotFound(name)
 
+        if self.fingerprint:
+            # Signed before reading, so an edit made while reading is hashed again.
+            signature = ContentChecker.get_signature(filepath)
+            data = filepath.read_bytes()
+            return data.decode("utf-8"), ContentChecker(filepath, caches.get_fingerprint(data), len(data), signature)
+
+        # Checked before reading, so an edit made while reading isn't missed.
+        is_up_to_date = self.get_up_to_date_checker(filepath)
+
         with codecs.open(filepath, encoding="utf-8") as fi:
             source = fi.read()
 
-        is_up_to_date = self.get_up_to_date_checker(filepath)
+        return source, is_up_to_date
+
+
+@attr.s(eq=False)
+class ContentChecker:
+    """Tell whether a file still has the content it was read with, whatever its modification time.
+
+    The file is only read and hashed again when its stat signature changes.
+    Its change time is part of the signature, so edits that put the
+    modification time back are still noticed.
+    """
+
+    path = attr.ib()
+    fingerprint = attr.ib()
+    size = attr.ib()
+    signature = attr.ib(default=None)
+
+    @staticmethod
+    def get_signature(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_size
+
+    def __call__(self):
+        signature = self.get_signature(self.path)
+        if signature is None:
+            return False
+        if signature == self.signature:
+            return True
+        if signature[-1] != self.size:
+            return False
+        try:
+            data = Path(self.path).read_bytes()
+        except OSError:
+            return False
+        if len(data) != self.size or caches.get_fingerprint(data) != self.fingerprint:
+            return False
+        self.signature = signature
+        return True
+
+
+@attr.s
+class BundleLoader(BaseLoader):
+    """Load a whole world from a bundle written by `ravel build`.
+
+    The bundle is memory-mapped once and its locations are decoded as they
+    are looked up. It is reopened if the file changes; the old mapping is
+    released once the rulebooks loaded from it are no longer used. Bundles
+    are unpickled, so only load trusted ones.
+    """
+
+    has_sources = False
+
+    path = attr.ib()
+    bundle = attr.ib(default=None, repr=False)
+
+    def load(self, environment, name):
+        if self.bundle is None or not self.bundle.is_up_to_date():
+            self.bundle = bundles.Bundle(self.path)
+        if name != self.bundle.head["name"]:
+            raise exceptions.RulebookNotFound(name)
+        return self.bundle.get_rulebook()
+
+    async def load_async(self, environment, name, executor=None):
+        import asyncio
+
+        return await asyncio.to_thread(self.load, environment, name)
+
+
+@attr.s
+class ZipLoader(BaseLoader):
+    """Load rulebooks from the members of a zip archive.
+
+    The archive's central directory is read once, into an index of rulebook
+    names, and members are decompressed as they are loaded. Rulebooks are
+    up to date for as long as the archive itself is unchanged; when it
+    changes, it is opened and indexed again.
+    """
+
+    path = attr.ib()
+    base_path = attr.ib(default="")
+    extension = attr.ib(default=".ravel")
+    archive = attr.ib(default=None, repr=False)
+    index = attr.ib(default=None, repr=False)
+    signature = attr.ib(default=None, repr=False)
+    lock = attr.ib(factory=threading.Lock, repr=False, eq=False)
+
+    def __getstate__(self):
+        return {**self.__dict__, "archive": None, "index": None, "signature": None, "lock": None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, lock=threading.Lock())
+
+    def get_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def open(self):
+        """Open and index the archive, again if it changed; call with the lock held."""
+        signature = self.get_signature()
+        if self.archive is not None and signature == self.signature:
+            return
+        import zipfile
+
+        if self.archive is not None:
+            self.archive.close()
+        self.archive = zipfile.ZipFile(self.path)
+        self.signature = signature
+
+        prefix = self.base_path.strip("/") + "/" if self.base_path.strip("/") else ""
+        self.index = {}
+        for info in self.archive.infolist():
+            filename = info.filename
+            if not info.is_dir() and filename.startswith(prefix) and filename.endswith(self.extension):
+                self.index[filename[len(prefix) : len(filename) - len(self.extension)]] = info
+
+    def get_source(self, environment, name):
+        # Sources are fetched from threads (see `get_source_async`): an archive mustn't be
+        # closed and reopened while another thread reads from it.
+        with self.lock:
+            self.open()
+            info = self.index.get(name)
+            if info is None:
+                raise exceptions.RulebookNotFound(name)
+
+            source = self.archive.read(info).decode("utf-8")
+            signature = self.signature
+
+        def is_up_to_date():
+            return self.get_signature() == signature
 
         return source, is_up_to_date
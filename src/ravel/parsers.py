@@ -1,9 +1,183 @@
+import re
+
 from parsimonious import Grammar, NodeVisitor
 
 from ravel import grammars, types
 
+# Tokens of `grammars.base_expression_grammar`, in the grammar's order of preference.
+EXPRESSION_TOKEN = re.compile(
+    r"""\s*(?:
+        (?P<float>\d+\.\d*)
+        | (?P<integer>\d+)
+        | \"\"\"(?P<string1>[^"]+)\"\"\"
+        | '''(?P<string2>[^']+)'''
+        | ```(?P<string3>[^`]+)```
+        | "(?P<string4>[^"]+)"
+        | '(?P<string5>[^']+)'
+        | `(?P<string6>[^`]+)`
+        | (?P<qvalue>value)
+        | \[(?P<bracketed>[^\]]+)\]
+        | (?P<operator>//|[-+*/%()])
+    )""",
+    re.VERBOSE,
+)
+STRING_GROUPS = ["string1", "string2", "string3", "string4", "string5", "string6"]
+
+# Operators at each level of the grammar, loosest first: additive, multiplicative, divisive.
+OPERATOR_LEVELS = [("+", "-"), ("*",), ("//", "/", "%")]
+
+QUALITY = r"""\s*(?:\[(?P<bracketed>[^\]]+)\]|"(?P<quoted>[^"]+)"|(?P<simple>[^\s"\[][^\s]*))\s+"""
+COMPARISON_HEAD = re.compile(QUALITY + r"(?P<comparator>>=|>|<=|<|!=|==|=)\s+")
+OPERATION_HEAD = re.compile(QUALITY + r"(?P<setter>\+=|-=|\*=|//=|/=|%=|=)\s+")
+CONSTRAINT = re.compile(r"\s+(?P<constraint>max|min)\s+(?:(?P<float>\d+\.\d*)|(?P<integer>\d+))")
+END = re.compile(r"\s*\Z")
+PLAIN_TEXT = re.compile(r"(?P<text>(?:(?!<>).)*)(?P<glue><>)?\Z")
+
+
+def scan_expression(text, pos=0):
+    """Return the `(tokens, positions)` of the expression tokens starting at `pos`."""
+    tokens = []
+    positions = []
+    match = EXPRESSION_TOKEN.match(text, pos)
+    while match is not None and match.end() > pos:
+        kind = match.lastgroup
+        if kind == "float":
+            token = ("operand", float(match.group(kind)))
+        elif kind == "integer":
+            token = ("operand", int(match.group(kind)))
+        elif kind in STRING_GROUPS or kind == "bracketed":
+            token = ("operand", match.group(kind))
+        elif kind == "qvalue":
+            token = ("operand", types.VALUE)
+        else:
+            token = (match.group(kind), None)
+        tokens.append(token)
+        pos = match.end()
+        positions.append(pos)
+        match = EXPRESSION_TOKEN.match(text, pos)
+    return tokens, positions
+
+
+def parse_tokens(tokens, index=0, level=0):
+    """Parse an expression from `tokens`, returning `(expression, next index)` or None.
+
+    Like the grammar, each level is right-recursive: `1 - 2 - 3` is `1 - (2 - 3)`.
+    """
+    if level == len(OPERATOR_LEVELS):
+        if index >= len(tokens):
+            return None
+        kind, value = tokens[index]
+        if kind == "operand":
+            return value, index + 1
+        if kind != "(":
+            return None
+        parsed = parse_tokens(tokens, index + 1)
+        if parsed is None or parsed[1] >= len(tokens) or tokens[parsed[1]][0] != ")":
+            return None
+        return parsed[0], parsed[1] + 1
+
+    parsed = parse_tokens(tokens, index, level + 1)
+    if parsed is None:
+        return None
+    term1, index = parsed
+    if index < len(tokens) and tokens[index][0] in OPERATOR_LEVELS[level]:
+        operator = tokens[index][0]
+        parsed = parse_tokens(tokens, index + 1, level)
+        if parsed is None:
+            return None
+        term2, index = parsed
+        return types.Expression(term1, operator, term2), index
+    return term1, index
+
+
+def parse_expression(text, pos=0):
+    """Parse the expression at `pos`, returning `(expression, end)` or None."""
+    tokens, positions = scan_expression(text, pos)
+    parsed = parse_tokens(tokens)
+    if parsed is None:
+        return None
+    expression, count = parsed
+    return expression, positions[count - 1]
+
+
+def get_quality(match):
+    return match.group("bracketed") or match.group("quoted") or match.group("simple")
+
+
+def parse_comparison(text, pos=0, endpos=None):
+    """Parse a comparison without the grammar, or return None if it needs the grammar."""
+    endpos = len(text) if endpos is None else endpos
+    head = COMPARISON_HEAD.match(text, pos, endpos)
+    if head is None:
+        return None
+    parsed = parse_expression(text[:endpos], head.end())
+    if parsed is None or END.match(text, parsed[1], endpos) is None:
+        return None
+    return types.Comparison(get_quality(head), head.group("comparator"), parsed[0])
+
+
+def parse_operation(text):
+    """Parse an operation without the grammar, or return None if it needs the grammar."""
+    head = OPERATION_HEAD.match(text)
+    if head is None:
+        return None
+    parsed = parse_expression(text, head.end())
+    if parsed is None:
+        return None
+    expression, end = parsed
+    constraint = None
+    match = CONSTRAINT.match(text, end)
+    if match is not None:
+        number = float(match.group("float")) if match.group("float") else int(match.group("integer"))
+        constraint = types.Constraint(match.group("constraint"), number)
+        end = match.end()
+    if END.match(text, end) is None:
+        return None
+    return types.Operation(get_quality(head), head.group("setter"), expression, constraint)
+
+
+def parse_plain_text(text):
+    """Parse a line of text without the grammar, or return None if it needs the grammar."""
+    predicate = None
+    pos = 0
+    if text.startswith("{"):
+        close = text.find("}")
+        comparison = None if close < 0 else parse_comparison(text, 1, close)
+        if comparison is None:
+            return None
+        predicate = types.Predicate(comparison.quality, comparison)
+        pos = close + 1
+    match = PLAIN_TEXT.match(text, pos)
+    if match is None:
+        return None
+    return types.Text(match.group("text"), sticky=bool(match.group("glue")), predicate=predicate)
+
+
+class LazyGrammar:
+    """A grammar built on first use and shared by every instance of a parser."""
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.grammar = None
+
+    def __get__(self, instance, owner):
+        if self.grammar is None:
+            self.grammar = Grammar(self.rules)
+        return self.grammar
+
 
 class BaseParser(NodeVisitor):
+    def parse(self, text, pos=0):
+        result = self.parse_fast(text) if pos == 0 else None
+        return self.parse_grammar(text, pos) if result is None else result
+
+    def parse_fast(self, text):
+        """Parse `text` without the grammar, returning None for anything it can't handle."""
+        return None
+
+    def parse_grammar(self, text, pos=0):
+        return super().parse(text, pos)
+
     def reduce_children(self, children):
         children = [c for c in children if c is not None]
         if children:
@@ -55,12 +229,10 @@ class BaseExpressionParser(BaseParser):
 
 
 class ComparisonParser(BaseExpressionParser):
-    grammar = Grammar(
-        (
-            "comparison = ws? quality ws comparator ws expression ws?"
-            + grammars.base_expression_grammar
-        )
-    )
+    grammar = LazyGrammar(grammars.comparison_grammar)
+
+    def parse_fast(self, text):
+        return parse_comparison(text)
 
     def visit_comparator(self, node, children):
         return node.text
@@ -71,7 +243,7 @@ class ComparisonParser(BaseExpressionParser):
 
 
 class IntroTextParser(BaseParser):
-    grammar = Grammar(grammars.intro_text_grammar)
+    grammar = LazyGrammar(grammars.intro_text_grammar)
 
     def visit_head(self, node, children):
         return node.text
@@ -96,7 +268,10 @@ class IntroTextParser(BaseParser):
 
 
 class PlainTextParser(ComparisonParser):
-    grammar = Grammar(grammars.plain_text_grammar)
+    grammar = LazyGrammar(grammars.plain_text_grammar)
+
+    def parse_fast(self, text):
+        return parse_plain_text(text)
 
     def visit_text(self, node, children):
         return node.text
@@ -116,7 +291,10 @@ class PlainTextParser(ComparisonParser):
 
 
 class OperationParser(BaseExpressionParser):
-    grammar = Grammar(grammars.operation_grammar)
+    grammar = LazyGrammar(grammars.operation_grammar)
+
+    def parse_fast(self, text):
+        return parse_operation(text)
 
     def visit_constraint(self, node, children):
         return types.Constraint(node.children[0].text, self.reduce_children(children))
@@ -0,0 +1,98 @@
+"""Timers for the phases of compiling a world.
+
+Compilers time their phases with `phase(environment, name)` (and rules and
+files with `rule` and `file`), which costs next to nothing unless the
+environment has a `CompileProfiler`.
+"""
+import contextlib
+import time
+
+import attr
+
+DISABLED = contextlib.nullcontext()
+
+
+def phase(environment, name):
+    """Time a phase of compilation if the environment is being profiled."""
+    profiler = environment.profiler
+    return DISABLED if profiler is None else profiler.phase(name)
+
+
+def rule(environment, name):
+    """Time the compilation of a rule if the environment is being profiled."""
+    profiler = environment.profiler
+    return DISABLED if profiler is None else profiler.rule(name)
+
+
+def file(environment, name):
+    """Time the compilation of a rulebook file if the environment is being profiled."""
+    profiler = environment.profiler
+    return DISABLED if profiler is None else profiler.file(name)
+
+
+@attr.s(slots=True)
+class PhaseStats:
+    seconds = attr.ib(default=0.0)
+    calls = attr.ib(default=0)
+
+
+@attr.s
+class CompileProfiler:
+    """Accumulate compile time by phase, by rulebook file and by rule."""
+
+    clock = attr.ib(default=time.perf_counter, repr=False)
+    phases = attr.ib(default=attr.Factory(dict))
+    files = attr.ib(default=attr.Factory(dict))
+    rules = attr.ib(default=attr.Factory(dict))
+
+    def add(self, stats, key, seconds):
+        entry = stats.get(key)
+        if entry is None:
+            entry = stats[key] = PhaseStats()
+        entry.seconds += seconds
+        entry.calls += 1
+
+    @contextlib.contextmanager
+    def timing(self, stats, key):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(stats, key, self.clock() - start)
+
+    def phase(self, name):
+        return self.timing(self.phases, name)
+
+    def file(self, name):
+        return self.timing(self.files, name)
+
+    def rule(self, name):
+        return self.timing(self.rules, name)
+
+    def get_slowest_rules(self, how_many=10):
+        return sorted(self.rules.items(), key=lambda item: item[1].seconds, reverse=True)[:how_many]
+
+    def as_dict(self, how_many=10):
+        """Return the timings as plain data, with the `how_many` slowest rules."""
+        return {
+            "phases": {name: attr.asdict(stats) for name, stats in self.phases.items()},
+            "files": {name: attr.asdict(stats) for name, stats in self.files.items()},
+            "slowest_rules": [
+                {"rule": name, **attr.asdict(stats)} for name, stats in self.get_slowest_rules(how_many)
+            ],
+        }
+
+    def format(self, how_many=10):
+        """Return a plain text report of the timings."""
+        lines = []
+        for title, entries in [
+            ("Phase", sorted(self.phases.items(), key=lambda item: item[1].seconds, reverse=True)),
+            ("File", sorted(self.files.items(), key=lambda item: item[1].seconds, reverse=True)),
+            ("Rule", self.get_slowest_rules(how_many)),
+        ]:
+            width = max([len(title)] + [len(name) for name, _ in entries])
+            lines.append("%-*s %10s %8s" % (width, title, "ms", "calls"))
+            for name, stats in entries:
+                lines.append("%-*s %10.3f %8d" % (width, name, stats.seconds * 1000, stats.calls))
+            lines.append("")
+        return "\n".join(lines)
@@ -1,72 +1,912 @@
+import heapq
+import itertools as it
 import logging
+import numbers
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, defaultdict
+from collections.abc import Mapping
+
+import attr
+
+from ravel import types
 
 logger = logging.getLogger("ravel.query")
 
+EQUALITY_COMPARATORS = frozenset(["==", "="])
 
-def query_predicates(query, predicates):
-    matches = []
-    qkeys = set()
-    qvalue = None
-    for predicate in predicates:
-        rkey = predicate.name
-        predicate = predicate.predicate
-        for qkey, qvalue in query:
-            if qkey == rkey:
-                qkeys.add(qkey)
-                logger.debug(
-                    "Checking query `%s: %s` against `%s: %r`",
-                    qkey,
-                    qvalue,
-                    rkey,
-                    predicate,
-                )
-                matched = predicate(qvalue)
-                matches.append(bool(matched))
-                if matched:
-                    logger.debug(
-                        "Matched rule for `%s %r`: %s", rkey, predicate, qvalue
-                    )
-                break
-        else:
-            assert rkey not in qkeys
+RANGE_COMPARATORS = {
+    # For each comparator, the slice of ascending thresholds satisfied by a value.
+    ">=": lambda thresholds, value: slice(0, bisect_right(thresholds, value)),
+    ">": lambda thresholds, value: slice(0, bisect_left(thresholds, value)),
+    "<=": lambda thresholds, value: slice(bisect_left(thresholds, value), None),
+    "<": lambda thresholds, value: slice(bisect_right(thresholds, value), None),
+}
+
+
+def is_constant(term):
+    return not hasattr(term, "evaluate")
+
+
+def is_number(value):
+    return isinstance(value, numbers.Real)
+
+
+def get_equality_key(predicate):
+    """Return the `(quality, value)` an equality predicate requires, or None.
+
+    Only comparisons of a quality against a constant can be indexed; anything
+    else (expressions, arbitrary callables) must be checked the slow way.
+    """
+    comparison = predicate.predicate
+    if getattr(comparison, "comparator", None) not in EQUALITY_COMPARATORS:
+        return None
+    if not is_constant(comparison.expression):
+        return None
+    try:
+        hash(comparison.expression)
+    except TypeError:
+        return None
+    return predicate.name, comparison.expression
+
+
+def get_range_key(predicate):
+    """Return the `(quality, comparator, threshold)` of a numeric range predicate, or None."""
+    comparison = predicate.predicate
+    comparator = getattr(comparison, "comparator", None)
+    if comparator not in RANGE_COMPARATORS:
+        return None
+    if not is_constant(comparison.expression) or not is_number(comparison.expression):
+        return None
+    return predicate.name, comparator, comparison.expression
+
+
+@attr.s(slots=True)
+class RangeIndex:
+    """Ascending thresholds of one quality's range predicates, per comparator.
+
+    Finding which rules' range predicates a value satisfies takes one
+    bisection per comparator, so O(log n + k) for k satisfied predicates.
+    """
+
+    thresholds = attr.ib(default=attr.Factory(dict))
+    positions = attr.ib(default=attr.Factory(dict))
+
+    @classmethod
+    def build(cls, entries):
+        thresholds = {}
+        positions = {}
+        for comparator in RANGE_COMPARATORS:
+            ordered = sorted((threshold, position) for cmp, threshold, position in entries if cmp == comparator)
+            if ordered:
+                thresholds[comparator] = [threshold for threshold, _ in ordered]
+                positions[comparator] = [position for _, position in ordered]
+        return cls(thresholds=thresholds, positions=positions)
+
+    def copy(self):
+        return RangeIndex(
+            thresholds={comparator: list(thresholds) for comparator, thresholds in self.thresholds.items()},
+            positions={comparator: list(positions) for comparator, positions in self.positions.items()},
+        )
+
+    def add(self, comparator, threshold, position):
+        thresholds = self.thresholds.setdefault(comparator, [])
+        index = bisect_right(thresholds, threshold)
+        thresholds.insert(index, threshold)
+        self.positions.setdefault(comparator, []).insert(index, position)
+
+    def remove(self, comparator, threshold, position):
+        thresholds = self.thresholds[comparator]
+        positions = self.positions[comparator]
+        start = bisect_left(thresholds, threshold)
+        index = positions.index(position, start, bisect_right(thresholds, threshold))
+        del thresholds[index]
+        del positions[index]
+        if not thresholds:
+            del self.thresholds[comparator]
+            del self.positions[comparator]
+
+    def satisfied(self, value):
+        """Return the positions of rules whose range predicates hold for `value`."""
+        result = []
+        for comparator, thresholds in self.thresholds.items():
+            if is_number(value):
+                result.extend(self.positions[comparator][RANGE_COMPARATORS[comparator](thresholds, value)])
+            else:
+                # Leave mismatched types to the full check, which treats them like the linear scan does.
+                result.extend(self.positions[comparator])
+        return result
+
+
+@attr.s(slots=True)
+class PresenceFilter:
+    """Skip rules that can't match without qualities a query lacks.
+
+    A rule needs a quality when one of its predicates fails for a missing
+    quality, which is known as soon as the predicate is compiled. The rules
+    allowed for each set of present needed qualities are worked out once
+    and cached.
+    """
+
+    needs = attr.ib()
+    qualities = attr.ib()
+    unindexed = attr.ib(default=attr.Factory(list))
+    maxsize = attr.ib(default=1024)
+    allowed = attr.ib(default=attr.Factory(dict), eq=False, repr=False)
+    counts = attr.ib(default=attr.Factory(Counter), eq=False, repr=False)
+
+    @staticmethod
+    def get_needs(rule):
+        return frozenset(predicate.name for predicate in rule.predicates if not predicate.holds_when_missing())
+
+    @classmethod
+    def build(cls, rules, unindexed=()):
+        needs = [cls.get_needs(rule) for rule in rules]
+        counts = Counter(quality for rule_needs in needs for quality in rule_needs)
+        return cls(needs=needs, qualities=tuple(sorted(counts)), unindexed=list(unindexed), counts=counts)
+
+    def copy(self):
+        return attr.evolve(
+            self, needs=list(self.needs), unindexed=list(self.unindexed), allowed={}, counts=Counter(self.counts)
+        )
+
+    def add(self, rule, indexed=True):
+        """Add a rule at the next position."""
+        needs = self.get_needs(rule)
+        if not indexed:
+            self.unindexed.append(len(self.needs))
+        self.needs.append(needs)
+        self.counts.update(needs)
+        self.qualities = tuple(sorted(self.counts))
+        self.allowed.clear()
+
+    def remove(self, position):
+        """Remove the rule at `position`, which no rule takes again."""
+        needs = self.needs[position]
+        self.needs[position] = None
+        index = bisect_left(self.unindexed, position)
+        if index < len(self.unindexed) and self.unindexed[index] == position:
+            del self.unindexed[index]
+        self.counts.subtract(needs)
+        for quality in needs:
+            if not self.counts[quality]:
+                del self.counts[quality]
+        self.qualities = tuple(sorted(self.counts))
+        self.allowed.clear()
+
+    def get_allowed(self, qualities):
+        """Return the positions of all rules, and of the unindexed rules, that can match the qualities present."""
+        present = frozenset(quality for quality in self.qualities if quality in qualities)
+        allowed = self.allowed.get(present)
+        if allowed is None:
+            if len(self.allowed) >= self.maxsize:
+                self.allowed.clear()
+            positions = frozenset(
+                position for position, needs in enumerate(self.needs) if needs is not None and needs <= present
+            )
+            allowed = self.allowed[present] = (
+                positions,
+                [position for position in self.unindexed if position in positions],
+            )
+        return allowed
+
+
+def get_indexed_keys(rule):
+    """Return the equality and range keys of a rule's indexable predicates."""
+    equalities = []
+    ranges = []
+    for predicate in rule.predicates:
+        key = get_equality_key(predicate)
+        if key is not None:
+            equalities.append(key)
+            continue
+        key = get_range_key(predicate)
+        if key is not None:
+            ranges.append(key)
+    return equalities, ranges
+
+
+@attr.s(slots=True)
+class RulesetIndex:
+    """Index a sorted list of rules on their constant comparisons.
+
+    `==`/`=` predicates are filed by `(quality, value)`, and numeric range
+    predicates in a `RangeIndex` per quality. A rule is only a candidate when
+    every one of its indexed predicates is satisfied by the current
+    qualities; the rest of its predicates are left to `query_predicates`.
+    Rules without an indexed predicate are candidates unless they need a
+    quality that is missing; see `PresenceFilter`.
+
+    Candidates come out ranked best first, the order `query` reports them
+    in, so a top-k query can stop at the k-th accepted rule.
+
+    Rules are filed by position in `rules`. Added rules take the next
+    positions and removed ones leave a hole, so an edited file only touches
+    its own rules' entries; see `update_index`.
+    """
+
+    ranked = True
+
+    rules = attr.ib()
+    scores = attr.ib(default=attr.Factory(list))
+    required = attr.ib(default=attr.Factory(list))
+    equalities = attr.ib(default=attr.Factory(dict))
+    ranges = attr.ib(default=attr.Factory(dict))
+    unindexed = attr.ib(default=attr.Factory(list))
+    presence = attr.ib(default=None)
+    matcher = attr.ib(default=attr.Factory(lambda: PredicateMatcher()), eq=False, repr=False)
+    positions = attr.ib(default=attr.Factory(dict), eq=False, repr=False)
+    removed = attr.ib(default=0)
+
+    @classmethod
+    def build(cls, rules):
+        equalities = defaultdict(lambda: defaultdict(list))
+        ranges = defaultdict(list)
+        required = []
+        unindexed = []
+        for position, rule in enumerate(rules):
+            rule_equalities, rule_ranges = get_indexed_keys(rule)
+            for quality, value in rule_equalities:
+                equalities[quality][value].append(position)
+            for quality, comparator, threshold in rule_ranges:
+                ranges[quality].append((comparator, threshold, position))
+            count = len(rule_equalities) + len(rule_ranges)
+            required.append(count)
+            if not count:
+                unindexed.append(position)
+
+        return cls(
+            rules=list(rules),
+            scores=[get_score(rule) for rule in rules],
+            required=required,
+            equalities={quality: dict(values) for quality, values in equalities.items()},
+            ranges={quality: RangeIndex.build(entries) for quality, entries in ranges.items()},
+            unindexed=unindexed,
+            presence=PresenceFilter.build(rules, unindexed),
+            positions={id(rule): position for position, rule in enumerate(rules)},
+        )
+
+    def copy(self):
+        """Return a copy that can be updated without changing this index."""
+        return attr.evolve(
+            self,
+            rules=list(self.rules),
+            scores=list(self.scores),
+            required=list(self.required),
+            equalities={
+                quality: {value: list(positions) for value, positions in rules_by_value.items()}
+                for quality, rules_by_value in self.equalities.items()
+            },
+            ranges={quality: range_index.copy() for quality, range_index in self.ranges.items()},
+            unindexed=list(self.unindexed),
+            presence=self.presence.copy(),
+            matcher=self.matcher.copy(),
+            positions=dict(self.positions),
+        )
+
+    def add(self, rules):
+        for rule in rules:
+            position = len(self.rules)
+            self.rules.append(rule)
+            self.scores.append(get_score(rule))
+            self.positions[id(rule)] = position
+            rule_equalities, rule_ranges = get_indexed_keys(rule)
+            for quality, value in rule_equalities:
+                self.equalities.setdefault(quality, {}).setdefault(value, []).append(position)
+            for quality, comparator, threshold in rule_ranges:
+                self.ranges.setdefault(quality, RangeIndex()).add(comparator, threshold, position)
+            count = len(rule_equalities) + len(rule_ranges)
+            self.required.append(count)
+            if not count:
+                self.unindexed.append(position)
+            self.presence.add(rule, indexed=bool(count))
+
+    def remove(self, rules):
+        for rule in rules:
+            position = self.positions.pop(id(rule))
+            rule_equalities, rule_ranges = get_indexed_keys(rule)
+            for quality, value in rule_equalities:
+                rules_by_value = self.equalities[quality]
+                rules_by_value[value].remove(position)
+                if not rules_by_value[value]:
+                    del rules_by_value[value]
+                if not rules_by_value:
+                    del self.equalities[quality]
+            for quality, comparator, threshold in rule_ranges:
+                range_index = self.ranges[quality]
+                range_index.remove(comparator, threshold, position)
+                if not range_index.thresholds:
+                    del self.ranges[quality]
+            if not self.required[position]:
+                del self.unindexed[bisect_left(self.unindexed, position)]
+            self.presence.remove(position)
+            # Plans are kept by name, which an edited rule may keep.
+            self.matcher.plans.pop(rule.name, None)
+            self.rules[position] = None
+            self.removed += 1
+
+    def candidates(self, qualities):
+        """Return the rules that may match `qualities`, best first."""
+        hits = Counter()
+        for quality, rules_by_value in self.equalities.items():
+            value = get_value(qualities, quality)
             try:
-                matched = predicate(0)
+                hits.update(rules_by_value.get(value, ()))
             except TypeError:
-                matched = False
-            if matched:
-                logger.debug("Matched rule for `%s %r`: %s", rkey, predicate, qvalue)
-                matches.append(True)
+                for quality_positions in rules_by_value.values():
+                    hits.update(quality_positions)
+
+        for quality, range_index in self.ranges.items():
+            hits.update(range_index.satisfied(get_value(qualities, quality)))
+
+        required = self.required
+        allowed, unindexed = self.presence.get_allowed(qualities)
+        positions = [
+            position for position, count in hits.items() if count == required[position] and position in allowed
+        ]
+        positions.extend(unindexed)
+        positions.sort(key=self.scores.__getitem__, reverse=True)
+        return [self.rules[position] for position in positions]
+
+    def accepted(self, qualities):
+        """Yield the rules accepting `qualities`, best first."""
+        for rule in self.candidates(qualities):
+            if self.matcher.match(qualities, rule):
+                yield rule
+
+
+def get_score(rule):
+    """Rank rules by specificity, then name, as query results are ordered."""
+    return len(rule.predicates), rule.name
+
+
+def rank_rules(rules):
+    """Return the rank of each rule's position, best first."""
+    by_rank = sorted(range(len(rules)), key=lambda position: get_score(rules[position]), reverse=True)
+    ranks = [0] * len(rules)
+    for rank, position in enumerate(by_rank):
+        ranks[position] = rank
+    return ranks
+
+
+def get_predicate_key(predicate):
+    """Identify a distinct predicate, however many rules it appears in."""
+    return predicate.name, repr(predicate.predicate)
+
+
+def get_value(qualities, quality):
+    """Get a quality's value as a predicate sees it: missing qualities compare as 0."""
+    value = qualities.get(quality)
+    return 0 if value is None else value
+
+
+def get_qualities(query):
+    """Return the query as a quality mapping; a sequence of pairs is converted like `dict()`."""
+    return query if isinstance(query, Mapping) else dict(query)
+
+
+def check_predicate(qualities, predicate):
+    """Check a single predicate against a quality mapping, as `query_predicates` would."""
+    if predicate.name in qualities:
+        return bool(types.get_compiled(predicate.predicate)(qualities[predicate.name]))
+    return predicate.holds_when_missing()
+
+
+def match_predicates(qualities, predicates):
+    """Check `predicates` against a quality mapping in order, stopping at the first failure."""
+    return all(check_predicate(qualities, predicate) for predicate in predicates)
+
+
+def query_predicates(query, predicates):
+    return match_predicates(get_qualities(query), predicates)
+
+
+@attr.s(slots=True)
+class PredicateStats:
+    """Runtime counters for one distinct predicate."""
+
+    quality = attr.ib()
+    predicate = attr.ib()
+    checks = attr.ib(default=0)
+    failures = attr.ib(default=0)
+
+    @property
+    def selectivity(self):
+        """Estimated chance of failing, starting from even odds for an unseen predicate."""
+        return (self.failures + 1) / (self.checks + 2)
+
+    def dump(self):
+        return {
+            "quality": self.quality,
+            "predicate": repr(self.predicate),
+            "checks": self.checks,
+            "failures": self.failures,
+            "selectivity": self.selectivity,
+        }
+
+
+@attr.s(slots=True)
+class MatchPlan:
+    """The order to check one rule's predicates in."""
+
+    checks = attr.ib()
+    calls = attr.ib(default=0)
+
+
+@attr.s(slots=True)
+class PredicateMatcher:
+    """Match rules against a quality mapping, checking likely failures first.
+
+    Every distinct predicate counts how often it is checked and how often
+    it fails, across all the rules that share it. Every `reorder_every`
+    matches of a rule, its predicates are re-sorted so the ones that have
+    failed most often are checked first; a match stops at the first
+    failing predicate.
+    """
+
+    reorder_every = attr.ib(default=64)
+    stats = attr.ib(default=attr.Factory(dict))
+    plans = attr.ib(default=attr.Factory(dict))
+
+    def get_stats(self, predicate):
+        key = get_predicate_key(predicate)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = PredicateStats(predicate.name, predicate.predicate)
+        return stats
+
+    def copy(self):
+        """Return a matcher with its own plans, sharing the predicate counters."""
+        return attr.evolve(self, plans=dict(self.plans))
+
+    def get_plan(self, rule):
+        plan = self.plans.get(rule.name)
+        if plan is None:
+            plan = self.plans[rule.name] = MatchPlan(
+                [
+                    (
+                        predicate.name,
+                        types.get_compiled(predicate.predicate),
+                        predicate.holds_when_missing(),
+                        self.get_stats(predicate),
+                    )
+                    for predicate in rule.predicates
+                ]
+            )
+        return plan
+
+    def match(self, qualities, rule):
+        plan = self.get_plan(rule)
+        plan.calls += 1
+        if not plan.calls % self.reorder_every:
+            # A new list, as sorting in place would empty it for anyone iterating over it meanwhile.
+            plan.checks = sorted(plan.checks, key=lambda check: check[3].selectivity, reverse=True)
+
+        for quality, check, default, stats in plan.checks:
+            stats.checks += 1
+            matched = check(qualities[quality]) if quality in qualities else default
+            if not matched:
+                stats.failures += 1
+                return False
+        return True
+
+    def dump(self):
+        """Return the predicate counters, most selective first."""
+        return [
+            stats.dump() for stats in sorted(self.stats.values(), key=lambda stats: stats.selectivity, reverse=True)
+        ]
+
+
+def match_rule(qualities, rule):
+    return match_predicates(qualities, rule.predicates)
+
+
+def dump_predicate_stats(rulebook):
+    """Return the predicate counters of every indexed concept in a rulebook."""
+    return {
+        concept: ruleset["index"].matcher.dump()
+        for concept, ruleset in rulebook.items()
+        if getattr(ruleset.get("index"), "matcher", None) is not None
+    }
+
+
+@attr.s(slots=True)
+class ConceptMatches:
+    """The satisfied rules of one concept, kept up to date one quality at a time.
+
+    Every predicate's last result is remembered along with the number of
+    failing predicates per rule, so a quality change only re-checks the
+    predicates that read that quality.
+    """
+
+    rules = attr.ib()
+    by_quality = attr.ib(default=attr.Factory(dict))
+    results = attr.ib(default=attr.Factory(list))
+    failing = attr.ib(default=attr.Factory(list))
+    satisfied = attr.ib(default=attr.Factory(set))
+
+    @classmethod
+    def build(cls, rules, qualities):
+        by_quality = defaultdict(list)
+        results = []
+        failing = []
+        satisfied = set()
+        for position, rule in enumerate(rules):
+            rule_results = []
+            for slot, predicate in enumerate(rule.predicates):
+                by_quality[predicate.name].append((position, slot, predicate))
+                rule_results.append(check_predicate(qualities, predicate))
+            results.append(rule_results)
+            failing.append(rule_results.count(False))
+            if not failing[-1]:
+                satisfied.add(position)
+
+        return cls(
+            rules=list(rules),
+            by_quality=dict(by_quality),
+            results=results,
+            failing=failing,
+            satisfied=satisfied,
+        )
+
+    def update(self, qualities, quality):
+        for position, slot, predicate in self.by_quality.get(quality, ()):
+            result = check_predicate(qualities, predicate)
+            if result is self.results[position][slot]:
+                continue
+            self.results[position][slot] = result
+            self.failing[position] += -1 if result else 1
+            if self.failing[position]:
+                self.satisfied.discard(position)
             else:
-                logger.debug("Could not match rule for `%s %r`", rkey, predicate)
-                matches.append(False)
-                break
+                self.satisfied.add(position)
+
+    def accepted(self, how_many=None):
+        """Return the best `how_many` satisfied rules, best first, as `query` would order them."""
+        rules = (self.rules[position] for position in self.satisfied)
+        if how_many is None:
+            return sorted(rules, key=get_score, reverse=True)
+        return heapq.nlargest(how_many, rules, key=get_score)
+
+
+@attr.s(slots=True)
+class MatchNetwork:
+    """Incrementally match a rulebook against a changing quality mapping.
+
+    Feed it each `quality_changed` event, and querying a concept costs only
+    as much as the changes since the last query, not the size of the
+    rulebook. The quality mapping is shared, not copied; changes made to it
+    behind the network's back must be followed by a `reset()`.
+    """
+
+    rulebook = attr.ib()
+    qualities = attr.ib()
+    concepts = attr.ib(default=attr.Factory(dict))
+
+    def get_concept(self, concept):
+        matches = self.concepts.get(concept)
+        if matches is None:
+            rules = self.rulebook.get(concept, {"rules": []})["rules"]
+            matches = self.concepts[concept] = ConceptMatches.build(rules, self.qualities)
+        return matches
+
+    def quality_changed(self, event):
+        for matches in self.concepts.values():
+            matches.update(self.qualities, event.quality)
+
+    def reset(self):
+        self.concepts.clear()
+
+    def query(self, concept, how_many=None):
+        ruleset = self.rulebook.get(concept, {"rules": [], "locations": {}})
+        for rule in self.get_concept(concept).accepted(how_many):
+            logger.debug("Query result: (rule %s with score of %s)", rule.name, len(rule.predicates))
+            yield rule.name, query_by_name(rule.name, ruleset)
+
+
+@attr.s(slots=True)
+class DecisionNode:
+    test = attr.ib(default=None)
+    children = attr.ib(default=attr.Factory(dict))
+    rules = attr.ib(default=attr.Factory(list))
+
+    def copy(self):
+        return DecisionNode(
+            self.test, {test: child.copy() for test, child in self.children.items()}, list(self.rules)
+        )
+
+
+@attr.s(slots=True)
+class DecisionDAG:
+    """Share predicate checks between all the rules of a concept.
+
+    Every distinct predicate becomes one test. Each rule is a path of tests
+    through a tree, most widely shared tests first, so rules with common
+    predicates (like a file's `when:` preamble) share the start of their
+    paths. A query walks the tree, pruning every branch below a failed
+    test, and remembers each test's result so that no predicate is checked
+    more than once, even when it turns up on several branches.
+    """
 
-    return all(matches)
+    ranked = True
+
+    rules = attr.ib()
+    scores = attr.ib(default=attr.Factory(list))
+    tests = attr.ib(default=attr.Factory(list))
+    root = attr.ib(default=attr.Factory(DecisionNode))
+    keys = attr.ib(default=attr.Factory(dict), eq=False, repr=False)
+    frequency = attr.ib(default=attr.Factory(Counter), eq=False, repr=False)
+    paths = attr.ib(default=attr.Factory(list), eq=False, repr=False)
+    positions = attr.ib(default=attr.Factory(dict), eq=False, repr=False)
+    removed = attr.ib(default=0)
+
+    @classmethod
+    def build(cls, rules):
+        dag = cls(rules=[])
+        paths = [dag.get_path(rule) for rule in rules]
+        for path in paths:
+            dag.frequency.update(path)
+        for rule, path in zip(rules, paths):
+            dag.insert(rule, path)
+        return dag
+
+    def copy(self):
+        """Return a copy that can be updated without changing this DAG."""
+        return attr.evolve(
+            self,
+            rules=list(self.rules),
+            scores=list(self.scores),
+            tests=list(self.tests),
+            root=self.root.copy(),
+            keys=dict(self.keys),
+            frequency=Counter(self.frequency),
+            paths=list(self.paths),
+            positions=dict(self.positions),
+        )
+
+    def get_path(self, rule):
+        """Return the tests of a rule's predicates, adding the ones never seen before."""
+        path = set()
+        for predicate in rule.predicates:
+            key = get_predicate_key(predicate)
+            if key not in self.keys:
+                self.keys[key] = len(self.tests)
+                self.tests.append(predicate)
+            path.add(self.keys[key])
+        return path
+
+    def insert(self, rule, path):
+        """File a rule at the next position, down its tests' path, most widely shared tests first."""
+        position = len(self.rules)
+        self.rules.append(rule)
+        self.scores.append(get_score(rule))
+        self.positions[id(rule)] = position
+        path = tuple(sorted(path, key=lambda test: (-self.frequency[test], test)))
+        self.paths.append(path)
+        node = self.root
+        for test in path:
+            child = node.children.get(test)
+            if child is None:
+                child = node.children[test] = DecisionNode(test)
+            node = child
+        node.rules.append(position)
+
+    def add(self, rules):
+        for rule in rules:
+            path = self.get_path(rule)
+            self.frequency.update(path)
+            self.insert(rule, path)
+
+    def remove(self, rules):
+        for rule in rules:
+            position = self.positions.pop(id(rule))
+            path = self.paths[position]
+            self.frequency.subtract(path)
+            nodes = [self.root]
+            for test in path:
+                nodes.append(nodes[-1].children[test])
+            nodes[-1].rules.remove(position)
+            # Prune the branches left without rules.
+            for parent, node in zip(reversed(nodes[:-1]), reversed(nodes[1:])):
+                if node.rules or node.children:
+                    break
+                del parent.children[node.test]
+            self.paths[position] = self.rules[position] = None
+            self.removed += 1
+
+    def accepted(self, qualities):
+        """Return the rules accepting `qualities`, best first."""
+        results = [None] * len(self.tests)
+        positions = []
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            positions.extend(node.rules)
+            for test, child in node.children.items():
+                result = results[test]
+                if result is None:
+                    result = results[test] = check_predicate(qualities, self.tests[test])
+                if result:
+                    nodes.append(child)
+        positions.sort(key=self.scores.__getitem__, reverse=True)
+        return [self.rules[position] for position in positions]
+
+
+ENGINES = {
+    "linear": None,
+    "indexed": RulesetIndex,
+    "dag": DecisionDAG,
+}
+
+
+def build_index(rules, engine="indexed"):
+    """Build the index `query` uses to match a ruleset, or None for a linear scan."""
+    try:
+        index_type = ENGINES[engine]
+    except KeyError:
+        raise ValueError("Unknown query engine %r; choose from %s" % (engine, ", ".join(ENGINES)))
+    return None if index_type is None else index_type.build(rules)
+
+
+def update_index(index, removed, added, rules):
+    """Return the index of a ruleset, now `rules`, that lost the `removed` rules and gained the `added` ones.
+
+    The index is copied, not changed, as rulebooks already loaded may still
+    use it. Only the changed rules' entries are updated, unless more rules
+    were removed than are left, when the index is built again to drop the
+    holes.
+    """
+    if index is None:
+        return None
+    if index.removed + len(removed) > len(rules):
+        return type(index).build(rules)
+    index = index.copy()
+    index.remove(removed)
+    index.add(added)
+    return index
 
 
 def query_ruleset(q, rules):
-    q = sorted(q)
+    """Yield the `(score, name)` of each rule in `rules` accepting the query.
+
+    Rules come out best first when the ruleset's index is ranked, otherwise
+    in ruleset order.
+    """
+    qualities = get_qualities(q)
+    index = rules.get("index")
+    if index is not None:
+        for rule in index.accepted(qualities):
+            yield get_score(rule)
+        return
+
     for rule in rules["rules"]:
         logger.debug("Against rule %r", rule)
-        if query_predicates(q, rule.predicates):
+        if match_rule(qualities, rule):
             logger.debug("Rule %s accepted", rule.name)
-            yield (len(rule.predicates), rule.name, query_by_name(rule.name, rules))
+            yield get_score(rule)
         else:
             logger.debug("Rule %s rejected", rule.name)
 
 
+_MISSING = object()
+
+
+def get_relevant_qualities(rules):
+    """Return the qualities any of `rules` reads, in a stable order."""
+    return tuple(sorted({predicate.name for rule in rules for predicate in rule.predicates}))
+
+
+@attr.s(slots=True)
+class QueryCache:
+    """A bounded LRU cache of one concept's query results.
+
+    A query can only depend on the qualities the concept's predicates read,
+    so results are keyed on just those qualities' values (and types), and
+    changes to any other quality still hit the cache.
+    """
+
+    qualities = attr.ib()
+    maxsize = attr.ib(default=1024)
+    entries = attr.ib(default=attr.Factory(OrderedDict), repr=False)
+    hits = attr.ib(default=0)
+    misses = attr.ib(default=0)
+    evictions = attr.ib(default=0)
+
+    @classmethod
+    def build(cls, rules, maxsize=1024):
+        return cls(qualities=get_relevant_qualities(rules), maxsize=maxsize)
+
+    def get_key(self, qualities, how_many=None):
+        """Project `qualities` onto the relevant ones, or return None if they can't be hashed."""
+        key = (
+            how_many,
+            tuple(
+                (type(qualities[quality]), qualities[quality]) if quality in qualities else _MISSING
+                for quality in self.qualities
+            ),
+        )
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        try:
+            result = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return result
+
+    def put(self, key, result):
+        self.entries[key] = result
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def updated(self, rules):
+        """Return an empty cache keyed on the qualities `rules` read as well as this one's."""
+        qualities = frozenset(self.qualities).union(get_relevant_qualities(rules))
+        return QueryCache(qualities=tuple(sorted(qualities)), maxsize=self.maxsize)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+        }
+
+
+def get_accepted_rules(q, ruleset, how_many=None):
+    """Return the `(score, name)` of the best `how_many` rules of a ruleset matching `q`, best first."""
+    accepted = query_ruleset(q, ruleset)
+    if getattr(ruleset.get("index"), "ranked", False):
+        return it.islice(accepted, how_many)
+    elif how_many is None:
+        return sorted(accepted, reverse=True)
+    else:
+        return heapq.nlargest(how_many, accepted)
+
+
 def query(concept, q, rules, how_many=None):
-    accepted_rules = sorted(
-        query_ruleset(q, rules.get(concept, [])),
-        reverse=True,
-    )
-    for score, rname, result in accepted_rules[:how_many]:
+    """Yield the `(name, location)` of the best `how_many` rules of `concept` matching `q`.
+
+    Only the returned rules have their locations looked up. Results come
+    from the ruleset's `QueryCache`, if it has one, when the relevant
+    qualities are unchanged.
+    """
+    ruleset = rules.get(concept, {"rules": [], "locations": {}})
+    cache = ruleset.get("cache")
+    key = None if cache is None else cache.get_key(get_qualities(q), how_many)
+    if key is None:
+        accepted_rules = get_accepted_rules(q, ruleset, how_many)
+    else:
+        accepted_rules = cache.get(key)
+        if accepted_rules is None:
+            accepted_rules = list(get_accepted_rules(q, ruleset, how_many))
+            cache.put(key, accepted_rules)
+
+    for score, rname in accepted_rules:
+        result = query_by_name(rname, ruleset)
         logger.debug(
             "Query result: (rule %s with score of %s) %r", rname, score, result
         )
         yield rname, result
 
 
+def get_cache_stats(rulebook):
+    """Return the query cache counters of every cached concept in a rulebook."""
+    return {concept: ruleset["cache"].stats() for concept, ruleset in rulebook.items() if ruleset.get("cache")}
+
+
 def query_top(concept, q, rules):
     for rname, result in query(concept, q, rules=rules, how_many=1):
         return rname, result
@@ -0,0 +1,114 @@
+"""A fast reader for the subset of syml that rulebooks are written in.
+
+syml parses with a parsimonious grammar, then walks the parse tree to build
+its document nodes. This reader finds the same lines with a few regexes and
+builds the same syml nodes from them directly, so the result, including the
+`Source` positions of `raw=False`, is exactly what `syml.loads` returns.
+Anything outside the subset (unusual whitespace, or lines syml would reject)
+is handed to syml itself.
+
+The nodes are syml 0.3's internals, which is why setup.cfg pins syml.
+"""
+import logging
+import re
+from collections import namedtuple
+
+import syml
+from syml import exceptions, nodes
+
+logger = logging.getLogger("ravel.readers")
+
+# Whitespace other than spaces, tabs and newlines, which syml's regexes and line counting treat differently.
+UNSUPPORTED = re.compile(r"[^\S \t\n]")
+
+INDENT = re.compile(r"\s*")
+COMMENT = re.compile(r"(#|//+)+")
+KEY = re.compile(r"[^\s:]+")
+WS = re.compile(r"[ \t]+")
+
+# Stands in for the parse tree node that syml keeps for positions and error messages.
+Span = namedtuple("Span", ["full_text", "start", "end"])
+
+
+class Unsupported(Exception):
+    """Raised for documents that only syml can read."""
+
+
+def loads(source, filename="", raw=True):
+    """Read a syml document, like `syml.loads(source, filename=filename, raw=raw)`."""
+    try:
+        root = read_document(source)
+    except (Unsupported, exceptions.ParseError) as e:
+        logger.debug("Reading %s with syml: %s", filename or "<string>", e)
+        return syml.loads(source, filename=filename, raw=raw)
+    return root.as_data(filename, raw=raw)
+
+
+def read_document(text):
+    """Build syml's document tree for `text`, or raise `Unsupported`."""
+    if UNSUPPORTED.search(text):
+        raise Unsupported("Unusual whitespace")
+
+    root = nodes.Root(Span(text, 0, len(text)))
+    current = root
+    count = 0
+    pos = 0
+    while pos < len(text):
+        indent = INDENT.match(text, pos)
+        pos = indent.end()
+        if pos == len(text):
+            break
+        line_end = text.find("\n", pos)
+        if line_end < 0:
+            line_end = len(text)
+        if COMMENT.match(text, pos):
+            pos = line_end
+            continue
+
+        parsed = read_structure(text, pos, line_end)
+        if parsed is None:
+            parsed = get_leaf(text, pos, line_end), line_end
+        node, end = parsed
+        if end != line_end:
+            raise Unsupported("Line %r isn't syml" % text[pos:line_end])
+
+        node.level = len(indent.group().replace("\t", " " * 4).strip("\n"))
+        current = current.incorporate_node(node)
+        count += 1
+        pos = line_end
+
+    if not count:
+        raise Unsupported("Empty document")
+    return root
+
+
+def get_leaf(text, start, end):
+    return nodes.TextLeafNode(Span(text, start, end), text[start:end])
+
+
+def read_structure(text, pos, end):
+    """Read a list item, key and value, or section at `pos`, returning `(node, end)` or None."""
+    if pos >= end:
+        return None
+
+    if text[pos] == "-":
+        ws = WS.match(text, pos + 1, end)
+        if ws is not None:
+            value = read_structure(text, ws.end(), end)
+            if value is None and ws.end() < end:
+                value = get_leaf(text, ws.end(), end), end
+            if value is not None:
+                node, value_end = value
+                item = nodes.ListItem(Span(text, pos, value_end))
+                item.incorporate_node(node)
+                return item, value_end
+
+    key = KEY.match(text, pos, end)
+    if key is None or key.end() == end or text[key.end()] != ":":
+        return None
+    section = nodes.KeyValue(Span(text, pos, key.end() + 1), get_leaf(text, pos, key.end()))
+    ws = WS.match(text, key.end() + 1, end)
+    if ws is not None and ws.end() < end:
+        section.incorporate_node(get_leaf(text, ws.end(), end))
+        return section, end
+    return section, key.end() + 1
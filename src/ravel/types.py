@@ -1,21 +1,114 @@
+import functools
+import math
 import operator as op
+import threading
+from collections.abc import Mapping, MutableMapping
 
 import attr
-from syml.types import Pos, Source  # noqa
 
 from ravel.utils.data import evaluate_term
 
+# Python operators equivalent to the `operator` functions used by the types below.
+_INFIX = {
+    ">": ">",
+    ">=": ">=",
+    "==": "==",
+    "=": "==",
+    "<=": "<=",
+    "<": "<",
+    "!=": "!=",
+    "+": "+",
+    "-": "-",
+    "*": "*",
+    "//": "//",
+    "/": "/",
+    "%": "%",
+}
+
+
+class _CodeGenerator:
+    """Build the source of a specialized function, inlining constant terms."""
+
+    def __init__(self, term_kwargs="**kwargs"):
+        self.namespace = {}
+        self.term_kwargs = term_kwargs
+
+    def bind(self, value):
+        name = "_t%d" % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    def term(self, term):
+        if isinstance(term, Expression) and term.operator in _INFIX:
+            return "(%s %s %s)" % (self.term(term.term1), _INFIX[term.operator], self.term(term.term2))
+        elif hasattr(term, "evaluate"):
+            return "%s.evaluate(%s)" % (self.bind(term), self.term_kwargs)
+        elif type(term) in (int, str, bool) or (type(term) is float and math.isfinite(term)):
+            return repr(term)
+        else:
+            return self.bind(term)
+
+    def function(self, name, argument, body):
+        source = "def %s(%s, **kwargs):\n    if %s is None:\n        %s = 0\n    return %s\n" % (
+            name,
+            argument,
+            argument,
+            argument,
+            body,
+        )
+        return self.define(name, source)
+
+    def define(self, name, source):
+        if not self.namespace:
+            # Nothing bound, so identical predicates can share one function.
+            return _define(name, source)
+        exec(compile(source, "<ravel %s>" % name, "exec"), self.namespace)
+        return self.namespace[name]
+
+
+@functools.lru_cache(maxsize=4096)
+def _define(name, source):
+    namespace = {}
+    exec(compile(source, "<ravel %s>" % name, "exec"), namespace)
+    return namespace[name]
+
+
+def compile_term(term):
+    """Compile a term into a function of `**kwargs`, for terms that aren't predicates."""
+    generator = _CodeGenerator()
+    body = generator.term(term)
+    return generator.define("term", "def term(**kwargs):\n    return %s\n" % body)
+
+
+def _getstate(self):
+    """Pickle every attribute but the compiled function, which is rebuilt on demand."""
+    return tuple(None if a.name == "_compiled" else getattr(self, a.name) for a in attr.fields(type(self)))
+
+
+def _setstate(self, state):
+    for a, value in zip(attr.fields(type(self)), state):
+        object.__setattr__(self, a.name, value)
+
+
+def get_compiled(callable_term):
+    """Return the compiled form of a comparison or operation, or the callable itself."""
+    return callable_term.compile() if hasattr(callable_term, "compile") else callable_term
+
 
 @attr.s(slots=True)
 class Choice:
     choice = attr.ib()
 
 
-@attr.s(slots=True, repr=False)
+@attr.s(slots=True, repr=False, getstate_setstate=False)
 class Comparison:
     quality = attr.ib()
     comparator = attr.ib()
     expression = attr.ib()
+    _compiled = attr.ib(default=None, init=False, repr=False, eq=False, order=False)
+
+    __getstate__ = _getstate
+    __setstate__ = _setstate
 
     _comparators = {
         ">": op.gt,
@@ -38,12 +131,23 @@ class Comparison:
             qvalue = 0
         return self.get_comparators()(qvalue, self.get_expression(qvalue=qvalue, **kwargs))
 
+    def compile(self):
+        """Compile into a function equivalent to `evaluate`, built once and reused."""
+        if self._compiled is None:
+            if self.comparator in _INFIX:
+                generator = _CodeGenerator(term_kwargs="qvalue=qvalue, **kwargs")
+                body = "qvalue %s %s" % (_INFIX[self.comparator], generator.term(self.expression))
+                self._compiled = generator.function("comparison", "qvalue", body)
+            else:
+                self._compiled = self.evaluate
+        return self._compiled
+
     def check(self, qualities, **kwargs):
         value = qualities.get(self.quality)
-        return self.evaluate(value, **kwargs)
+        return self.compile()(value, **kwargs)
 
     def __call__(self, qvalue, **kwargs):
-        return self.evaluate(qvalue, **kwargs)
+        return self.compile()(qvalue, **kwargs)
 
     def __repr__(self):
         return "(%r %s %r)" % (self.quality, self.comparator, self.expression)
@@ -60,11 +164,15 @@ class Effect:
     operation = attr.ib()
 
 
-@attr.s(slots=True)
+@attr.s(slots=True, getstate_setstate=False)
 class Expression:
     term1 = attr.ib()
     operator = attr.ib()
     term2 = attr.ib()
+    _compiled = attr.ib(default=None, init=False, repr=False, eq=False, order=False)
+
+    __getstate__ = _getstate
+    __setstate__ = _setstate
 
     _operators = {
         "+": op.add,
@@ -84,6 +192,12 @@ class Expression:
             evaluate_term(self.term2, **kwargs),
         )
 
+    def compile(self):
+        """Compile into a function equivalent to `evaluate`, built once and reused."""
+        if self._compiled is None:
+            self._compiled = compile_term(self) if self.operator in _INFIX else self.evaluate
+        return self._compiled
+
 
 @attr.s(slots=True)
 class BeginChoices:
@@ -95,12 +209,16 @@ class GetChoice:
     pass
 
 
-@attr.s(slots=True)
+@attr.s(slots=True, getstate_setstate=False)
 class Operation:
     quality = attr.ib()
     operator = attr.ib()
     expression = attr.ib()
     constraint = attr.ib(default=None)
+    _compiled = attr.ib(default=None, init=False, repr=False, eq=False, order=False)
+
+    __getstate__ = _getstate
+    __setstate__ = _setstate
 
     _operators = {
         "=": lambda a, b: b,
@@ -127,11 +245,29 @@ class Operation:
         )
         return result
 
+    def compile(self):
+        """Compile into a function equivalent to `evaluate`, built once and reused."""
+        if self._compiled is None:
+            generator = _CodeGenerator()
+            expression = generator.term(self.expression)
+            if self.operator == "=":
+                body = expression
+            elif self.operator[:-1] in _INFIX:
+                body = "initial_value %s %s" % (_INFIX[self.operator[:-1]], expression)
+            else:
+                body = None
+            if body is None:
+                self._compiled = self.evaluate
+            else:
+                self._compiled = generator.function("operation", "initial_value", body)
+        return self._compiled
+
 
 @attr.s(slots=True)
 class Predicate:
     name = attr.ib()
     predicate = attr.ib()
+    _default_truth = attr.ib(default=None, init=False, repr=False, eq=False, order=False)
 
     def check(self, qualities, **kwargs):
         if self.predicate is None:
@@ -139,6 +275,19 @@ class Predicate:
 
         return self.predicate.check(qualities, **kwargs)
 
+    def holds_when_missing(self):
+        """Whether the predicate holds for a missing quality, which compares as 0.
+
+        This can't change, so it's worked out once, when first queried, and
+        remembered. A predicate that can't be evaluated for 0 doesn't hold.
+        """
+        if self._default_truth is None:
+            try:
+                self._default_truth = bool(get_compiled(self.predicate)(0))
+            except Exception:
+                self._default_truth = False
+        return self._default_truth
+
 
 @attr.s(slots=True)
 class Situation:
@@ -146,6 +295,174 @@ class Situation:
     directives = attr.ib()
 
 
+@attr.s(slots=True)
+class LazyBaggage:
+    """Baggage whose compilation is put off until its location is first looked up.
+
+    `settings` stands in for the environment when `handler` is called: it
+    only holds what compiling needs (see `environments.CompileSettings`).
+    """
+
+    handler = attr.ib(eq=False, repr=False)
+    settings = attr.ib(eq=False, repr=False)
+    concept = attr.ib()
+    rule_name = attr.ib()
+    baggage = attr.ib(repr=False)
+    _locations = attr.ib(default=None, init=False, eq=False, repr=False)
+
+    def compile(self):
+        """Return the compiled locations, compiling them once."""
+        if self._locations is None:
+            self._locations = self.handler(self.settings, self.concept, self.rule_name, self.baggage)
+        return self._locations
+
+
+class Locations(MutableMapping):
+    """A concept's compiled baggage by location, compiling `LazyBaggage` on first lookup.
+
+    Lazy baggage is stored under its rule's name. A location nested under it
+    (such as a choice's sub-situation) is found by compiling the nearest
+    enclosing lazy location, found by trimming `separator`-joined names.
+    Membership tests resolve names the same way, and iterating (or taking
+    the length) compiles everything. Compiled baggage replaces its lazy
+    location under `lock`, so lookups can come from several threads.
+    """
+
+    def __init__(self, *args, separator="::", **kwargs):
+        self.data = {}
+        self.separator = separator
+        self.lock = threading.RLock()
+        self.update(*args, **kwargs)
+
+    def __getstate__(self):
+        return {"data": self.data, "separator": self.separator}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.data)
+
+    def __getitem__(self, name):
+        try:
+            value = self.data[name]
+        except KeyError:
+            return self.get_nested(name)
+        if isinstance(value, LazyBaggage):
+            self.compile(name, value)
+            value = self.data[name]
+        return value
+
+    def __setitem__(self, name, value):
+        self.data[name] = value
+
+    def __delitem__(self, name):
+        del self.data[name]
+
+    def __iter__(self):
+        self.compile_all()
+        return iter(list(self.data))
+
+    def __len__(self):
+        self.compile_all()
+        return len(self.data)
+
+    def update(self, other=(), **kwargs):
+        # Lazy baggage is copied from other locations as it is, not compiled.
+        if isinstance(other, Locations):
+            with other.lock:
+                other = dict(other.data)
+        super().update(other, **kwargs)
+
+    def get_nested(self, name):
+        parent = name
+        while self.separator in parent:
+            parent = parent.rsplit(self.separator, 1)[0]
+            value = self.data.get(parent)
+            if isinstance(value, LazyBaggage):
+                self.compile(parent, value)
+                if name in self.data:
+                    return self[name]
+        raise KeyError(name)
+
+    def compile(self, name, baggage):
+        """Replace the lazy `baggage` stored under `name` with its compiled locations."""
+        with self.lock:
+            if self.data.get(name) is baggage:
+                self.data.update(baggage.compile())
+
+    def compile_all(self):
+        for name, value in list(self.data.items()):
+            if isinstance(value, LazyBaggage):
+                self.compile(name, value)
+
+
+class MergedLocations(Mapping):
+    """The locations of a concept in several rulebooks, each looked up in its own rulebook's locations.
+
+    `owners` maps each location name to the locations it is found in, so a
+    rulebook's locations can be removed and added again without copying
+    the others'. Nested names are found through their parents, as in
+    `Locations`.
+    """
+
+    def __init__(self, separator="::"):
+        self.owners = {}
+        self.separator = separator
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, dict(self.items()))
+
+    @staticmethod
+    def get_names(locations):
+        # Lazy locations are named without being compiled; their nested names are found through their parents.
+        if isinstance(locations, Locations):
+            with locations.lock:
+                return list(locations.data)
+        return list(locations)
+
+    def copy(self):
+        merged = MergedLocations(separator=self.separator)
+        merged.owners = dict(self.owners)
+        return merged
+
+    def add(self, locations):
+        for name in self.get_names(locations):
+            self.owners[name] = locations
+
+    def remove(self, locations):
+        for name in self.get_names(locations):
+            if self.owners.get(name) is locations:
+                del self.owners[name]
+
+    def get_owner(self, name):
+        owner = self.owners.get(name)
+        parent = name
+        while owner is None and self.separator in parent:
+            parent = parent.rsplit(self.separator, 1)[0]
+            owner = self.owners.get(parent)
+        return owner
+
+    def __getitem__(self, name):
+        owner = self.get_owner(name)
+        if owner is None:
+            raise KeyError(name)
+        return owner[name]
+
+    def __iter__(self):
+        owners = {id(owner): owner for owner in self.owners.values()}
+        names = {}
+        for owner in owners.values():
+            for name in owner:
+                if self.get_owner(name) is owner:
+                    names[name] = None
+        return iter(names)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
 @attr.s(slots=True)
 class Text:
     text = attr.ib()
@@ -171,3 +488,12 @@ class VALUE:
 class Rule:
     name = attr.ib()
     predicates = attr.ib()
+
+
+def __getattr__(name):
+    # Only compiling rulebooks needs syml (and parsimonious with it), so its types are imported on demand.
+    if name in ("Pos", "Source"):
+        from syml import types as syml_types
+
+        return getattr(syml_types, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
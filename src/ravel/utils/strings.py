@@ -1,7 +1,4 @@
-from syml.utils import get_text_source  # noqa
-
-from .. import exceptions
-from ..types import Pos
+from .. import exceptions, types
 
 
 def get_coords_of_str_index(s, index):
@@ -13,9 +10,9 @@ def get_coords_of_str_index(s, index):
     curr_pos = 0
     for linenum, line in enumerate(lines):
         if curr_pos + len(line) > index:
-            return Pos(index, linenum + 1, index - curr_pos)
+            return types.Pos(index, linenum + 1, index - curr_pos)
         curr_pos += len(line)
-    return Pos(len(s), linenum + 1, 0)
+    return types.Pos(len(s), linenum + 1, 0)
 
 
 def get_line(s, line_number):
@@ -57,3 +54,11 @@ def strip_outer_whitespace(text):
 def unwrap(text):
     """Unwrap a hard-wrapped paragraph of text."""
     return " ".join(text.splitlines())
+
+
+def __getattr__(name):
+    if name == "get_text_source":
+        from syml.utils import get_text_source
+
+        return get_text_source
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -50,6 +50,7 @@ class VirtualMachine:
     signals: Signals = field(default=attr.Factory(Signals))
     begin_state: Begin = field(default=attr.Factory(Begin))
     queue: Deque[Callable] = field(default=attr.Factory(deque))
+    matches: Optional[queries.MatchNetwork] = field(default=None, repr=False)
 
     def enqueue(self, callable_action: Callable, *args, **kwargs):
         logger.debug(f"Enqueuing action {callable_action.__name__}: {args!r}, {kwargs!r}")
@@ -62,7 +63,7 @@ class VirtualMachine:
     def begin(self):
         logger.debug("Beginning...")
         self.enqueue(self.initialize_from_givens)
-        self.enqueue(self.push, self.begin_state())
+        self.enqueue(self.push, self.begin_state)
 
     def run(self):  # pragma: nocover
         self.begin()
@@ -73,16 +74,17 @@ class VirtualMachine:
         logger.debug("Applying operation: %r", op)
         quality = op.quality
         initial_value = self.qualities.get(quality)
-        new_value = op.evaluate(initial_value, qualities=self.qualities)
+        new_value = op.compile()(initial_value, qualities=self.qualities)
         self.qualities[quality] = new_value
         logger.debug(f"Quality [{quality}] was {initial_value!r}, now {new_value!r}")
-        self.send(
-            events.quality_changed(
-                quality=quality,
-                initial_value=initial_value,
-                new_value=new_value,
-            )
+        event = events.quality_changed(
+            quality=quality,
+            initial_value=initial_value,
+            new_value=new_value,
         )
+        if self.matches is not None:
+            self.matches.quality_changed(event)
+        self.send(event)
 
     def initialize_from_givens(self):
         logger.debug(f"Initializing from givens: {self.givens!r}")
@@ -132,6 +134,13 @@ class VirtualMachine:
         signal = getattr(self.signals, event.name)
         signal.send(event)
 
+    def query(self, concept, how_many=None):
+        """Query the rulebook for the rules of `concept` matching the current qualities."""
+        matches = self.matches
+        if matches is None or matches.qualities is not self.qualities or matches.rulebook is not self.rulebook:
+            self.matches = queries.MatchNetwork(self.rulebook, self.qualities)
+        return self.matches.query(concept, how_many)
+
     def get_situation(self, name):
         logger.debug("Getting situation %s", name)
         return queries.query_by_name(name, self.rulebook["Situation"])
@@ -2,7 +2,6 @@ import logging
 
 import attr
 
-from ravel import queries
 from ravel.utils.strings import get_text
 from ravel.vm import events
 
@@ -36,7 +35,7 @@ class Begin(State):
 @attr.s
 class DisplayPossibleSituations(State):
     def query_and_display(self, vm):
-        query = queries.query("Situation", vm.qualities.items(), vm.rulebook)
+        query = vm.query("Situation")
         vm.send(events.begin_display_choices())
         for n, (location, situation) in enumerate(query):
             vm.send(
@@ -0,0 +1,245 @@
+"""Watchers that tell loaders when rulebook files change.
+
+A watcher keeps a generation counter for every file it watches, bumped
+whenever the file changes, so checking whether a compiled rulebook is up to
+date is a dictionary lookup rather than a `stat`. On Linux the counters are
+bumped by inotify events; elsewhere a single thread stats every watched file
+in one batch each interval.
+"""
+import ctypes
+import ctypes.util
+import functools
+import os
+import select
+import struct
+import sys
+import threading
+
+import attr
+
+# From <sys/inotify.h>.
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# Anything that would change a file's contents or modification time.
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+DIRECTORY_GONE = IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED
+
+EVENT = struct.Struct("iIII")
+
+
+@attr.s(eq=False)
+class BaseWatcher:
+    """Keep a generation counter for each watched file.
+
+    Watchers start watching on first use and aren't pickled with their
+    loader: an unpickled watcher starts afresh.
+    """
+
+    generations = attr.ib(init=False, factory=dict, repr=False)
+    lock = attr.ib(init=False, factory=threading.Lock, repr=False)
+    stopped = attr.ib(init=False, factory=threading.Event, repr=False)
+    thread = attr.ib(init=False, default=None, repr=False)
+
+    def __getstate__(self):
+        return {field.name: getattr(self, field.name) for field in attr.fields(type(self)) if field.init}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_up_to_date_checker(self, path):
+        """Return a function telling whether `path` has changed since this call."""
+        path = self.watch(path)
+        generations = self.generations
+        generation = generations[path]
+
+        def is_up_to_date():
+            return generations[path] == generation
+
+        return is_up_to_date
+
+    def watch(self, path):
+        """Start watching `path`, returning the key of its generation."""
+        path = os.path.abspath(path)
+        with self.lock:
+            if path not in self.generations:
+                self.add(path)
+                self.generations[path] = 0
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=type(self).__name__, daemon=True)
+                self.thread.start()
+        return path
+
+    def get_paths(self):
+        with self.lock:
+            return list(self.generations)
+
+    def bump(self, paths):
+        with self.lock:
+            self.bump_locked(paths)
+
+    def bump_locked(self, paths):
+        for path in paths:
+            if path in self.generations:
+                self.generations[path] += 1
+
+    def add(self, path):
+        pass
+
+    def run(self):
+        raise NotImplementedError()
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+@attr.s(eq=False)
+class PollingWatcher(BaseWatcher):
+    """Stat every watched file once each `interval` seconds."""
+
+    interval = attr.ib(default=1.0)
+    signatures = attr.ib(init=False, factory=dict, repr=False)
+
+    @staticmethod
+    def get_signature(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def add(self, path):
+        self.signatures[path] = self.get_signature(path)
+
+    def poll(self):
+        """Stat the watched files, bumping the generation of those that changed."""
+        with self.lock:
+            signatures = list(self.signatures.items())
+        changed = {}
+        for path, signature in signatures:
+            current = self.get_signature(path)
+            if current != signature:
+                changed[path] = current
+        with self.lock:
+            self.signatures.update(changed)
+            self.bump_locked(changed)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.poll()
+
+
+@functools.lru_cache(maxsize=None)
+def get_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+@attr.s(eq=False)
+class InotifyWatcher(BaseWatcher):
+    """Watch the directories of the watched files with inotify."""
+
+    timeout = attr.ib(default=0.5)
+    fd = attr.ib(init=False, default=None, repr=False)
+    directories = attr.ib(init=False, factory=dict, repr=False)
+    watches = attr.ib(init=False, factory=dict, repr=False)
+
+    @staticmethod
+    def is_available():
+        return get_libc() is not None
+
+    def add(self, path):
+        directory = os.path.dirname(path)
+        if directory in self.directories:
+            return
+        libc = get_libc()
+        if self.fd is None:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            self.fd = fd
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "Can't watch %s" % directory)
+        self.directories[directory] = wd
+        self.watches[wd] = directory
+
+    def read_events(self):
+        """Read the pending events, bumping the generation of the files they concern."""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size : offset + EVENT.size + length].rstrip(b"\0")
+            offset += EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                changed.update(self.get_paths())
+                continue
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & DIRECTORY_GONE:
+                # Files will be watched again, in a new directory, when next loaded.
+                with self.lock:
+                    del self.watches[wd]
+                    self.directories.pop(directory, None)
+                changed.update(path for path in self.get_paths() if os.path.dirname(path) == directory)
+            elif name:
+                changed.add(os.path.join(directory, os.fsdecode(name)))
+        self.bump(changed)
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                readable, _, _ = select.select([self.fd], [], [], self.timeout)
+                if readable:
+                    self.read_events()
+        finally:
+            os.close(self.fd)
+
+    def watch(self, path):
+        path = super().watch(path)
+        if os.path.dirname(path) not in self.directories:
+            # The directory went away since the file was first watched.
+            with self.lock:
+                self.add(path)
+        return path
+
+
+def get_watcher():
+    """Return the best watcher for this platform."""
+    return InotifyWatcher() if InotifyWatcher.is_available() else PollingWatcher()
@@ -0,0 +1,93 @@
+import random
+
+import pytest
+
+from ravel import queries, types
+
+np = pytest.importorskip("numpy")
+
+from ravel import batch  # noqa: E402
+
+
+def predicate(quality, comparator, value):
+    return types.Predicate(quality, types.Comparison(quality, comparator, value))
+
+
+@pytest.fixture
+def ruleset():
+    rules = [
+        types.Rule("foyer", [predicate("Location", "=", "Foyer")]),
+        types.Rule("foyer-cloak", [predicate("Location", "=", "Foyer"), predicate("Wearing Cloak", ">=", 1)]),
+        types.Rule("bar", [predicate("Bar", ">", 1), predicate("Location", "==", "Bar")]),
+        types.Rule("not-bar", [predicate("Location", "!=", "Bar")]),
+        types.Rule("sums", [predicate("Bar", "<", types.Expression(1, "+", 1))]),
+        types.Rule("custom", [types.Predicate("Bar", lambda value: (value or 0) % 2 == 1)]),
+        types.Rule("words", [predicate("Name", ">", "M")]),
+    ]
+    rules.sort()
+    return {"rules": rules, "locations": {rule.name: types.Situation(rule.name, []) for rule in rules}}
+
+
+SESSIONS = [
+    {},
+    {"Location": "Foyer"},
+    {"Location": "Foyer", "Wearing Cloak": 1},
+    {"Location": "Bar", "Bar": 2},
+    {"Location": "Bar", "Bar": 3, "Name": "Zed"},
+    {"Location": "Cloakroom", "Bar": None, "Name": "Al"},
+    {"Location": "Nowhere", "Wearing Cloak": True, "Bar": 1.5},
+]
+
+
+class TestBatchQuery:
+    @pytest.mark.parametrize("how_many", [1, 2, 3, None])
+    def test_it_should_match_the_scalar_path(self, ruleset, how_many):
+        query = batch.BatchQuery.build(ruleset)
+        expected = [
+            list(queries.query("Test", qualities, {"Test": ruleset}, how_many=how_many)) for qualities in SESSIONS
+        ]
+        assert query.query(SESSIONS, how_many=how_many) == expected
+
+    def test_it_should_return_the_top_result_per_session(self, ruleset):
+        query = batch.BatchQuery.build(ruleset)
+        expected = [queries.query_top("Test", qualities, {"Test": ruleset}) for qualities in SESSIONS]
+        assert query.query_top(SESSIONS) == expected
+
+    def test_it_should_leave_unvectorizable_predicates_to_the_scalar_path(self, ruleset):
+        query = batch.BatchQuery.build(ruleset)
+        assert sorted(ruleset["rules"][position].name for position in query.residuals) == ["custom", "words"]
+        assert query.numeric_thresholds.shape == (len(ruleset["rules"]), 1)
+        assert query.symbol_thresholds.shape == (len(ruleset["rules"]), 1)
+
+    def test_it_should_encode_sessions(self, ruleset):
+        query = batch.BatchQuery.build(ruleset)
+        matrix = query.encode([{"Location": "Bar", "Bar": 2}, {"Location": 1}])
+        location = query.columns["Location"]
+        bar = query.columns["Bar"]
+        assert matrix.values[0, bar] == 2
+        assert np.isnan(matrix.values[0, location])
+        assert matrix.symbols[0, location] == query.strings["Bar"]
+        assert matrix.values[1, location] == 1
+        assert matrix.symbols[1, location] == -1
+
+    def test_it_should_evaluate_sessions_in_chunks(self, ruleset, monkeypatch):
+        monkeypatch.setattr(batch, "CHUNK_CELLS", 2)
+        query = batch.BatchQuery.build(ruleset)
+        expected = [queries.query_top("Test", qualities, {"Test": ruleset}) for qualities in SESSIONS]
+        assert query.query_top(SESSIONS) == expected
+
+    def test_it_should_match_the_scalar_path_on_the_cloak_of_darkness(self, cloak_env):
+        rulebook = cloak_env.load()["rulebook"]
+        query = batch.BatchQuery.build(rulebook["Situation"])
+        rng = random.Random(7)
+        sessions = [
+            {
+                "Location": rng.choice(["Intro", "Foyer", "Bar", "Cloakroom"]),
+                "Wearing Cloak": rng.randrange(2),
+                "Bar": rng.randrange(4),
+                "Fumbled": rng.randrange(2),
+            }
+            for _ in range(50)
+        ]
+        expected = [list(queries.query("Situation", qualities, rulebook, how_many=2)) for qualities in sessions]
+        assert query.query(sessions, how_many=2) == expected
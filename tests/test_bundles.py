@@ -0,0 +1,158 @@
+import asyncio
+import gc
+import subprocess
+import sys
+import tempfile
+from unittest.mock import patch
+
+import pytest
+from click.testing import CliRunner
+from path import Path
+
+from ravel import bundles, cli, environments, exceptions, loaders
+from ravel.vm.runners import QueueRunner
+
+
+@pytest.fixture
+def tempdir():
+    _tempdir = Path(tempfile.mkdtemp())
+    yield _tempdir
+    _tempdir.rmtree()
+
+
+@pytest.fixture
+def bundle_path(tempdir, cloak_env):
+    path = tempdir / "cloak.bundle"
+    bundles.write_bundle(path, cloak_env.load())
+    return path
+
+
+@pytest.fixture
+def bundle_env(bundle_path):
+    return environments.Environment(loader=loaders.BundleLoader(bundle_path))
+
+
+class TestBundle:
+    def test_it_should_hold_the_compiled_world(self, bundle_path, cloak_env):
+        expected = cloak_env.load()
+        bundle = bundles.Bundle(bundle_path)
+        rulebook = bundle.get_rulebook()
+        assert rulebook["metadata"] == expected["metadata"]
+        assert rulebook["givens"] == expected["givens"]
+        for concept, ruleset in expected["rulebook"].items():
+            assert rulebook["rulebook"][concept]["rules"] == ruleset["rules"]
+            assert dict(rulebook["rulebook"][concept]["locations"]) == ruleset["locations"]
+
+    def test_it_should_find_locations_in_its_string_table(self, bundle_path):
+        bundle = bundles.Bundle(bundle_path)
+        position = bundle.find("Situation", "foyer::foyer")
+        assert bundle.get_name(position) == b"Situation\0foyer::foyer"
+        assert bundle.find("Situation", "foyer::nowhere") is None
+        assert bundle.find("Nothing", "foyer::foyer") is None
+
+    def test_it_should_decode_only_its_head_when_opened(self, bundle_path):
+        bundle = bundles.Bundle(bundle_path)
+        assert bundle.rules is None
+        bundle.get_rulebook()
+        assert "Situation" in bundle.rules
+
+    def test_it_should_close_its_mapping(self, bundle_path):
+        with bundles.Bundle(bundle_path) as bundle:
+            locations = bundle.get_rulebook()["rulebook"]["Situation"]["locations"]
+        assert bundle.map.closed
+        with pytest.raises(exceptions.BundleError):
+            locations["foyer::foyer"]
+
+    def test_it_should_refuse_other_files(self, tempdir):
+        path = tempdir / "not.bundle"
+        path.write_bytes(b"\0" * 128)
+        with pytest.raises(exceptions.BundleError):
+            bundles.Bundle(path)
+
+    def test_it_should_refuse_bundles_from_other_versions(self, bundle_path):
+        with patch("ravel.bundles.get_ravel_version", return_value="0.0"):
+            with pytest.raises(exceptions.BundleError):
+                bundles.Bundle(bundle_path)
+
+    def test_it_should_write_bundles_atomically(self, tempdir, cloak_env):
+        rulebook = cloak_env.load()
+        with patch("os.replace", side_effect=OSError), pytest.raises(OSError):
+            bundles.write_bundle(tempdir / "cloak.bundle", rulebook)
+        assert tempdir.listdir() == []
+
+
+class TestBundleLoader:
+    def test_it_should_load_the_world_without_compiling(self, bundle_env, cloak_env):
+        expected = cloak_env.load()
+        with patch.object(environments.Environment, "compile_rulebook") as compile_rulebook:
+            rulebook = bundle_env.load()
+            compile_rulebook.assert_not_called()
+        assert rulebook["rulebook"]["Situation"]["rules"] == expected["rulebook"]["Situation"]["rules"]
+
+    def test_it_should_load_the_world_asynchronously(self, bundle_env):
+        rulebook = asyncio.run(bundle_env.load_async())
+        assert rulebook["rulebook"]["Situation"]["rules"] == bundle_env.load()["rulebook"]["Situation"]["rules"]
+
+    def test_it_should_decode_locations_as_they_are_looked_up(self, bundle_env):
+        locations = bundle_env.load()["rulebook"]["Situation"]["locations"]
+        assert locations.decoded == {}
+        situation = locations["foyer::foyer"]
+        assert locations["foyer::foyer"] is situation
+        assert list(locations.decoded) == ["foyer::foyer"]
+        with pytest.raises(KeyError):
+            locations["foyer::nowhere"]
+
+    def test_it_should_run_the_world(self, bundle_env, cloak_env):
+        results = []
+        for env in (bundle_env, cloak_env):
+            with QueueRunner(env) as runner:
+                events = [event for event in runner if event.name != "waiting_for_input"]
+                results.append((events, runner.choice_events))
+        assert results[0] == results[1]
+
+    def test_it_should_only_load_the_bundled_world(self, bundle_env):
+        bundle_env.initializing_name = "foyer"
+        with pytest.raises(exceptions.RulebookNotFound):
+            bundle_env.load()
+
+    def test_it_should_load_with_parallel_workers(self, bundle_env):
+        expected = bundle_env.load()
+        bundle_env.parallel_workers = 2
+        rulebook = bundle_env.load()
+        assert rulebook["rulebook"]["Situation"]["rules"] == expected["rulebook"]["Situation"]["rules"]
+
+    def test_it_should_refuse_options_for_compiling(self, bundle_path):
+        result = CliRunner().invoke(cli.main, ["run", str(bundle_path), "--jobs", "2"])
+        assert result.exit_code == 2
+        assert "--jobs can't be used with a bundle" in result.output
+
+    def test_it_should_reopen_a_changed_bundle(self, bundle_env, bundle_path, examples_path):
+        rulebook = bundle_env.load()["rulebook"]
+        simple_env = environments.Environment(loader=loaders.FileSystemLoader(base_path=examples_path / "simple"))
+        bundles.write_bundle(bundle_path, simple_env.load())
+        previous = bundle_env.loader.bundle
+        assert "rooms::rooms" in bundle_env.load()["rulebook"]["Situation"]["locations"]
+        assert bundle_env.loader.bundle is not previous
+
+        # Rulebooks loaded from the previous bundle keep working until they're dropped.
+        assert "foyer::foyer" in rulebook["Situation"]["locations"]
+        mapped = previous.map
+        assert not mapped.closed
+        del rulebook, previous
+        gc.collect()
+        assert mapped.closed
+
+    def test_it_should_not_import_the_compiler(self, bundle_path):
+        script = "\n".join(
+            [
+                "import sys",
+                "from ravel import environments, loaders",
+                "env = environments.Environment(loader=loaders.BundleLoader(%r))" % str(bundle_path),
+                "env.load()",
+                "print(' '.join(sorted(sys.modules)))",
+            ]
+        )
+        result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True)
+        modules = result.stdout.split()
+        assert "ravel.environments" in modules
+        assert not [module for module in modules if module.startswith(("parsimonious", "syml", "ravel.compiler"))]
@@ -0,0 +1,231 @@
+import tempfile
+from unittest.mock import Mock, patch
+
+import pytest
+from path import Path
+
+from ravel import caches, environments, loaders
+
+
+@pytest.fixture
+def tempdir():
+    _tempdir = Path(tempfile.mkdtemp())
+    yield _tempdir
+    _tempdir.rmtree()
+
+
+@pytest.fixture
+def disk_cache(tempdir):
+    return caches.DiskCache(tempdir / "cache")
+
+
+@pytest.fixture
+def cached_env(examples_path, disk_cache):
+    return environments.Environment(
+        loader=loaders.FileSystemLoader(base_path=examples_path / "cloak"),
+        disk_cache=disk_cache,
+    )
+
+
+class TestDiskCache:
+    def test_it_should_key_on_the_source_name_and_versions(self, disk_cache):
+        key = disk_cache.get_key("source", "name")
+        assert key == disk_cache.get_key("source", "name")
+        assert key != disk_cache.get_key("other source", "name")
+        assert key != disk_cache.get_key("source", "other")
+        assert key != disk_cache.get_key("source", "name", "/")
+        assert key != caches.DiskCache(disk_cache.path, version="0.0").get_key("source", "name")
+        assert key != caches.DiskCache(disk_cache.path, grammar_version="old").get_key("source", "name")
+
+    def test_it_should_store_and_retrieve_a_rulebook(self, disk_cache):
+        rulebook = {"rulebook": {}, "includes": ["foo"], "givens": [], "metadata": {}, "is_up_to_date": lambda: True}
+        disk_cache.put("key", rulebook)
+        assert disk_cache.get("key") == {"rulebook": {}, "includes": ["foo"], "givens": [], "metadata": {}}
+        assert [f.name for f in disk_cache.path.listdir()] == ["key.pickle"]
+
+    def test_it_should_miss_on_an_unknown_key(self, disk_cache):
+        assert disk_cache.get("key") is None
+
+    def test_it_should_discard_a_corrupted_entry(self, disk_cache):
+        disk_cache.put("key", {"rulebook": {}})
+        disk_cache.get_path("key").write_bytes(b"garbage")
+        assert disk_cache.get("key") is None
+        assert not disk_cache.get_path("key").exists()
+
+    def test_it_should_discard_an_entry_stored_under_another_key(self, disk_cache):
+        disk_cache.put("other", {"rulebook": {}})
+        disk_cache.get_path("other").rename(disk_cache.get_path("key"))
+        assert disk_cache.get("key") is None
+
+    def test_it_should_not_leave_partial_entries_behind(self, disk_cache):
+        with patch("pickle.dump", side_effect=RuntimeError), pytest.raises(RuntimeError):
+            disk_cache.put("key", {"rulebook": {}})
+        assert disk_cache.path.listdir() == []
+
+    def test_it_should_clear_all_entries(self, disk_cache):
+        disk_cache.put("key", {"rulebook": {}})
+        disk_cache.clear()
+        assert disk_cache.get("key") is None
+
+
+class TestEnvironmentDiskCache:
+    def test_it_should_load_unchanged_rulebooks_from_the_cache(self, cached_env, examples_path, disk_cache):
+        expected = cached_env.load()
+        assert len(disk_cache.path.listdir()) == 5
+
+        env = environments.Environment(
+            loader=loaders.FileSystemLoader(base_path=examples_path / "cloak"),
+            disk_cache=disk_cache,
+        )
+        with patch("ravel.readers.loads") as loads:
+            assert env.load() == expected
+            loads.assert_not_called()
+
+    def test_it_should_recompile_corrupted_entries(self, cached_env, disk_cache):
+        expected = cached_env.load()
+        for filepath in disk_cache.path.listdir():
+            filepath.write_bytes(b"\x80\x05garbage")
+        cached_env.cache.clear()
+        assert cached_env.load() == expected
+
+
+class TestCompileCache:
+    def test_it_should_compile_each_source_once(self):
+        cache = caches.CompileCache()
+        compile = Mock(side_effect=lambda source: object())
+        first = cache.get("predicate", "Foo > 1", compile)
+        assert cache.get("predicate", "  Foo > 1 ", compile) is first
+        assert cache.get("effect", "Foo > 1", compile) is not first
+        assert compile.call_count == 2
+        assert cache.stats() == {"size": 2, "hits": 1, "misses": 2, "hit_rate": 1 / 3, "evictions": 0}
+
+    def test_it_should_evict_the_least_recently_used_source(self):
+        cache = caches.CompileCache(maxsize=2)
+        compile = Mock(side_effect=lambda source: object())
+        cache.get("predicate", "A", compile)
+        cache.get("predicate", "B", compile)
+        cache.get("predicate", "A", compile)
+        cache.get("predicate", "C", compile)
+        assert [source for _, source in cache.entries] == ["A", "C"]
+        assert cache.stats()["evictions"] == 1
+
+    def test_it_should_not_cache_failures(self):
+        cache = caches.CompileCache()
+        with pytest.raises(ValueError):
+            cache.get("predicate", "Foo >", Mock(side_effect=ValueError))
+        assert cache.stats()["size"] == 0
+
+    def test_it_should_be_shared_across_an_environments_rulebooks(self, cached_env):
+        cached_env.load()
+        stats = cached_env.get_compile_cache_stats()
+        assert stats["hits"] > 0
+        assert stats["size"] == stats["misses"] - stats["evictions"]
+
+
+class TestRulebookCache:
+    def test_it_should_evict_the_least_recently_used_entry(self):
+        cache = caches.RulebookCache(max_entries=2)
+        cache["a"] = {}
+        cache["b"] = {}
+        cache["a"]
+        cache["c"] = {}
+        assert list(cache) == ["a", "c"]
+        assert cache.stats()["evictions"] == 1
+
+    def test_it_should_evict_the_least_frequently_used_entry(self):
+        cache = caches.RulebookCache(max_entries=2, policy="lfu")
+        cache["a"] = {}
+        cache["b"] = {}
+        cache["a"]
+        cache["b"]
+        cache["a"]
+        cache["c"] = {}
+        assert set(cache) == {"a", "c"}
+
+    def test_it_should_bound_the_approximate_size(self):
+        cache = caches.RulebookCache(max_bytes=100, sizer=lambda value: value["size"])
+        cache["a"] = {"size": 60}
+        cache["b"] = {"size": 60}
+        assert list(cache) == ["b"]
+        assert cache.stats()["bytes"] == 60
+
+    def test_it_should_count_entries_sharing_a_rulebook_once(self):
+        cache = caches.RulebookCache(max_entries=1, max_bytes=100, sizer=lambda value: 60)
+        rulebook = {"rulebook": {}}
+        cache["a"] = rulebook
+        cache["content"] = {**rulebook, "is_up_to_date": None}
+        assert set(cache) == {"a", "content"}
+        assert cache.stats()["bytes"] == 60
+
+    def test_it_should_never_evict_pinned_entries(self):
+        cache = caches.RulebookCache(max_entries=1)
+        cache["a"] = {}
+        cache.pin(["a"])
+        cache["b"] = {}
+        cache["c"] = {}
+        assert list(cache) == ["a", "c"]
+        cache.unpin(["a"])
+        assert list(cache) == ["c"]
+
+    def test_it_should_count_hits_misses_and_recompiles(self):
+        cache = caches.RulebookCache()
+        assert cache.get("a") is None
+        cache["a"] = {}
+        cache["a"]
+        cache["a"] = {}
+        stats = cache.stats()
+        assert (stats["hits"], stats["misses"], stats["recompiles"]) == (1, 1, 1)
+
+    def test_it_should_measure_compiled_rulebooks(self, cached_env):
+        rulebook = cached_env.get_rulebook("foyer")
+        assert caches.get_size(rulebook) > caches.get_size(rulebook["rulebook"]["Situation"]["rules"])
+
+
+class TestEnvironmentRulebookCache:
+    def test_it_should_wrap_a_plain_mapping(self, examples_path):
+        env = environments.Environment(
+            loader=loaders.FileSystemLoader(base_path=examples_path / "cloak"),
+            cache={},
+        )
+        assert isinstance(env.cache, caches.RulebookCache)
+        env.load()
+        env.load()
+        assert env.get_rulebook_cache_stats()["hits"] == 5
+
+    def test_it_should_reject_anything_else(self):
+        with pytest.raises(TypeError, match="RulebookCache or a mapping"):
+            environments.Environment(cache=[])
+
+    def test_it_should_pin_the_loaded_story(self, examples_path):
+        env = environments.Environment(
+            loader=loaders.FileSystemLoader(base_path=examples_path / "cloak"),
+            cache=caches.RulebookCache(max_entries=1),
+        )
+        env.load()
+        assert set(env.cache) == {"begin", "foyer", "bar-dark", "bar-light", "cloakroom"}
+        env.initializing_name = "foyer"
+        env.load()
+        assert set(env.cache) == {"foyer", "bar-dark", "bar-light", "cloakroom"}
+
+    def test_it_should_report_the_counters(self, cached_env):
+        cached_env.load()
+        cached_env.cache["foyer"]["is_up_to_date"] = lambda: False
+        cached_env.load()
+        stats = cached_env.get_rulebook_cache_stats()
+        assert stats["recompiles"] == 1
+        # Looking `foyer` up above is a hit; the stale lookup of it while loading is a miss.
+        assert (stats["hits"], stats["misses"]) == (5, 6)
+        assert stats["pinned"] == 5
+
+    def test_it_should_count_shared_rulebooks_once(self, examples_path):
+        sizes = []
+        for fingerprint in (False, True):
+            env = environments.Environment(
+                loader=loaders.FileSystemLoader(base_path=examples_path / "cloak", fingerprint=fingerprint),
+                cache=caches.RulebookCache(max_bytes=10**9),
+            )
+            env.load()
+            sizes.append(env.get_rulebook_cache_stats())
+        assert sizes[1]["keys"] == 10
+        assert sizes[1]["size"] == sizes[0]["size"] == 5
+        assert sizes[1]["bytes"] < sizes[0]["bytes"] * 1.1
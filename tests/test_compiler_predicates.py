@@ -7,6 +7,11 @@ from .helpers import source
 
 
 class TestCompilePredicate:
+    def test_it_should_share_identical_predicates(self, env):
+        predicate = compile_predicate(env, source('"foo" == 9'))
+        assert compile_predicate(env, source(' "foo" == 9')) is predicate
+        assert compile_predicate(env, source('"foo" == 10')) is not predicate
+
     def test_it_should_produce_a_predicate_function_for_exact_match_with_integer(
         self, env
     ):
@@ -59,6 +64,14 @@ class TestCompilePredicate:
         expected = types.Predicate("foo", types.Comparison("foo", "!=", 9))
         assert predicate == expected
 
+    def test_it_should_work_out_its_truth_for_a_missing_quality(self, env):
+        assert compile_predicate(env, source('"foo" < 9')).holds_when_missing() is True
+        assert compile_predicate(env, source('"foo" > 9')).holds_when_missing() is False
+
+    def test_it_should_not_evaluate_the_predicate_while_compiling(self, env):
+        predicate = compile_predicate(env, source('"foo" > 1 / 0'))
+        assert predicate.holds_when_missing() is False
+
     def test_it_should_raise_on_bad_syntax(self, env):
         with pytest.raises(exceptions.ComparisonParseError):
             compile_predicate(env, source('"foo" !='))
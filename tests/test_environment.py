@@ -1,8 +1,42 @@
+import asyncio
+import os
+import pickle
+import tempfile
+import threading
+import time
 from unittest.mock import patch
 
 import pytest
+from path import Path
 
-from ravel import environments, loaders
+from ravel import environments, loaders, queries, types
+from ravel.vm import machines
+
+BEGIN_RULES = """include:
+  - other
+
+intro:
+  - Hello.
+"""
+
+OTHER_RULES = """rooms:
+  - when:
+    - Count >= 10
+  - Rooms.
+
+hall:
+  - when:
+    - Count >= 30
+  - A hall.
+"""
+
+QUALITIES = [
+    {},
+    {"Location": "Foyer"},
+    {"Location": "Bar", "Wearing Cloak": 1},
+    {"Location": "Bar", "Wearing Cloak": 0, "Bar": 2},
+    {"Location": "Cloakroom", "Wearing Cloak": 1, "Fumbled": 1},
+]
 
 
 @pytest.fixture
@@ -34,6 +68,341 @@ class TestGetRulebook:
         assert new_rulebook == rulebook
 
 
+@pytest.fixture
+def story_path():
+    _tempdir = Path(tempfile.mkdtemp())
+    (_tempdir / "begin.ravel").write_text(BEGIN_RULES)
+    (_tempdir / "other.ravel").write_text(OTHER_RULES)
+    yield _tempdir
+    _tempdir.rmtree()
+
+
+class TestIncrementalMerge:
+    def test_it_should_reuse_the_rulesets_when_nothing_changed(self, cloak_env):
+        rulebook = cloak_env.load()["rulebook"]
+        new_rulebook = cloak_env.load()["rulebook"]
+        assert all(new_rulebook[concept] is ruleset for concept, ruleset in rulebook.items())
+
+    def test_it_should_remerge_only_the_concepts_a_changed_rulebook_touches(self, cloak_env):
+        rulebook = cloak_env.load()["rulebook"]
+        rulebook["Other"] = cloak_env.merged["rulebook"]["Other"] = {"rules": [], "locations": {}}
+        cloak_env.cache["foyer"]["is_up_to_date"] = lambda: False
+
+        new_rulebook = cloak_env.load()["rulebook"]
+        foyer_rules = cloak_env.cache["foyer"]["rulebook"]["Situation"]["rules"]
+        assert {id(rule) for rule in foyer_rules} <= {id(rule) for rule in new_rulebook["Situation"]["rules"]}
+        assert new_rulebook["Other"] is rulebook["Other"]
+
+    @pytest.mark.parametrize("query_engine", ["linear", "indexed", "dag"])
+    def test_it_should_merge_like_a_full_rebuild(self, examples_path, query_engine):
+        def get_env():
+            return environments.Environment(
+                loader=loaders.FileSystemLoader(base_path=examples_path / "cloak"),
+                query_engine=query_engine,
+            )
+
+        env = get_env()
+        env.load()
+        env.cache["foyer"]["is_up_to_date"] = lambda: False
+        env.cache["bar-dark"]["is_up_to_date"] = lambda: False
+        rulebook = env.load()
+        expected = get_env().load()
+        assert rulebook["metadata"] == expected["metadata"]
+        assert rulebook["givens"] == expected["givens"]
+        assert set(rulebook["rulebook"]) == set(expected["rulebook"])
+        for concept, ruleset in expected["rulebook"].items():
+            assert rulebook["rulebook"][concept]["rules"] == ruleset["rules"]
+            assert dict(rulebook["rulebook"][concept]["locations"].items()) == dict(ruleset["locations"].items())
+            for qualities in QUALITIES:
+                assert list(queries.query(concept, qualities, rulebook["rulebook"])) == list(
+                    queries.query(concept, qualities, expected["rulebook"])
+                )
+
+    def test_it_should_not_rebuild_untouched_rules_or_the_index(self, cloak_env):
+        situation = cloak_env.load()["rulebook"]["Situation"]
+        index = situation["index"]
+        untouched = [id(rule) for rule in situation["rules"] if not rule.name.startswith("foyer::")]
+        cloak_env.cache["foyer"]["is_up_to_date"] = lambda: False
+
+        with patch.object(queries.RulesetIndex, "build") as build, patch.object(queries.PresenceFilter, "build"):
+            new_situation = cloak_env.load()["rulebook"]["Situation"]
+            build.assert_not_called()
+        assert [id(rule) for rule in new_situation["rules"] if not rule.name.startswith("foyer::")] == untouched
+        assert new_situation["index"].removed == len(cloak_env.cache["foyer"]["rulebook"]["Situation"]["rules"])
+        assert index.removed == 0
+
+    def test_it_should_leave_the_previously_loaded_rulebook_alone(self, story_path):
+        env = environments.Environment(loader=loaders.FileSystemLoader(base_path=story_path))
+        rulebook = env.load()["rulebook"]
+        rules = list(rulebook["Situation"]["rules"])
+        vm = machines.VirtualMachine(rulebook=rulebook, qualities={"Count": 20})
+        expected = list(vm.query("Situation"))
+
+        (story_path / "other.ravel").write_text(OTHER_RULES.split("\n\n", 1)[1])
+        env.cache["other"]["is_up_to_date"] = lambda: False
+        new_rulebook = env.load()["rulebook"]
+        assert [name for name, _ in queries.query("Situation", {"Count": 20}, new_rulebook)] == ["begin::intro"]
+        assert rulebook["Situation"]["rules"] == rules
+        assert list(vm.query("Situation")) == expected
+        assert list(queries.query("Situation", {"Count": 20}, rulebook)) == expected
+
+    @pytest.mark.parametrize("query_engine", ["linear", "indexed", "dag"])
+    def test_it_should_check_the_predicates_of_an_edited_rule(self, story_path, query_engine):
+        env = environments.Environment(
+            loader=loaders.FileSystemLoader(base_path=story_path),
+            query_engine=query_engine,
+        )
+        rulebook = env.load()["rulebook"]
+        assert [name for name, _ in queries.query("Situation", {"Count": 5}, rulebook)] == ["begin::intro"]
+        assert [name for name, _ in queries.query("Situation", {"Count": 20}, rulebook)] == [
+            "other::rooms",
+            "begin::intro",
+        ]
+
+        (story_path / "other.ravel").write_text(OTHER_RULES.replace("Count >= 10", "Count >= 1"))
+        env.cache["other"]["is_up_to_date"] = lambda: False
+        rulebook = env.load()["rulebook"]
+        expected = environments.Environment(loader=loaders.FileSystemLoader(base_path=story_path)).load()["rulebook"]
+        for count in [0, 5, 20]:
+            results = [name for name, _ in queries.query("Situation", {"Count": count}, rulebook)]
+            assert results == [name for name, _ in queries.query("Situation", {"Count": count}, expected)]
+        assert "other::rooms" in [name for name, _ in queries.query("Situation", {"Count": 5}, rulebook)]
+
+    def test_it_should_rebuild_everything_when_the_includes_change(self, cloak_env):
+        rulebook = cloak_env.load()["rulebook"]
+        cloak_env.cache["begin"] = dict(cloak_env.cache["begin"], includes=[])
+        new_rulebook = cloak_env.load()["rulebook"]
+        assert new_rulebook["Situation"] is not rulebook["Situation"]
+        begin_locations = cloak_env.cache["begin"]["rulebook"]["Situation"]["locations"]
+        assert set(new_rulebook["Situation"]["locations"]) == set(begin_locations)
+
+
+class TestLazySituations:
+    @pytest.fixture
+    def lazy_env(self, examples_path):
+        return environments.Environment(
+            loader=loaders.FileSystemLoader(base_path=examples_path / "cloak"),
+            lazy_situations=True,
+        )
+
+    def test_it_should_put_off_compiling_situations(self, lazy_env):
+        lazy_env.load()
+        for rulebook in lazy_env.merged["rulebooks"].values():
+            locations = rulebook["rulebook"]["Situation"]["locations"].data
+            assert all(isinstance(location, types.LazyBaggage) for location in locations.values())
+        assert "begin::intro::press-onward" not in lazy_env.cache["begin"]["rulebook"]["Situation"]["locations"].data
+
+    def test_it_should_compile_situations_like_the_eager_mode(self, lazy_env, cloak_env):
+        locations = lazy_env.load()["rulebook"]["Situation"]["locations"]
+        expected = cloak_env.load()["rulebook"]["Situation"]["locations"]
+        assert locations["begin::intro::press-onward"] == expected["begin::intro::press-onward"]
+        assert {name: locations[name] for name in expected} == expected
+
+    def test_it_should_compile_each_situation_once(self, lazy_env):
+        locations = lazy_env.load()["rulebook"]["Situation"]["locations"]
+        assert locations["foyer::foyer"] is locations["foyer::foyer"]
+        foyer_locations = lazy_env.cache["foyer"]["rulebook"]["Situation"]["locations"]
+        assert isinstance(foyer_locations.data["foyer::foyer"], types.Situation)
+
+    def test_it_should_resolve_nested_locations_when_iterating(self, lazy_env, cloak_env):
+        locations = lazy_env.load()["rulebook"]["Situation"]["locations"]
+        expected = cloak_env.load()["rulebook"]["Situation"]["locations"]
+        assert "begin::intro::press-onward" in locations
+        assert set(locations) == set(expected)
+        assert dict(locations.items()) == dict(expected.items())
+        assert not any(isinstance(location, types.LazyBaggage) for location in locations.values())
+
+    def test_it_should_pickle_lazy_situations(self, lazy_env):
+        rulebook = lazy_env.load()["rulebook"]
+        restored = pickle.loads(pickle.dumps(rulebook))
+        assert restored["Situation"]["locations"]["begin::intro"] == rulebook["Situation"]["locations"]["begin::intro"]
+
+    def test_it_should_not_keep_the_environment(self, lazy_env):
+        lazy_env.load()
+        lazy = lazy_env.cache["foyer"]["rulebook"]["Situation"]["locations"].data["foyer::foyer"]
+        assert lazy.settings == environments.CompileSettings("::", lazy_env.compile_cache)
+        restored = pickle.loads(pickle.dumps(lazy))
+        assert restored.settings.location_separator == "::"
+        assert restored.settings.compile_cache is not lazy_env.compile_cache
+        assert b"FileSystemLoader" not in pickle.dumps(lazy)
+
+
+class TestParallelLoad:
+    @pytest.fixture
+    def parallel_env(self, examples_path):
+        return environments.Environment(
+            loader=loaders.FileSystemLoader(base_path=examples_path / "cloak"),
+            parallel_workers=2,
+        )
+
+    def test_it_should_load_the_same_rulebooks_in_the_same_order(self, cloak_env, parallel_env):
+        assert list(parallel_env.get_rulebooks_in_parallel("begin")) == list(cloak_env.get_rulebooks("begin"))
+        assert parallel_env.load() == cloak_env.load()
+
+    def test_it_should_check_freshness_in_the_parent(self, parallel_env):
+        parallel_env.load()
+        assert all(rulebook["is_up_to_date"]() for rulebook in parallel_env.cache.values())
+
+    def test_it_should_not_recompile_up_to_date_rulebooks(self, parallel_env):
+        parallel_env.load()
+        with patch.object(parallel_env.loader, "get_source") as get_source:
+            parallel_env.load()
+            get_source.assert_not_called()
+
+
+class TestLoadAsync:
+    def test_it_should_load_the_same_rulebook_as_load(self, cloak_env, examples_path):
+        async_env = environments.Environment(loader=loaders.FileSystemLoader(base_path=examples_path / "cloak"))
+        assert asyncio.run(async_env.load_async()) == cloak_env.load()
+        loaded_rulebooks = asyncio.run(async_env.get_rulebooks_async("begin"))
+        assert list(loaded_rulebooks) == list(cloak_env.get_rulebooks("begin"))
+
+    def test_it_should_fetch_each_wave_of_includes_concurrently(self, cloak_env):
+        get_source = cloak_env.loader.get_source
+        fetching = []
+        most_fetching = []
+
+        async def get_source_async(environment, name):
+            fetching.append(name)
+            most_fetching.append(len(fetching))
+            await asyncio.sleep(0.01)
+            fetching.remove(name)
+            return get_source(environment, name)
+
+        with patch.object(cloak_env.loader, "get_source_async", get_source_async):
+            asyncio.run(cloak_env.load_async())
+        assert max(most_fetching) > 1
+
+    def test_it_should_not_recompile_up_to_date_rulebooks(self, cloak_env):
+        asyncio.run(cloak_env.load_async())
+        with patch.object(cloak_env.loader, "get_source") as get_source:
+            asyncio.run(cloak_env.load_async())
+            get_source.assert_not_called()
+
+    def test_it_should_check_freshness_and_assemble_off_the_event_loop(self, cloak_env):
+        asyncio.run(cloak_env.load_async())
+        on_the_loop = []
+
+        def is_up_to_date():
+            on_the_loop.append(threading.current_thread() is threading.main_thread())
+            return True
+
+        for rulebook in cloak_env.cache.values():
+            rulebook["is_up_to_date"] = is_up_to_date
+        assemble_rulebook = cloak_env.assemble_rulebook
+
+        def assemble_in_thread(name, loaded_rulebooks):
+            on_the_loop.append(threading.current_thread() is threading.main_thread())
+            return assemble_rulebook(name, loaded_rulebooks)
+
+        with patch.object(cloak_env, "assemble_rulebook", assemble_in_thread):
+            asyncio.run(cloak_env.load_async())
+        assert len(on_the_loop) == 6
+        assert not any(on_the_loop)
+
+    def test_it_should_compile_one_file_at_a_time_in_threads(self, cloak_env):
+        build_rulebook = cloak_env.build_rulebook
+        building = []
+        most_building = []
+
+        def slow_build_rulebook(source, name=""):
+            building.append(name)
+            most_building.append(len(building))
+            time.sleep(0.01)
+            building.remove(name)
+            return build_rulebook(source, name)
+
+        with patch.object(cloak_env, "build_rulebook", slow_build_rulebook):
+            assert asyncio.run(cloak_env.load_async()) == cloak_env.load()
+        assert most_building and max(most_building) == 1
+
+    def test_it_should_compile_in_worker_processes(self, cloak_env, examples_path):
+        parallel_env = environments.Environment(
+            loader=loaders.FileSystemLoader(base_path=examples_path / "cloak"),
+            parallel_workers=2,
+        )
+        assert asyncio.run(parallel_env.load_async()) == cloak_env.load()
+        assert all(rulebook["is_up_to_date"]() for rulebook in parallel_env.cache.values())
+
+
+class TestContentFingerprints:
+    @pytest.fixture
+    def story_path(self, examples_path):
+        _tempdir = Path(tempfile.mkdtemp())
+        (examples_path / "simple").copytree(_tempdir / "v1")
+        (examples_path / "simple").copytree(_tempdir / "v2")
+        yield _tempdir
+        _tempdir.rmtree()
+
+    @pytest.fixture
+    def fingerprint_env(self, story_path):
+        return environments.Environment(
+            loader=loaders.FileSystemLoader(base_path=story_path / "v1", fingerprint=True),
+        )
+
+    def test_it_should_not_recompile_touched_rulebooks(self, fingerprint_env, story_path):
+        rulebook = fingerprint_env.load()["rulebook"]
+        os.utime(story_path / "v1" / "rooms.ravel", ns=(0, 0))
+        assert fingerprint_env.load()["rulebook"] == rulebook
+        assert fingerprint_env.get_rulebook("rooms") is fingerprint_env.cache["rooms"]
+        assert fingerprint_env.cache["rooms"]["is_up_to_date"]()
+
+    def test_it_should_recompile_edits_that_keep_the_timestamp(self, fingerprint_env, story_path):
+        fingerprint_env.load()
+        filepath = story_path / "v1" / "rooms.ravel"
+        stat = filepath.stat()
+        filepath.write_text(filepath.read_text().replace("rooms", "rooms "))
+        os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        assert not fingerprint_env.cache["rooms"]["is_up_to_date"]()
+
+    def test_it_should_share_rulebooks_with_the_same_content(self, fingerprint_env, story_path):
+        fingerprint_env.load()
+        first = fingerprint_env.cache["rooms"]
+        # Another version of the story, with only the compiled content to go on.
+        for name in [key for key in fingerprint_env.cache if isinstance(key, str)]:
+            del fingerprint_env.cache[name]
+        fingerprint_env.loader = loaders.FileSystemLoader(base_path=story_path / "v2", fingerprint=True)
+        with patch("ravel.compiler.rulebooks.compile_rulebook") as compile_rulebook:
+            fingerprint_env.load()
+            compile_rulebook.assert_not_called()
+        second = fingerprint_env.cache["rooms"]
+        assert second["rulebook"] is first["rulebook"]
+        assert second["is_up_to_date"].path == story_path / "v2" / "rooms.ravel"
+
+    def test_it_should_share_rulebooks_when_loading_in_parallel(self, fingerprint_env):
+        fingerprint_env.load()
+        first = fingerprint_env.cache["rooms"]
+        del fingerprint_env.cache["rooms"]
+        fingerprint_env.parallel_workers = 2
+        fingerprint_env.load()
+        assert fingerprint_env.cache["rooms"]["rulebook"] is first["rulebook"]
+
+
+class TestQueryCaches:
+    def test_it_should_cache_queries_on_each_loaded_concept(self, env):
+        rulebook = env.load()["rulebook"]
+        list(queries.query("Situation", {}, rulebook))
+        list(queries.query("Situation", {"Unread": 1}, rulebook))
+        assert env.get_query_cache_stats()["Situation"]["hits"] == 1
+
+    def test_it_should_invalidate_the_caches_on_reload(self, env):
+        rulebook = env.load()["rulebook"]
+        list(queries.query("Situation", {}, rulebook))
+        old_cache = rulebook["Situation"]["cache"]
+
+        env.cache.clear()
+        new_rulebook = env.load()["rulebook"]
+        assert old_cache.stats()["size"] == 0
+        assert new_rulebook["Situation"]["cache"] is not old_cache
+        assert env.get_query_cache_stats()["Situation"]["misses"] == 0
+
+    def test_it_should_not_cache_when_disabled(self, env):
+        env.query_cache_size = 0
+        rulebook = env.load()["rulebook"]
+        assert "cache" not in rulebook["Situation"]
+        assert env.get_query_cache_stats() == {}
+
+
 class TestDefaultIsUpToDate:
     def test_it_should_return_true(self, env):
         assert env.default_is_up_to_date() is True
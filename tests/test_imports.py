@@ -0,0 +1,75 @@
+import subprocess
+import sys
+
+# Microseconds `python -X importtime` may report for importing the runners: the time spent in
+# ravel's own modules, and the cumulative time. Both are about three times what they take now,
+# and the best of a few runs is compared, so that a busy machine doesn't fail the test. Which
+# modules get imported is checked exactly below.
+OWN_IMPORT_BUDGET = 250_000
+IMPORT_BUDGET = 600_000
+IMPORT_RUNS = 3
+
+# Only needed to compile rulebooks, never to run compiled ones.
+COMPILE_TIME_MODULES = {"parsimonious", "slugify", "syml", "ravel.compiler", "ravel.parsers", "concurrent.futures"}
+
+# Slow to import, and only needed by some loaders, caches or commands.
+HEAVY_MODULES = {"asyncio", "importlib.metadata", "zipfile", "pdb"}
+
+
+def get_imported_modules(module):
+    """Return the name of every module in `sys.modules` after `import module`, in a fresh interpreter."""
+    result = subprocess.run(
+        [sys.executable, "-c", "import sys, %s; print('\\n'.join(sys.modules))" % module],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.split()
+
+
+def get_import_times(module):
+    """Return the self and cumulative microseconds of every module imported by `import module`."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import %s" % module],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        own, cumulative, name = line[len("import time:") :].split("|")
+        if own.strip().isdigit():
+            times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+
+def get_best_import_times(module):
+    """Return the least time spent in ravel's modules, and the least cumulative time, of a few imports."""
+    runs = [get_import_times(module) for _ in range(IMPORT_RUNS)]
+    own = min(sum(own for name, (own, _) in times.items() if name.split(".")[0] == "ravel") for times in runs)
+    return own, min(times[module][1] for times in runs)
+
+
+def get_matching_modules(modules, names):
+    prefixes = tuple(name + "." for name in names)
+    return [module for module in modules if module in names or module.startswith(prefixes)]
+
+
+class TestImports:
+    def test_the_runners_should_not_import_the_compiler(self):
+        modules = get_imported_modules("ravel.vm.runners")
+        assert "ravel.vm.runners" in modules
+        assert get_matching_modules(modules, COMPILE_TIME_MODULES) == []
+
+    def test_the_runners_should_import_within_budget(self):
+        own, cumulative = get_best_import_times("ravel.vm.runners")
+        assert own < OWN_IMPORT_BUDGET
+        assert cumulative < IMPORT_BUDGET
+
+    def test_the_runners_should_not_import_heavy_modules(self):
+        assert get_matching_modules(get_imported_modules("ravel.vm.runners"), HEAVY_MODULES) == []
+
+    def test_the_loaders_should_not_import_the_compiler(self):
+        assert get_matching_modules(get_imported_modules("ravel.loaders"), COMPILE_TIME_MODULES) == []
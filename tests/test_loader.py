@@ -1,10 +1,17 @@
+import asyncio
+import os
+import pickle
 import tempfile
+import threading
+import time
+import zipfile
 from unittest.mock import Mock, patch
 
 import pytest
+from click.testing import CliRunner
 from path import Path
 
-from ravel import exceptions, loaders
+from ravel import cli, environments, exceptions, loaders
 
 
 @pytest.fixture
@@ -60,6 +67,12 @@ class TestGetSource:
 
         assert is_up_to_date() is False
 
+    def test_it_should_get_the_source_asynchronously(self, tempdir, fs_loader):
+        (tempdir / "test.ravel").write_text("test!")
+        source, is_up_to_date = asyncio.run(fs_loader.get_source_async(Mock(), "test"))
+        assert source == "test!"
+        assert is_up_to_date() is True
+
     def test_it_should_raise_when_getting_source_of_nonexistent_rulebook(
         self, tempdir, fs_loader
     ):
@@ -68,6 +81,45 @@ class TestGetSource:
             fs_loader.get_source(env, "foo")
 
 
+class TestFingerprintedSource:
+    def test_it_should_check_the_content_rather_than_the_timestamp(self, tempdir):
+        fs_loader = loaders.FileSystemLoader(base_path=tempdir, fingerprint=True)
+        fp = tempdir / "test.ravel"
+        fp.write_text("test!")
+        source, is_up_to_date = fs_loader.get_source(Mock(), "test")
+        assert source == "test!"
+
+        fp.write_text("test!")
+        fp.utime((0, 0))
+        assert is_up_to_date() is True
+
+        fp.write_text("best!")
+        fp.utime((0, 0))
+        assert is_up_to_date() is False
+
+    def test_it_should_only_hash_again_when_the_file_is_touched(self, tempdir):
+        fs_loader = loaders.FileSystemLoader(base_path=tempdir, fingerprint=True)
+        fp = tempdir / "test.ravel"
+        fp.write_text("test!")
+        _, is_up_to_date = fs_loader.get_source(Mock(), "test")
+        with patch("ravel.caches.get_fingerprint") as get_fingerprint:
+            assert is_up_to_date() is True
+            get_fingerprint.assert_not_called()
+
+        fp.touch()
+        assert is_up_to_date() is True
+        with patch("ravel.caches.get_fingerprint") as get_fingerprint:
+            assert is_up_to_date() is True
+            get_fingerprint.assert_not_called()
+
+    def test_it_should_fail_for_removed_files(self, tempdir):
+        fs_loader = loaders.FileSystemLoader(base_path=tempdir, fingerprint=True)
+        (tempdir / "test.ravel").write_text("test!")
+        _, is_up_to_date = fs_loader.get_source(Mock(), "test")
+        (tempdir / "test.ravel").remove()
+        assert is_up_to_date() is False
+
+
 class TestLoad:
     def test_it_should_load_and_compile_a_rulebook(self, tempdir, fs_loader):
         env = Mock()
@@ -80,3 +132,75 @@ class TestLoad:
         assert result == "compiled"
 
         env.compile_rulebook.assert_called_once_with("test!", "test", checker)
+
+
+class TestZipLoader:
+    @pytest.fixture
+    def archive_path(self, tempdir, examples_path):
+        path = tempdir / "cloak.zip"
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            for filepath in (examples_path / "cloak").files("*.ravel"):
+                archive.write(filepath, "story/" + filepath.name)
+            archive.writestr("story/notes.txt", "Not a rulebook.")
+        return path
+
+    @pytest.fixture
+    def zip_loader(self, archive_path):
+        return loaders.ZipLoader(archive_path, base_path="story")
+
+    def test_it_should_load_the_same_world_as_the_directory(self, zip_loader, cloak_env):
+        env = environments.Environment(loader=zip_loader)
+        assert env.load() == cloak_env.load()
+
+    def test_it_should_index_the_archive_once(self, zip_loader):
+        with patch("zipfile.ZipFile", wraps=zipfile.ZipFile) as zip_file:
+            zip_loader.get_source(Mock(), "begin")
+            zip_loader.get_source(Mock(), "foyer")
+            assert zip_file.call_count == 1
+        assert set(zip_loader.index) == {"begin", "rooms", "foyer", "bar-dark", "bar-light", "cloakroom"}
+
+    def test_it_should_raise_for_missing_rulebooks(self, zip_loader):
+        with pytest.raises(exceptions.RulebookNotFound):
+            zip_loader.get_source(Mock(), "notes")
+
+    def test_it_should_be_out_of_date_when_the_archive_changes(self, zip_loader, archive_path):
+        source, is_up_to_date = zip_loader.get_source(Mock(), "begin")
+        assert is_up_to_date() is True
+
+        with zipfile.ZipFile(archive_path, "w") as archive:
+            archive.writestr("story/begin.ravel", "changed")
+        assert is_up_to_date() is False
+        assert zip_loader.get_source(Mock(), "begin")[0] == "changed"
+
+    def test_it_should_pickle_without_the_open_archive(self, zip_loader):
+        zip_loader.get_source(Mock(), "begin")
+        restored = pickle.loads(pickle.dumps(zip_loader))
+        assert restored.archive is None
+        assert restored.get_source(Mock(), "begin")[0] == zip_loader.get_source(Mock(), "begin")[0]
+
+    def test_it_should_not_close_the_archive_while_it_is_read(self, zip_loader, archive_path):
+        zip_loader.get_source(Mock(), "begin")
+        reading = threading.Event()
+        read = zip_loader.archive.read
+
+        def slow_read(info):
+            reading.set()
+            time.sleep(0.05)
+            return read(info)
+
+        zip_loader.archive.read = slow_read
+        results = []
+        reader = threading.Thread(target=lambda: results.append(zip_loader.get_source(Mock(), "begin")[0]))
+        reader.start()
+        reading.wait()
+        with zipfile.ZipFile(archive_path + ".new", "w") as archive:
+            archive.writestr("story/begin.ravel", "changed")
+        os.replace(archive_path + ".new", archive_path)
+        assert zip_loader.get_source(Mock(), "begin")[0] == "changed"
+        reader.join()
+        assert len(results) == 1
+
+    def test_it_should_refuse_options_that_need_files(self, archive_path):
+        result = CliRunner().invoke(cli.main, ["run", str(archive_path), "--watch"])
+        assert result.exit_code == 2
+        assert "--watch can't be used with a zip archive" in result.output
@@ -1,8 +1,11 @@
 import itertools as it
+import random
+from unittest.mock import patch
 
+import attr
 import pytest
 
-from ravel import parsers, types
+from ravel import environments, exceptions, loaders, parsers, types
 
 
 class TestIntroTextParser:
@@ -198,3 +201,94 @@ class TestOperationsParser:
         result = parser.parse(statement)
         assert isinstance(result, types.Operation)
         assert result == expected
+
+
+def get_structure(value):
+    """Describe a parse result down to the types of its leaves."""
+    if attr.has(type(value)):
+        return (type(value).__name__,) + tuple(
+            get_structure(getattr(value, field.name)) for field in attr.fields(type(value)) if field.init
+        )
+    return type(value).__name__, value
+
+
+def parse_both(parser, text):
+    try:
+        expected = get_structure(parser.parse_grammar(text))
+    except (exceptions.ParsimoniousParseError, exceptions.VisitationError):
+        expected = None
+    result = parser.parse_fast(text)
+    return (None if result is None else get_structure(result)), expected
+
+
+class TestFastParsers:
+    PARSERS = [parsers.ComparisonParser, parsers.OperationParser, parsers.PlainTextParser]
+
+    @pytest.mark.parametrize("story", ["cloak", "simple", "taxi"])
+    def test_it_should_parse_the_examples_like_the_grammar(self, examples_path, story):
+        seen = []
+        parse = parsers.BaseParser.parse
+
+        def record(parser, text, pos=0):
+            seen.append((parser, text))
+            return parse(parser, text, pos)
+
+        env = environments.Environment(loader=loaders.FileSystemLoader(base_path=examples_path / story))
+        with patch.object(parsers.BaseParser, "parse", record):
+            env.load()
+
+        seen = [(parser, text) for parser, text in seen if isinstance(parser, tuple(self.PARSERS))]
+        assert seen
+        for parser, text in seen:
+            result, expected = parse_both(parser, text)
+            assert result == expected, text
+
+    @pytest.mark.parametrize(
+        "text",
+        [
+            "Foo > 3",
+            " Foo>3",
+            "[Foo Bar] <= 2.",
+            '"Foo Bar" != `baz`',
+            "[Foo]x > 3",
+            '"Foo" bar" > 3',
+            "Foo >== 3",
+            "Foo = = 3",
+            "Foo == valuex",
+            "Foo == 1 - 2 - 3",
+            "Foo == 4 / 2 * 3 // (1 % 2)",
+            "Foo == ( 1+2 )*3",
+            "Foo == (1 + 2",
+            'Foo == """a"""',
+            'Foo == ""a""',
+            "Foo += 1 max 5",
+            "Foo += 1 max",
+            "Foo //= 2 min 1.5 ",
+            "{Foo > 3}Bar <>",
+            "{Fo}o > 3} Bar",
+            "{not a comparison} Bar",
+            "{Foo == 'a}b'} Bar",
+            "Bar <> baz",
+            "",
+        ],
+    )
+    def test_it_should_agree_with_the_grammar_or_defer_to_it(self, text):
+        for parser_type in self.PARSERS:
+            result, expected = parse_both(parser_type(), text)
+            assert result is None or result == expected, (parser_type, text)
+
+    def test_it_should_agree_with_the_grammar_on_generated_input(self):
+        fragments = [
+            "Foo", "[Foo Bar]", '"Foo"', " ", "  ", ">", ">=", "=", "==", "!=", "+=", "//=", "+", "-", "*",
+            "/", "//", "%", "(", ")", "1", "2.5", "3.", "value", "'a'", '"b"', "max", "min", "{", "}", "<>",
+        ]
+        rng = random.Random(0)
+        parsers_ = [parser_type() for parser_type in self.PARSERS]
+        handled = 0
+        for _ in range(3000):
+            text = "".join(rng.choice(fragments) for _ in range(rng.randint(1, 9)))
+            for parser in parsers_:
+                result, expected = parse_both(parser, text)
+                assert result is None or result == expected, (parser, text)
+                handled += result is not None
+        assert handled
@@ -0,0 +1,73 @@
+import json
+from itertools import count
+
+import pytest
+from click.testing import CliRunner
+
+from ravel import cli, environments, loaders, profilers
+
+
+@pytest.fixture
+def profiler():
+    return profilers.CompileProfiler()
+
+
+@pytest.fixture
+def profiled_env(examples_path, profiler):
+    return environments.Environment(
+        loader=loaders.FileSystemLoader(base_path=examples_path / "cloak"),
+        profiler=profiler,
+    )
+
+
+class TestPhase:
+    def test_it_should_do_nothing_without_a_profiler(self, cloak_env):
+        assert profilers.phase(cloak_env, "syml") is profilers.DISABLED
+        assert profilers.rule(cloak_env, "foyer::foyer") is profilers.DISABLED
+        assert profilers.file(cloak_env, "foyer") is profilers.DISABLED
+
+    def test_it_should_time_with_the_profiler(self, profiled_env, profiler):
+        profiler.clock = count().__next__
+        with profilers.phase(profiled_env, "syml"):
+            pass
+        with profilers.phase(profiled_env, "syml"):
+            pass
+        assert profiler.phases["syml"] == profilers.PhaseStats(seconds=2, calls=2)
+
+
+class TestCompileProfiler:
+    def test_it_should_record_phases_files_and_rules(self, profiled_env, profiler):
+        profiled_env.load()
+        assert {"syml", "preamble", "rulesets", "baggage", "directives", "merge", "index"} <= set(profiler.phases)
+        assert set(profiler.files) == {"begin", "foyer", "bar-dark", "bar-light", "cloakroom"}
+        assert "foyer::foyer" in profiler.rules
+        assert all(stats.calls for stats in profiler.phases.values())
+
+    def test_it_should_sort_the_slowest_rules(self, profiler):
+        for name, seconds in [("a", 1.0), ("b", 3.0), ("c", 2.0)]:
+            profiler.add(profiler.rules, name, seconds)
+        assert [name for name, _ in profiler.get_slowest_rules(2)] == ["b", "c"]
+
+    def test_it_should_report_as_json(self, profiled_env, profiler):
+        profiled_env.load()
+        report = json.loads(json.dumps(profiler.as_dict(how_many=3)))
+        assert set(report) == {"phases", "files", "slowest_rules"}
+        assert len(report["slowest_rules"]) == 3
+        assert report["files"]["foyer"]["calls"] == 1
+
+    def test_it_should_not_be_pickled_with_the_environment(self, profiled_env):
+        assert profiled_env.__getstate__()["profiler"] is None
+        assert profiled_env.get_worker_environment().profiler is None
+
+
+class TestProfileCompileCommand:
+    def test_it_should_print_a_breakdown(self, examples_path):
+        result = CliRunner().invoke(cli.main, ["profile-compile", str(examples_path / "cloak"), "--top", "2"])
+        assert result.exit_code == 0, result.output
+        assert "Phase" in result.output
+        assert "foyer" in result.output
+
+    def test_it_should_print_json(self, examples_path):
+        result = CliRunner().invoke(cli.main, ["profile-compile", str(examples_path / "cloak"), "--json"])
+        assert result.exit_code == 0, result.output
+        assert "files" in json.loads(result.output)
@@ -1,10 +1,12 @@
 import textwrap
+from unittest.mock import patch
 
 import pytest
 import syml
 
-from ravel import environments, queries, types
+from ravel import environments, loaders, queries, types
 from ravel.compiler.rulebooks import compile_rulebook
+from ravel.vm import events
 
 
 class TestQueryPredicates:
@@ -86,6 +88,442 @@ class TestQueryTop:
         assert result is None
 
 
+class TestQuery:
+    @pytest.fixture
+    def rules(self):
+        rulebook = syml.loads(TEST_RULES + UNGATED_RULES)
+        env = environments.Environment()
+        return compile_rulebook(env, rulebook)["rulebook"]
+
+    @pytest.fixture
+    def indexed_rules(self, rules):
+        return {
+            concept: dict(ruleset, index=queries.build_index(ruleset["rules"])) for concept, ruleset in rules.items()
+        }
+
+    Q = [("foo", "bar"), ("blah", "boo"), ("size", 2)]
+
+    def test_it_should_order_results_by_score_then_name(self, rules):
+        result = [name for name, _ in queries.query("onTest", self.Q, rules)]
+        assert result == ["foo-bar-blah-boo", "unguarded", "foo-bar", "big-size"]
+
+    @pytest.mark.parametrize("how_many", [None, 1, 2, 3, 10])
+    def test_it_should_agree_with_and_without_an_index(self, rules, indexed_rules, how_many):
+        expected = list(queries.query("onTest", self.Q, rules))[:how_many]
+        assert list(queries.query("onTest", self.Q, rules, how_many=how_many)) == expected
+        assert list(queries.query("onTest", self.Q, indexed_rules, how_many=how_many)) == expected
+
+    def test_it_should_only_look_up_the_locations_of_the_top_rules(self, rules):
+        with patch.object(queries, "query_by_name", wraps=queries.query_by_name) as query_by_name:
+            list(queries.query("onTest", self.Q, rules, how_many=2))
+            assert [call.args[0] for call in query_by_name.call_args_list] == ["foo-bar-blah-boo", "unguarded"]
+
+    def test_it_should_stop_checking_ranked_rules_after_the_top_rules(self, indexed_rules):
+        match = queries.PredicateMatcher.match
+        with patch.object(queries.PredicateMatcher, "match", autospec=True, side_effect=match) as mock_match:
+            assert queries.query_top("onTest", self.Q, indexed_rules)[0] == "foo-bar-blah-boo"
+            assert mock_match.call_count == 1
+
+
+class TestPredicateMatcher:
+    @pytest.fixture
+    def rule(self):
+        return types.Rule(
+            "rule",
+            [
+                types.Predicate("foo", types.Comparison("foo", ">=", 1)),
+                types.Predicate("bar", types.Comparison("bar", "=", "baz")),
+            ],
+        )
+
+    def test_it_should_match_a_rule(self, rule):
+        matcher = queries.PredicateMatcher()
+        assert matcher.match({"foo": 1, "bar": "baz"}, rule) is True
+        assert matcher.match({"foo": 0, "bar": "baz"}, rule) is False
+        assert matcher.match({"bar": "baz"}, rule) is False
+
+    def test_it_should_stop_at_the_first_failing_predicate(self, rule):
+        matcher = queries.PredicateMatcher()
+        # `foo` fails first, so `bar` is never checked.
+        assert matcher.match({"foo": 0, "bar": "qux"}, rule) is False
+        assert matcher.stats[("foo", "('foo' >= 1)")].checks == 1
+        assert matcher.stats[("foo", "('foo' >= 1)")].failures == 1
+        assert sum(stats["checks"] for stats in matcher.dump()) == 1
+
+    def test_it_should_not_reorder_checks_being_iterated(self, rule):
+        matcher = queries.PredicateMatcher(reorder_every=2)
+        matcher.match({"foo": 2, "bar": "qux"}, rule)
+        checks = matcher.get_plan(rule).checks
+        matcher.match({"foo": 2, "bar": "qux"}, rule)
+        assert [quality for quality, *_ in checks] == ["foo", "bar"]
+        assert [quality for quality, *_ in matcher.get_plan(rule).checks] == ["bar", "foo"]
+
+    def test_it_should_check_the_most_selective_predicates_first(self, rule):
+        matcher = queries.PredicateMatcher(reorder_every=4)
+        for _ in range(4):
+            matcher.match({"foo": 2, "bar": "qux"}, rule)
+        assert [quality for quality, *_ in matcher.get_plan(rule).checks] == ["bar", "foo"]
+
+        assert matcher.stats[("foo", "('foo' >= 1)")].checks == 3
+        matcher.match({"foo": 2, "bar": "qux"}, rule)
+        assert matcher.stats[("foo", "('foo' >= 1)")].checks == 3
+
+    def test_it_should_share_counters_between_rules(self, rule):
+        matcher = queries.PredicateMatcher()
+        other = types.Rule("other", rule.predicates[:1])
+        matcher.match({"foo": 0}, rule)
+        matcher.match({"foo": 0}, other)
+        assert matcher.stats[("foo", "('foo' >= 1)")].failures == 2
+
+    def test_it_should_dump_the_counters_of_a_rulebook(self, cloak_env):
+        rulebook = cloak_env.load()["rulebook"]
+        list(queries.query("Situation", {"Location": "Bar", "Wearing Cloak": 1, "Bar": 0}, rulebook))
+        stats = queries.dump_predicate_stats(rulebook)
+        assert list(stats) == ["Situation"]
+        assert {"quality", "predicate", "checks", "failures", "selectivity"} == set(stats["Situation"][0])
+        assert sum(stat["checks"] for stat in stats["Situation"]) > 0
+
+
+class TestDecisionDAG:
+    @pytest.fixture
+    def rules(self):
+        shared = types.Predicate("foo", types.Comparison("foo", "=", "bar"))
+        return [
+            types.Rule("a", [types.Predicate("bar", types.Comparison("bar", ">", 1)), shared]),
+            types.Rule("b", [types.Predicate("baz", types.Comparison("baz", ">", 1)), shared]),
+            types.Rule("c", [types.Predicate("foo", types.Comparison("foo", "=", "bar"))]),
+        ]
+
+    def test_it_should_share_the_most_common_tests(self, rules):
+        dag = queries.DecisionDAG.build(rules)
+        assert len(dag.tests) == 3
+        assert list(dag.root.children) == [1]
+        shared = dag.root.children[1]
+        assert shared.rules == [2]
+        assert sorted(shared.children) == [0, 2]
+
+    def test_it_should_check_each_distinct_predicate_at_most_once(self, rules):
+        dag = queries.DecisionDAG.build(rules)
+        with patch.object(queries, "check_predicate", wraps=queries.check_predicate) as check:
+            accepted = dag.accepted({"foo": "bar", "bar": 2})
+            assert [rule.name for rule in accepted] == ["a", "c"]
+            assert check.call_count == 3
+
+    def test_it_should_prune_branches_below_a_failed_test(self, rules):
+        dag = queries.DecisionDAG.build(rules)
+        with patch.object(queries, "check_predicate", wraps=queries.check_predicate) as check:
+            assert dag.accepted({"foo": "baz", "bar": 2}) == []
+            assert check.call_count == 1
+
+    def test_it_should_add_and_remove_rules_in_place(self, rules):
+        dag = queries.DecisionDAG.build(rules[:2])
+        dag.add(rules[2:])
+        assert [rule.name for rule in dag.accepted({"foo": "bar", "bar": 2})] == ["a", "c"]
+
+        dag.remove(rules[:1])
+        assert [rule.name for rule in dag.accepted({"foo": "bar", "bar": 2})] == ["c"]
+        assert sorted(dag.root.children[1].children) == [2]
+        assert dag.removed == 1
+
+
+class TestEngines:
+    @pytest.mark.parametrize("engine", list(queries.ENGINES))
+    def test_every_engine_should_match_the_linear_scan_on_the_cloak_of_darkness(self, examples_path, engine):
+        env = environments.Environment(
+            loader=loaders.FileSystemLoader(base_path=examples_path / "cloak"),
+            query_engine=engine,
+        )
+        rulebook = env.load()["rulebook"]
+        linear = {concept: {**ruleset, "index": None, "cache": None} for concept, ruleset in rulebook.items()}
+        for location in ["Intro", "Foyer", "Bar", "Cloakroom"]:
+            for bar in [0, 2]:
+                q = {"Location": location, "Wearing Cloak": 0, "Bar": bar, "Fumbled": 1}
+                for how_many in [None, 1]:
+                    expected = list(queries.query("Situation", q, linear, how_many=how_many))
+                    assert list(queries.query("Situation", q, rulebook, how_many=how_many)) == expected
+
+    def test_it_should_select_the_engine_from_the_environment(self, examples_path):
+        env = environments.Environment(
+            loader=loaders.FileSystemLoader(base_path=examples_path / "cloak"),
+            query_engine="dag",
+        )
+        assert isinstance(env.load()["rulebook"]["Situation"]["index"], queries.DecisionDAG)
+
+    def test_it_should_reject_an_unknown_engine(self):
+        with pytest.raises(ValueError):
+            queries.build_index([], "quantum")
+
+
+class TestQueryCache:
+    @pytest.fixture
+    def rules(self):
+        rulebook = syml.loads(TEST_RULES + UNGATED_RULES)
+        env = environments.Environment()
+        rules = compile_rulebook(env, rulebook)["rulebook"]
+        rules["onTest"]["cache"] = queries.QueryCache.build(rules["onTest"]["rules"], maxsize=2)
+        return rules
+
+    def test_it_should_key_on_the_relevant_qualities(self, rules):
+        cache = rules["onTest"]["cache"]
+        assert cache.qualities == ("blah", "foo", "size")
+        assert cache.get_key({"foo": "bar", "turns": 5}) == cache.get_key({"foo": "bar", "turns": 6})
+        assert cache.get_key({"foo": "bar"}) != cache.get_key({"foo": "baz"})
+        assert cache.get_key({"size": 1}) != cache.get_key({"size": 1.0})
+        assert cache.get_key({"size": None}) != cache.get_key({})
+        assert cache.get_key({"foo": "bar"}, how_many=1) != cache.get_key({"foo": "bar"})
+
+    def test_it_should_cache_query_results(self, rules):
+        cache = rules["onTest"]["cache"]
+        expected = list(queries.query("onTest", {"foo": "bar", "turns": 1}, rules))
+        with patch.object(queries, "query_ruleset") as query_ruleset:
+            assert list(queries.query("onTest", {"foo": "bar", "turns": 2}, rules)) == expected
+            query_ruleset.assert_not_called()
+        assert cache.stats() == {"hits": 1, "misses": 1, "evictions": 0, "size": 1, "maxsize": 2}
+
+    def test_it_should_evict_the_least_recently_used_results(self, rules):
+        cache = rules["onTest"]["cache"]
+        for foo in ["bar", "baz", "bar", "qux"]:
+            list(queries.query("onTest", {"foo": foo}, rules))
+        assert cache.stats() == {"hits": 1, "misses": 3, "evictions": 1, "size": 2, "maxsize": 2}
+        assert cache.get(cache.get_key({"foo": "bar"})) is not None
+        assert cache.get(cache.get_key({"foo": "baz"})) is None
+
+    def test_it_should_bypass_the_cache_for_unhashable_qualities(self, rules):
+        cache = rules["onTest"]["cache"]
+        assert list(queries.query("onTest", {"foo": ["bar"]}, rules)) == [("unguarded", ["unguarded"])]
+        assert cache.stats()["misses"] == 0
+
+    def test_it_should_report_cache_stats_for_a_rulebook(self, rules):
+        list(queries.query("onTest", {"foo": "bar"}, rules))
+        assert queries.get_cache_stats(rules)["onTest"]["misses"] == 1
+
+    def test_it_should_key_on_the_qualities_of_added_rules(self, rules):
+        cache = rules["onTest"]["cache"]
+        list(queries.query("onTest", {"foo": "bar"}, rules))
+        new_cache = cache.updated([types.Rule("new", [types.Predicate("new", types.Comparison("new", "=", 1))])])
+        assert new_cache.stats()["size"] == 0
+        assert cache.stats()["size"] == 1
+        assert "new" in new_cache.qualities and "foo" in new_cache.qualities
+
+
+class TestPresenceFilter:
+    @pytest.fixture
+    def rules(self):
+        return [
+            types.Rule("a", [types.Predicate("foo", types.Comparison("foo", "!=", "bar"))]),
+            types.Rule("b", [types.Predicate("foo", types.Comparison("foo", ">", "a"))]),
+            types.Rule("c", [types.Predicate("bar", types.Comparison("bar", "<", types.Expression(2, "-", 1)))]),
+            types.Rule("d", [types.Predicate("bar", types.Comparison("bar", "!=", 0))]),
+        ]
+
+    def test_it_should_work_out_which_qualities_each_rule_needs(self, rules):
+        presence = queries.PresenceFilter.build(rules, unindexed=[0, 1, 2, 3])
+        assert presence.needs == [frozenset(), {"foo"}, frozenset(), {"bar"}]
+        assert presence.qualities == ("bar", "foo")
+
+    def test_it_should_skip_rules_needing_missing_qualities(self, rules):
+        presence = queries.PresenceFilter.build(rules, unindexed=[1, 2, 3])
+        assert presence.get_allowed({"baz": 1}) == ({0, 2}, [2])
+        assert presence.get_allowed({"foo": "b"}) == ({0, 1, 2}, [1, 2])
+
+    def test_it_should_cache_by_the_set_of_needed_qualities_present(self, rules):
+        presence = queries.PresenceFilter.build(rules, unindexed=[0, 1, 2, 3])
+        first = presence.get_allowed({"foo": "b", "baz": 1})
+        assert presence.get_allowed({"foo": "c", "qux": 2}) is first
+        assert list(presence.allowed) == [frozenset({"foo"})]
+
+    def test_the_index_should_skip_rules_needing_missing_qualities(self, rules):
+        with patch.object(queries, "PredicateMatcher") as matcher:
+            index = queries.build_index(rules)
+            assert [rule.name for rule in index.candidates({"baz": 1})] == ["c", "a"]
+            matcher.return_value.match.assert_not_called()
+
+
+class TestRangeIndex:
+    @pytest.fixture
+    def index(self):
+        return queries.RangeIndex.build(
+            [
+                (">=", 1, 0),
+                (">=", 3, 1),
+                (">", 1, 2),
+                ("<=", 2, 3),
+                ("<", 2, 4),
+                (">=", 2, 5),
+            ]
+        )
+
+    def test_it_should_sort_thresholds_per_comparator(self, index):
+        assert index.thresholds == {">=": [1, 2, 3], ">": [1], "<=": [2], "<": [2]}
+        assert index.positions == {">=": [0, 5, 1], ">": [2], "<=": [3], "<": [4]}
+
+    @pytest.mark.parametrize(
+        "value, expected",
+        [
+            (0, [3, 4]),
+            (1, [0, 3, 4]),
+            (1.5, [0, 2, 3, 4]),
+            (2, [0, 2, 3, 5]),
+            (3, [0, 1, 2, 5]),
+        ],
+    )
+    def test_it_should_find_the_satisfied_range_predicates(self, index, value, expected):
+        assert sorted(index.satisfied(value)) == expected
+
+    def test_it_should_defer_non_numeric_values_to_the_full_check(self, index):
+        assert sorted(index.satisfied("foo")) == [0, 1, 2, 3, 4, 5]
+
+    def test_it_should_add_and_remove_thresholds_in_order(self, index):
+        index.add(">=", 2, 6)
+        index.remove(">=", 2, 5)
+        index.remove(">", 1, 2)
+        assert index.thresholds == {">=": [1, 2, 3], "<=": [2], "<": [2]}
+        assert index.positions == {">=": [0, 6, 1], "<=": [3], "<": [4]}
+
+
+class TestRulesetIndex:
+    @pytest.fixture
+    def ruleset(self):
+        rulebook = syml.loads(TEST_RULES + UNGATED_RULES)
+        env = environments.Environment()
+        return compile_rulebook(env, rulebook)["rulebook"]["onTest"]
+
+    def test_it_should_file_rules_under_their_equality_predicates(self, ruleset):
+        index = queries.build_index(ruleset["rules"])
+        assert index.equalities == {"blah": {"boo": [2]}, "foo": {"bar": [1, 2]}}
+        assert index.required == [1, 1, 2, 0]
+        assert index.unindexed == [3]
+
+    def test_it_should_file_rules_under_their_range_predicates(self, ruleset):
+        index = queries.build_index(ruleset["rules"])
+        assert index.ranges == {
+            "size": queries.RangeIndex(thresholds={">": [1]}, positions={">": [0]}),
+        }
+
+    def test_it_should_only_offer_candidates_whose_equalities_can_match(self, ruleset):
+        index = queries.build_index(ruleset["rules"])
+        candidates = index.candidates({"foo": "bar"})
+        assert [rule.name for rule in candidates] == ["unguarded", "foo-bar"]
+
+        candidates = index.candidates({"foo": "bar", "blah": "boo", "size": 2})
+        assert [rule.name for rule in candidates] == ["foo-bar-blah-boo", "unguarded", "foo-bar", "big-size"]
+
+        candidates = index.candidates({"foo": "baz", "blah": "boo"})
+        assert [rule.name for rule in candidates] == ["unguarded"]
+
+    def test_it_should_index_added_and_removed_rules_like_a_new_index(self, ruleset):
+        rules = ruleset["rules"]
+        index = queries.build_index(rules[:2])
+        index.add(rules[2:])
+        index.remove(rules[:1])
+        expected = queries.build_index(rules[1:])
+        assert index.equalities == {"blah": {"boo": [2]}, "foo": {"bar": [1, 2]}}
+        assert index.ranges == {}
+        assert index.unindexed == [3]
+        for qualities in [{"foo": "bar"}, {"foo": "bar", "blah": "boo", "size": 2}, {"foo": "baz", "blah": "boo"}]:
+            assert index.candidates(qualities) == expected.candidates(qualities)
+
+    def test_it_should_build_again_to_drop_the_holes_of_removed_rules(self, ruleset):
+        rules = ruleset["rules"]
+        index = queries.build_index(rules)
+        index = queries.update_index(index, rules[:1], [], rules[1:])
+        assert index.removed == 1
+        new_index = queries.update_index(index, rules[1:3], [], rules[3:])
+        assert new_index is not index
+        assert new_index == queries.build_index(rules[3:])
+
+    def test_it_should_match_the_linear_scan(self, ruleset):
+        indexed = dict(ruleset, index=queries.build_index(ruleset["rules"]))
+        for q in [
+            [("foo", "bar")],
+            [("foo", "bar"), ("blah", "boo")],
+            [("foo", "bar"), ("size", 5)],
+            [("blah", "boo"), ("size", 1)],
+            [("foo", "bar"), ("blah", "boo"), ("size", 2.5)],
+            [],
+        ]:
+            expected = list(queries.query("onTest", q, {"onTest": ruleset}))
+            assert list(queries.query("onTest", q, {"onTest": indexed})) == expected
+
+    def test_it_should_match_the_linear_scan_on_the_cloak_of_darkness(self, cloak_env):
+        rulebook = cloak_env.load()["rulebook"]
+        linear = {concept: {**ruleset, "index": None, "cache": None} for concept, ruleset in rulebook.items()}
+        for location in ["Intro", "Foyer", "Bar", "Cloakroom", "Nowhere"]:
+            for cloak in [0, 1]:
+                q = {"Location": location, "Wearing Cloak": cloak, "Bar": 2, "Fumbled": 0}.items()
+                expected = list(queries.query("Situation", q, linear))
+                assert expected == list(queries.query("Situation", q, rulebook))
+
+
+class TestMatchNetwork:
+    @pytest.fixture
+    def rulebook(self):
+        rulebook = syml.loads(TEST_RULES + UNGATED_RULES)
+        env = environments.Environment()
+        return compile_rulebook(env, rulebook)["rulebook"]
+
+    def changed(self, network, qualities, quality, value):
+        initial_value = qualities.get(quality)
+        qualities[quality] = value
+        network.quality_changed(quality_changed(quality, initial_value, value))
+
+    def test_it_should_match_the_initial_qualities(self, rulebook):
+        qualities = {"foo": "bar"}
+        network = queries.MatchNetwork(rulebook, qualities)
+        assert list(network.query("onTest")) == list(queries.query("onTest", qualities.items(), rulebook))
+
+    def test_it_should_follow_quality_changes(self, rulebook):
+        qualities = {"foo": "bar"}
+        network = queries.MatchNetwork(rulebook, qualities)
+        assert [name for name, _ in network.query("onTest")] == ["unguarded", "foo-bar"]
+
+        for quality, value in [("blah", "boo"), ("size", 2), ("foo", "baz"), ("foo", "bar"), ("size", 0)]:
+            self.changed(network, qualities, quality, value)
+            expected = list(queries.query("onTest", qualities.items(), rulebook))
+            assert list(network.query("onTest")) == expected
+
+    def test_it_should_only_recheck_predicates_reading_the_changed_quality(self, rulebook):
+        qualities = {"foo": "bar"}
+        network = queries.MatchNetwork(rulebook, qualities)
+        list(network.query("onTest"))
+        with patch.object(queries, "check_predicate", wraps=queries.check_predicate) as check:
+            self.changed(network, qualities, "size", 5)
+            assert [call.args[1].name for call in check.call_args_list] == ["size"]
+
+    def test_it_should_limit_results(self, rulebook):
+        network = queries.MatchNetwork(rulebook, {"foo": "bar", "blah": "boo"})
+        assert list(network.query("onTest", how_many=1)) == [("foo-bar-blah-boo", ["blah"])]
+
+    def test_it_should_return_nothing_for_an_unknown_concept(self, rulebook):
+        network = queries.MatchNetwork(rulebook, {})
+        assert list(network.query("onNothing")) == []
+
+    def test_it_should_keep_its_own_copy_of_the_rules(self, rulebook):
+        network = queries.MatchNetwork(rulebook, {"foo": "bar"})
+        expected = list(network.query("onTest"))
+        del rulebook["onTest"]["rules"][:]
+        assert list(network.query("onTest")) == expected
+
+
+def quality_changed(quality, initial_value, new_value):
+    return events.quality_changed(quality=quality, initial_value=initial_value, new_value=new_value)
+
+
+UNGATED_RULES = textwrap.dedent(
+    """
+    big-size:
+        - onTest
+        - when: size > 1
+        - big
+
+    unguarded:
+        - onTest
+        - when: foo != "baz"
+        - unguarded
+"""
+)
+
+
 TEST_RULES = textwrap.dedent(
     """
     foo-bar:
@@ -0,0 +1,73 @@
+from unittest.mock import patch
+
+import pytest
+import syml
+
+from ravel import readers
+
+
+def read_both(source, raw=True):
+    try:
+        expected = syml.loads(source, filename="test", raw=raw)
+    except Exception as e:
+        expected = type(e)
+    try:
+        result = readers.loads(source, filename="test", raw=raw)
+    except Exception as e:
+        result = type(e)
+    return result, expected
+
+
+class TestLoads:
+    @pytest.mark.parametrize("raw", [True, False])
+    def test_it_should_read_the_examples_like_syml_without_syml(self, examples_path, raw):
+        for filepath in examples_path.walkfiles("*.ravel"):
+            source = filepath.read_text(encoding="utf-8")
+            expected = syml.loads(source, filename="test", raw=raw)
+            with patch("syml.loads") as loads:
+                assert readers.loads(source, filename="test", raw=raw) == expected, filepath
+                loads.assert_not_called()
+
+    @pytest.mark.parametrize(
+        "source",
+        [
+            "a: b",
+            "a:\n  b: c\n  d:\n    - e\n    - f: g\n      h: i",
+            "- a\n- b\n  c\n-   d  ",
+            "- - a\n  - b\n- c",
+            "- key:\n    - value",
+            "text\n  more text\n\n    and more\n",
+            "a: b\n# comment\n  // another: comment\nc: d",
+            "a:\n\t- b\n\t- c",
+            "a:\n  \n    b",
+            "-\n-x\n- ",
+            "a b: c\nd: e: f",
+            "a:b",
+            "a:   ",
+            "- a:b",
+            "a:\n  b\n c: d",
+            "",
+            "# only a comment",
+            "a: b\r\nc: d",
+            "a:\u00a0b",
+        ],
+    )
+    @pytest.mark.parametrize("raw", [True, False])
+    def test_it_should_agree_with_syml(self, source, raw):
+        result, expected = read_both(source, raw)
+        assert result == expected
+
+    def test_it_should_defer_to_syml_for_what_it_does_not_support(self):
+        with patch("syml.loads") as loads:
+            assert readers.loads("a:b", filename="test") is loads.return_value
+            loads.assert_called_once_with("a:b", filename="test", raw=True)
+
+    def test_it_should_log_when_it_defers_to_syml(self, caplog):
+        with caplog.at_level("DEBUG", logger="ravel.readers"):
+            assert readers.loads("a: b\r\n", filename="test") == {"a": "b\r"}
+        assert "Reading test with syml" in caplog.text
+
+    def test_it_should_not_hide_its_own_bugs(self):
+        with patch("ravel.readers.read_document", side_effect=RuntimeError):
+            with pytest.raises(RuntimeError):
+                readers.loads("a: b")
@@ -1,3 +1,7 @@
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+
 import pytest
 
 from ravel import types
@@ -186,3 +190,200 @@ class TestOperation:
         )
         result = operation.evaluate(2)
         assert result == expected
+
+
+class TestCompile:
+    OPERANDS = [None, 0, 2, 3, 4.5]
+
+    @pytest.mark.parametrize("cmp", [">", ">=", "==", "=", "<=", "<", "!="])
+    @pytest.mark.parametrize(
+        "expression",
+        [
+            3,
+            2.5,
+            types.Expression(5, "-", 3),
+            types.Expression(types.Expression(7, "//", 2), "%", types.Expression(2, "*", 2)),
+            types.Expression(9, "/", 2),
+        ],
+    )
+    def test_a_compiled_comparison_should_agree_with_evaluate(self, cmp, expression):
+        comparison = types.Comparison(quality="Foo", comparator=cmp, expression=expression)
+        compiled = comparison.compile()
+        for qvalue in self.OPERANDS:
+            assert compiled(qvalue) == comparison.evaluate(qvalue)
+
+    def test_a_compiled_comparison_should_inline_string_constants(self):
+        comparison = types.Comparison(quality="Location", comparator="=", expression='Foy"er')
+        assert comparison.compile()('Foy"er') is True
+        assert comparison.compile()("Bar") is False
+
+    def test_a_comparison_should_only_compile_once(self):
+        comparison = types.Comparison(quality="Foo", comparator=">", expression=1)
+        assert comparison.compile() is comparison.compile()
+
+    def test_compiling_should_not_affect_equality_or_repr(self):
+        comparison = types.Comparison(quality="Foo", comparator=">", expression=1)
+        comparison.compile()
+        assert comparison == types.Comparison(quality="Foo", comparator=">", expression=1)
+        assert repr(comparison) == "('Foo' > 1)"
+
+    def test_a_compiled_comparison_should_defer_to_terms_it_cannot_inline(self):
+        term = Mock()
+        term.evaluate.return_value = 3
+        comparison = types.Comparison(quality="Foo", comparator=">=", expression=term)
+        assert comparison.compile()(4, qualities={}) is True
+        term.evaluate.assert_called_once_with(qvalue=4, qualities={})
+
+    @pytest.mark.parametrize("operator", ["=", "+=", "-=", "*=", "//=", "/=", "%="])
+    def test_a_compiled_operation_should_agree_with_evaluate(self, operator):
+        operation = types.Operation(quality="Foo", operator=operator, expression=types.Expression(1, "+", 2))
+        compiled = operation.compile()
+        for initial_value in self.OPERANDS:
+            assert compiled(initial_value, qualities={}) == operation.evaluate(initial_value, qualities={})
+
+    def test_a_compiled_expression_should_agree_with_evaluate(self):
+        expression = types.Expression(types.Expression(7, "*", 3), "-", 2.5)
+        assert expression.compile()() == expression.evaluate() == 18.5
+
+    def test_a_compiled_comparison_should_pickle_without_its_code(self):
+        comparison = types.Comparison(quality="Foo", comparator=">", expression=types.Expression(1, "+", 1))
+        comparison.compile()
+        restored = pickle.loads(pickle.dumps(comparison))
+        assert restored == comparison
+        assert restored._compiled is None
+        assert restored.compile()(3) is True
+
+    def test_a_compiled_expression_should_raise_like_evaluate(self):
+        expression = types.Expression(1, "//", 0)
+        with pytest.raises(ZeroDivisionError):
+            expression.compile()()
+
+
+class TestPredicate:
+    @pytest.mark.parametrize(
+        "comparison, expected",
+        [
+            (types.Comparison("Foo", "=", 0), True),
+            (types.Comparison("Foo", ">", 0), False),
+            (types.Comparison("Foo", "!=", "bar"), True),
+            (types.Comparison("Foo", ">=", "bar"), False),
+        ],
+    )
+    def test_it_should_know_whether_it_holds_for_a_missing_quality(self, comparison, expected):
+        assert types.Predicate("Foo", comparison).holds_when_missing() is expected
+
+    def test_it_should_not_hold_for_a_missing_quality_when_it_raises(self):
+        predicate = types.Predicate("Foo", types.Comparison("Foo", ">", types.Expression(1, "/", 0)))
+        assert predicate.holds_when_missing() is False
+
+    def test_it_should_remember_whether_it_holds_for_a_missing_quality(self):
+        calls = []
+        predicate = types.Predicate("Foo", lambda value: calls.append(value) or True)
+        assert predicate.holds_when_missing() is True
+        assert predicate.holds_when_missing() is True
+        assert calls == [0]
+
+
+class TestLocations:
+    @pytest.fixture
+    def baggage(self):
+        def handler(environment, concept, rule_name, baggage):
+            calls.append(rule_name)
+            return {rule_name: baggage, rule_name + "::sub": "sub"}
+
+        calls = []
+        lazy = types.LazyBaggage(handler, None, "Situation", "foo::bar", "bar")
+        return lazy, calls
+
+    def test_it_should_compile_lazy_baggage_on_first_lookup(self, baggage):
+        lazy, calls = baggage
+        locations = types.Locations({"foo::bar": lazy})
+        assert locations["foo::bar"] == "bar"
+        assert locations["foo::bar"] == "bar"
+        assert calls == ["foo::bar"]
+
+    def test_it_should_compile_the_enclosing_baggage_of_a_nested_location(self, baggage):
+        lazy, calls = baggage
+        locations = types.Locations({"foo::bar": lazy}, separator="::")
+        assert locations.get("foo::bar::sub") == "sub"
+        assert calls == ["foo::bar"]
+
+    def test_it_should_raise_key_error_for_unknown_locations(self, baggage):
+        lazy, calls = baggage
+        locations = types.Locations({"foo::bar": lazy})
+        with pytest.raises(KeyError):
+            locations["foo::bar::baz"]
+        assert locations.get("baz") is None
+
+    def test_it_should_resolve_nested_locations_in_membership_tests(self, baggage):
+        lazy, calls = baggage
+        locations = types.Locations({"foo::bar": lazy})
+        assert "foo::bar::sub" in locations
+        assert "foo::bar::baz" not in locations
+        assert calls == ["foo::bar"]
+
+    def test_it_should_compile_lazy_baggage_when_iterating(self, baggage):
+        lazy, calls = baggage
+        locations = types.Locations({"foo::bar": lazy, "foo::baz": "baz"})
+        assert sorted(locations) == ["foo::bar", "foo::bar::sub", "foo::baz"]
+        assert len(locations) == 3
+        assert dict(locations.items()) == {"foo::bar": "bar", "foo::bar::sub": "sub", "foo::baz": "baz"}
+        assert calls == ["foo::bar"]
+
+    def test_it_should_copy_lazy_baggage_from_other_locations_without_compiling_it(self, baggage):
+        lazy, calls = baggage
+        locations = types.Locations()
+        locations.update(types.Locations({"foo::bar": lazy}))
+        assert locations.data == {"foo::bar": lazy}
+        assert calls == []
+
+    def test_it_should_compile_once_across_threads(self, baggage):
+        lazy, calls = baggage
+        locations = types.Locations({"foo::bar": lazy})
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(locations.__getitem__, ["foo::bar::sub"] * 8))
+        assert results == ["sub"] * 8
+        assert calls == ["foo::bar"]
+
+    def test_it_should_pickle_without_its_lock(self, baggage):
+        locations = types.Locations({"foo::bar": "bar"}, separator="/")
+        restored = pickle.loads(pickle.dumps(locations))
+        assert restored == locations
+        assert restored.separator == "/"
+        assert restored.lock is not locations.lock
+
+
+class TestMergedLocations:
+    @pytest.fixture
+    def baggage(self):
+        def handler(environment, concept, rule_name, baggage):
+            calls.append(rule_name)
+            return {rule_name: baggage, rule_name + "::sub": "sub"}
+
+        calls = []
+        lazy = types.LazyBaggage(handler, None, "Situation", "foo::bar", "bar")
+        return lazy, calls
+
+    def test_it_should_look_names_up_in_their_own_locations(self, baggage):
+        lazy, calls = baggage
+        locations = types.MergedLocations()
+        locations.add(types.Locations({"foo::bar": lazy}))
+        locations.add({"baz::qux": "qux"})
+        assert locations["foo::bar::sub"] == "sub"
+        assert locations["baz::qux"] == "qux"
+        assert "baz::quux" not in locations
+        assert calls == ["foo::bar"]
+        assert dict(locations) == {"foo::bar": "bar", "foo::bar::sub": "sub", "baz::qux": "qux"}
+
+    def test_it_should_remove_the_names_of_replaced_locations(self, baggage):
+        lazy, calls = baggage
+        locations = types.MergedLocations()
+        old = types.Locations({"foo::bar": lazy})
+        locations.add(old)
+        locations.add({"baz::qux": "qux"})
+        assert locations["foo::bar::sub"] == "sub"
+
+        locations.remove(old)
+        locations.add({"foo::baz": "baz"})
+        assert "foo::bar::sub" not in locations
+        assert dict(locations) == {"baz::qux": "qux", "foo::baz": "baz"}
@@ -2,7 +2,7 @@ from unittest.mock import Mock
 
 import pytest
 
-from ravel import types
+from ravel import queries, types
 from ravel.vm import machines, runners
 
 
@@ -52,6 +52,24 @@ class TestMachine:
         machine.initialize_from_givens()
         assert machine.qualities == {"Foo": 0}
 
+    def test_it_should_keep_its_matches_up_to_date(self, runner, vm):
+        vm.initialize_from_givens()
+        assert [name for name, _ in vm.query("Situation")] == ["begin::intro"]
+
+        vm.apply_operation(types.Operation(quality="Location", operator="=", expression="Foyer"))
+        assert vm.matches.qualities is vm.qualities
+        expected = list(queries.query("Situation", vm.qualities.items(), vm.rulebook))
+        assert list(vm.query("Situation")) == expected
+        assert "foyer::foyer" in [name for name, _ in expected]
+
+    def test_it_should_match_against_a_new_rulebook(self, runner, vm):
+        vm.initialize_from_givens()
+        assert [name for name, _ in vm.query("Situation")] == ["begin::intro"]
+
+        vm.rulebook = {**vm.rulebook, "Situation": {"rules": [], "locations": {}}}
+        assert list(vm.query("Situation")) == []
+        assert vm.matches.rulebook is vm.rulebook
+
 
 class TestCloak:
     def advance(self, vm, num=1):
@@ -0,0 +1,107 @@
+import pickle
+import tempfile
+import time
+
+import pytest
+from path import Path
+
+from ravel import loaders, watchers
+
+
+@pytest.fixture
+def tempdir():
+    _tempdir = Path(tempfile.mkdtemp())
+    yield _tempdir
+    _tempdir.rmtree()
+
+
+@pytest.fixture
+def polling_watcher():
+    watcher = watchers.PollingWatcher(interval=60)
+    yield watcher
+    watcher.close()
+
+
+@pytest.fixture
+def inotify_watcher():
+    if not watchers.InotifyWatcher.is_available():
+        pytest.skip("inotify isn't available")
+    watcher = watchers.InotifyWatcher(timeout=0.01)
+    yield watcher
+    watcher.close()
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestPollingWatcher:
+    def test_it_should_invalidate_only_the_changed_file(self, tempdir, polling_watcher):
+        (tempdir / "a.ravel").write_text("a")
+        (tempdir / "b.ravel").write_text("b")
+        a_is_up_to_date = polling_watcher.get_up_to_date_checker(tempdir / "a.ravel")
+        b_is_up_to_date = polling_watcher.get_up_to_date_checker(tempdir / "b.ravel")
+
+        polling_watcher.poll()
+        assert a_is_up_to_date() and b_is_up_to_date()
+
+        (tempdir / "a.ravel").write_text("a, edited")
+        polling_watcher.poll()
+        assert not a_is_up_to_date()
+        assert b_is_up_to_date()
+
+    def test_it_should_invalidate_deleted_files(self, tempdir, polling_watcher):
+        (tempdir / "a.ravel").write_text("a")
+        is_up_to_date = polling_watcher.get_up_to_date_checker(tempdir / "a.ravel")
+        (tempdir / "a.ravel").remove()
+        polling_watcher.poll()
+        assert not is_up_to_date()
+
+    def test_it_should_pickle_without_its_state(self, tempdir, polling_watcher):
+        (tempdir / "a.ravel").write_text("a")
+        polling_watcher.watch(tempdir / "a.ravel")
+        watcher = pickle.loads(pickle.dumps(polling_watcher))
+        assert watcher.interval == 60
+        assert watcher.generations == {}
+        assert watcher.thread is None
+
+
+class TestInotifyWatcher:
+    def test_it_should_invalidate_only_the_changed_file(self, tempdir, inotify_watcher):
+        (tempdir / "a.ravel").write_text("a")
+        (tempdir / "b.ravel").write_text("b")
+        a_is_up_to_date = inotify_watcher.get_up_to_date_checker(tempdir / "a.ravel")
+        b_is_up_to_date = inotify_watcher.get_up_to_date_checker(tempdir / "b.ravel")
+        assert a_is_up_to_date() and b_is_up_to_date()
+
+        (tempdir / "a.ravel").write_text("a, edited")
+        assert wait_for(lambda: not a_is_up_to_date())
+        assert b_is_up_to_date()
+
+    def test_it_should_invalidate_files_whose_directory_is_removed(self, tempdir, inotify_watcher):
+        (tempdir / "story").mkdir()
+        (tempdir / "story" / "a.ravel").write_text("a")
+        is_up_to_date = inotify_watcher.get_up_to_date_checker(tempdir / "story" / "a.ravel")
+        (tempdir / "story").rmtree()
+        assert wait_for(lambda: not is_up_to_date())
+
+
+class TestWatchedFileSystemLoader:
+    def test_it_should_check_freshness_through_the_watcher(self, tempdir, polling_watcher):
+        fs_loader = loaders.FileSystemLoader(base_path=tempdir, watcher=polling_watcher)
+        (tempdir / "test.ravel").write_text("test!")
+        source, is_up_to_date = fs_loader.get_source(None, "test")
+        assert source == "test!"
+        assert is_up_to_date()
+
+        (tempdir / "test.ravel").write_text("test, again!")
+        polling_watcher.poll()
+        assert not is_up_to_date()
+        source, is_up_to_date = fs_loader.get_source(None, "test")
+        assert source == "test, again!"
+        assert is_up_to_date()